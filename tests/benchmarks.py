@@ -0,0 +1,268 @@
+"""
+Benchmarks of toxygen internals. They don't use tox network, only libtoxcore and libtoxencryptsave are loaded.
+Run from repository root:
+
+    python -m tests.benchmarks --profiles small,medium --output results.json
+
+Results are written as json, so runs for different commits can be compared.
+"""
+from toxygen.profile import *
+from toxygen.history import History, PAGE_SIZE, MESSAGE_OWNER
+from toxygen.history_export import HistoryExporter
+from toxygen.messages import TextMessage
+from toxygen.toxencryptsave import ToxEncryptSave
+import toxes as encr  # the same module as in toxygen, toxygen/__init__.py adds it to path
+import argparse
+import json
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+
+PASSWORD = 'benchmark_password'
+
+PROFILES = {  # name - (number of messages, number of friends)
+    'small': (100, 10),
+    'medium': (10000, 100),
+    'large': (1000000, 5000)
+}
+
+SAVE_COUNT = 1000  # number of unsaved messages in save benchmark
+
+CHUNK_SIZE = 1371  # max size of file chunk in toxcore
+
+INLINE_SIZES = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024)  # sizes of received inline images
+
+SENT_FILE_SIZE = 64 * 1024 * 1024
+
+
+def measure(func, count):
+    """
+    :return: average time of func call in milliseconds
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) * 1000 / count
+
+
+def benchmark_encryption(count=10, size=64 * 1024):
+    """
+    Compares encryption with password (key is derived on every call) and with cached key
+    """
+    data = bytes(size)
+    raw = ToxEncryptSave()
+    encrypted = raw.pass_encrypt(data, PASSWORD)
+    es = encr.ToxES()
+    es.set_password(PASSWORD)
+    return {
+        'pass_encrypt': measure(lambda: raw.pass_encrypt(data, PASSWORD), count),
+        'pass_decrypt': measure(lambda: raw.pass_decrypt(encrypted, PASSWORD), count),
+        'cached_encrypt': measure(lambda: es.pass_encrypt(data), count),
+        'cached_decrypt': measure(lambda: es.pass_decrypt(encrypted), count)
+    }
+
+
+# -----------------------------------------------------------------------------------------------------------------
+# File transfers
+# -----------------------------------------------------------------------------------------------------------------
+
+
+def benchmark_receive_to_buffer(sizes=INLINE_SIZES):
+    """
+    Receives inline images chunk by chunk. Time of chunk shouldn't depend on size of image
+    :return: dict, key - size of image, value - average time of chunk in milliseconds
+    """
+    results = {}
+    chunk = bytes(CHUNK_SIZE)
+    for size in sizes:
+        transfer = ReceiveToBuffer(None, 0, size, 0)
+        positions = range(0, size, CHUNK_SIZE)
+        start = time.perf_counter()
+        for position in positions:
+            transfer.write_chunk(position, chunk[:size - position])
+        results['chunk_{}kb'.format(size // 1024)] = (time.perf_counter() - start) * 1000 / len(positions)
+    return results
+
+
+def benchmark_chunk_reader(directory, size=SENT_FILE_SIZE):
+    """
+    Reads file chunk by chunk as file transfer does
+    :return: dict with average time of chunk in milliseconds and throughput in MB/s
+    """
+    path = directory + 'sent_file.bin'
+    with open(path, 'wb') as fl:
+        fl.write(os.urandom(size))
+    positions = range(0, size, CHUNK_SIZE)
+    with open(path, 'rb', buffering=0) as fl:
+        reader = ChunkReader(fl)
+        start = time.perf_counter()
+        for position in positions:
+            reader.read(position, CHUNK_SIZE)
+        duration = time.perf_counter() - start
+    os.remove(path)
+    return {'chunk': duration * 1000 / len(positions), 'mb_per_sec': size / (1024 * 1024) / duration}
+
+
+# -----------------------------------------------------------------------------------------------------------------
+# History
+# -----------------------------------------------------------------------------------------------------------------
+
+
+def get_tox_id(number):
+    return '{:064X}'.format(number) + '0' * 12
+
+
+def generate_history(directory, name, messages_count, friends_count):
+    """
+    Creates history with synthetic messages. The first friend has half of all messages, others share the rest.
+    Existing history with the same name is reused
+    :return: History instance and list of friends' tox ids (the first one has the longest history)
+    """
+    ProfileHelper(directory, name)
+    path = directory + name + '.hstr'
+    tox_ids = list(map(get_tox_id, range(friends_count)))
+    if os.path.exists(path):
+        db = sqlite3.connect(path)
+        try:
+            exists = db.execute('SELECT count(*) FROM messages;').fetchone()[0] == messages_count
+        except sqlite3.Error:
+            exists = False
+        db.close()
+        if exists:
+            return History(name), tox_ids
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    history = History(name)
+    start = time.time() - messages_count
+    counts = [messages_count // 2] + [0] * (friends_count - 1)
+    for i in range(messages_count - counts[0]):
+        counts[1 + i % (friends_count - 1) if friends_count > 1 else 0] += 1
+    first = 0
+    for tox_id, count in zip(tox_ids, counts):
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, (('Message #{} lorem ipsum dolor sit amet'.format(first + j), j % 2,
+                                              start + first + j, 0) for j in range(count)))
+        first += count
+    return history, tox_ids
+
+
+def benchmark_history(directory, name, messages_count, friends_count, count=5):
+    """
+    :return: dict, key - name of operation, value - average time in milliseconds
+    """
+    s = Settings.get_instance()
+    s['save_history'] = False  # unsaved messages are kept in memory
+    start = time.perf_counter()
+    history, tox_ids = generate_history(directory, name, messages_count, friends_count)
+    results = {'generate': (time.perf_counter() - start) * 1000}
+    tox_id = tox_ids[0]
+    oldest = history.messages_getter(tox_id).get_after(0.0, 1)[0][2]
+
+    def first_page():
+        friend = Friend(history.messages_getter(tox_id), 0, 'Friend', '', None, tox_id)
+        friend.load_corr()
+    results['first_page'] = measure(first_page, count)
+
+    def deep_scrollback():
+        history.messages_getter(tox_id).get_before(oldest + PAGE_SIZE * 2)
+    results['deep_scrollback'] = measure(deep_scrollback, count)
+
+    def scroll_pages():
+        friend = Friend(history.messages_getter(tox_id), 0, 'Friend', '', None, tox_id)
+        friend.load_corr()
+        for _ in range(10):
+            friend.load_corr(False)
+    results['scroll_10_pages'] = measure(scroll_pages, count)
+
+    friend = Friend(None, 0, 'Friend', '', None, tox_ids[-1])
+    t = time.time()
+    for i in range(SAVE_COUNT):
+        friend.append_message(TextMessage('Unsaved #' + str(i), MESSAGE_OWNER['ME'], t + i, 0))
+    unsaved = friend.get_corr_for_saving()
+    start = time.perf_counter()
+    history.save_messages_to_db(tox_ids[-1], unsaved)
+    results['save_{}'.format(SAVE_COUNT)] = (time.perf_counter() - start) * 1000
+
+    times = iter(range(SAVE_COUNT))
+    results['delete'] = measure(lambda: history.delete_message(tox_ids[-1], t + next(times)), count)
+    results['search_text'] = measure(lambda: history.search('Message #{}'.format(messages_count // 3)), count)
+    results['search_regexp'] = measure(lambda: history.search('#1[0-9]*7 lorem', tox_id), count)
+
+    def export():
+        exporter = HistoryExporter(history, tox_id, 'Friend', 'Me', 'jsonl')
+        with open(directory + name + '.jsonl', 'wt', encoding='utf-8') as fl:
+            exporter.write(fl)
+    results['export'] = measure(export, 1)
+    os.remove(directory + name + '.jsonl')
+
+    # messages are passed to history writer when they are received and written in background. On exit
+    # Profile.save_history saves messages which weren't passed to writer and flushes writer
+    s['save_history'] = True
+    friend = Friend(history.messages_getter(tox_ids[-1]), 0, 'Friend', '', None, tox_ids[-1])
+    t += SAVE_COUNT
+    start = time.perf_counter()
+    for i in range(SAVE_COUNT):
+        friend.append_message(TextMessage('Queued #' + str(i), MESSAGE_OWNER['ME'], t + i, 0))
+    results['queue_{}'.format(SAVE_COUNT)] = (time.perf_counter() - start) * 1000
+    unsaved = friend.get_corr_for_saving()
+    start = time.perf_counter()
+    history.save_messages_to_db(tox_ids[-1], unsaved)
+    history.save()
+    results['save_history'] = (time.perf_counter() - start) * 1000
+    s['save_history'] = False
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Toxygen benchmarks')
+    parser.add_argument('--profiles', default='small,medium', help='comma separated list of: ' + ', '.join(PROFILES))
+    parser.add_argument('--directory', default=None, help='directory for generated profiles (reused between runs)')
+    parser.add_argument('--output', default=None, help='path to json file with results, default - stdout')
+    parser.add_argument('--no-encryption', action='store_true', help='skip encryption benchmark and encrypted profiles')
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp()
+    directory = os.path.join(os.path.abspath(directory), '')
+    Settings._instance = Settings.get_default_settings()
+    encr.ToxES()
+    results = {
+        'commit': get_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': {}
+    }
+    if not args.no_encryption:
+        results['results']['encryption'] = benchmark_encryption()
+        encr.ToxES()  # without password
+    results['results']['receive_to_buffer'] = benchmark_receive_to_buffer()
+    results['results']['chunk_reader'] = benchmark_chunk_reader(directory)
+    for name in args.profiles.split(','):
+        messages_count, friends_count = PROFILES[name]
+        results['results'][name] = benchmark_history(directory, name, messages_count, friends_count)
+        if not args.no_encryption:  # text of every message is encrypted with cached key
+            encr.ToxES().set_password(PASSWORD)
+            results['results'][name + '_encrypted'] = benchmark_history(directory, name + '_encrypted',
+                                                                        messages_count, friends_count)
+            encr.ToxES()
+    data = json.dumps(results, indent=4)
+    if args.output is None:
+        print(data)
+    else:
+        with open(args.output, 'wt') as fl:
+            fl.write(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
 from toxygen.profile import *
 from toxygen.tox_dns import tox_dns
 from toxygen.history import History
+from toxygen.history_export import HistoryExporter
+from toxygen.outbox import Outbox, split_message
+from toxygen.refresh import RefreshScheduler, CONTACTS_LIST, HEADER, MESSAGES_PAGE
+from toxygen.contacts_index import ContactsIndex
+from toxygen.transfers_io import TransfersIO
 from toxygen.smileys import SmileyLoader
 from toxygen.messages import *
-import toxygen.toxes as encr
+import toxes as encr  # the same module as in toxygen, toxygen/__init__.py adds it to path
+from toxygen.toxencryptsave import ToxEncryptSave
 import toxygen.util as util
+import database
+import threading
 import time
+import sqlite3
+import json
+import io
 
 
 class TestTox:
@@ -65,6 +76,16 @@ class TestEncryption:
             new_data = lib.pass_decrypt(new_data)
             assert copy_data == new_data
 
+    def test_cached_key(self):
+        data = b'toxygen'
+        lib = encr.ToxES()
+        lib.set_password('easypassword')
+        raw = ToxEncryptSave()
+        encrypted = raw.pass_encrypt(data, 'easypassword')
+        assert lib.pass_decrypt(encrypted) == data
+        assert raw.pass_decrypt(lib.pass_encrypt(data), 'easypassword') == data
+        assert lib.pass_decrypt(lib.pass_encrypt(data)) == data
+
 
 class TestSmileys:
 
@@ -79,6 +100,7 @@ class TestSmileys:
 def create_singletons():
     folder = util.curr_directory() + '/abc'
     Settings._instance = Settings.get_default_settings()
+    encr.ToxES._instance = None  # profile without password
     if not os.path.exists(folder):
         os.makedirs(folder)
     ProfileHelper(folder, 'test')
@@ -146,6 +168,101 @@ class TestFriend:
         result = friend.search_string('tox')
         assert result is None
 
+    def test_friend_indexes(self):
+        create_singletons()
+        friend = create_random_friend()
+        t = time.time()
+        friend.append_message(TextMessage('Sent', MESSAGE_OWNER['ME'], t, 0))
+        friend.append_message(TextMessage('First', MESSAGE_OWNER['NOT_SENT'], t + 1, 0))
+        friend.append_message(TransferMessage(MESSAGE_OWNER['FRIEND'], t + 2, TOX_FILE_TRANSFER_STATE['RUNNING'],
+                                              100, 'file_name', friend.number, 7))
+        friend.append_message(TextMessage('Second', MESSAGE_OWNER['NOT_SENT'], t + 3, 0))
+        friend.append_message(TextMessage('Reply', MESSAGE_OWNER['FRIEND'], t + 4, 0))
+        assert friend.get_last_message_text() == 'Second'
+        friend.mark_as_sent(t + 1)
+        assert list(map(lambda m: m.get_data()[0], friend.get_unsent_messages())) == ['Second']
+        assert friend.get_corr()[1].get_owner() == MESSAGE_OWNER['ME']
+        assert friend.update_transfer_data(7, TOX_FILE_TRANSFER_STATE['FINISHED'], InlineImage(b'image')) == -4
+        assert friend.get_corr()[2].get_type() == MESSAGE_TYPE['INLINE']
+        assert friend.update_transfer_data(7, TOX_FILE_TRANSFER_STATE['CANCELLED']) is None
+        friend.delete_message(t + 3)
+        assert friend.get_last_message_text() == 'First'
+        assert len(friend.get_unsent_messages()) == 0
+        assert list(map(lambda m: m[0], friend.get_corr_for_saving())) == ['Sent', 'First', 'Reply']
+        assert friend.get_corr_for_saving()[1][1] == MESSAGE_OWNER['ME']  # unsaved message is saved as sent
+        friend.delete_message(t)
+        assert len(friend.get_corr_for_saving()) == 2
+
+    def test_read_receipts(self):
+        create_singletons()
+        friend = create_random_friend()
+        t = time.time()
+        friend.append_message(TextMessage('Long message', MESSAGE_OWNER['NOT_SENT'], t, 0))
+        friend.append_message(TextMessage('Short message', MESSAGE_OWNER['NOT_SENT'], t + 1, 0))
+        friend.add_receipts(t, [1, 2])
+        friend.add_receipts(t + 1, [3])
+        assert friend.receipt(3) == t + 1
+        assert friend.receipt(1) is None
+        assert friend.receipt(3) is None
+        assert list(map(lambda m: m.get_data()[0], friend.get_unsent_messages())) == ['Long message']
+        assert friend.receipt(2) == t
+        assert not friend.get_unsent_messages()
+
+    def test_contacts_model(self):
+        create_singletons()
+        contacts = []
+        model = ContactsModel(contacts)
+        for i in range(4):
+            model.append(create_friend('Friend #' + str(3 - i), '', i, '{:064X}'.format(i)))
+        assert model.rowCount() == 4 and model.data(model.index(0)) == 'Friend #3'
+        model.move(0, 3)
+        assert list(map(lambda c: c.number, contacts)) == [1, 2, 3, 0]
+        model.move(2, 0)
+        assert list(map(lambda c: c.number, contacts)) == [3, 1, 2, 0]
+        model.sort_contacts(lambda c: c.name)
+        assert list(map(lambda c: c.number, contacts)) == [3, 2, 1, 0]
+        assert model.remove(0).number == 3 and model.rowCount() == 3
+        assert all(model.get_row(contact) == row for row, contact in enumerate(contacts))
+
+    def test_contacts_index(self):
+        create_singletons()
+        index = ContactsIndex()
+        alice, bob = create_friend('Alice', '', 0, 'AB' * 32), create_friend('Bob', '', 1, 'CD' * 32)
+        index.update(alice)
+        index.update(bob, 'Robert')
+        assert index.search('') is None
+        assert index.search('C') == {alice, bob}  # name and public key
+        assert index.search('cd') == {bob}
+        assert index.search('rob') == {bob}
+        assert index.search('abab') == {alice}
+        index.search('ali')
+        alice.name = b'Eve'
+        index.update(alice)
+        assert index.search('ali') == set()
+        index.remove(bob)
+        assert index.search('cd') == set() and index.search('e') == {alice}
+
+    def test_correspondence(self):
+        t = time.time()
+        corr = Correspondence([TextMessage('Text', MESSAGE_OWNER['NOT_SENT'], t, 0), InfoMessage('Info', t + 1)])
+        corr.extend_left([GroupChatMessage('Group', MESSAGE_OWNER['FRIEND'], t - 1, MESSAGE_TYPE['GC_TEXT'], 'Peer')])
+        inline = InlineImage(b'image')
+        corr.append(inline)
+        assert len(corr) == 4
+        assert corr[0].get_data() == ('Group', MESSAGE_OWNER['FRIEND'], t - 1, MESSAGE_TYPE['GC_TEXT'], 'Peer')
+        assert type(corr[2]) is InfoMessage and corr[2].get_owner() is None
+        assert corr[-1] is inline and corr.get_time(3) is None
+        corr.set_owner(1, MESSAGE_OWNER['ME'])
+        assert corr.get_data(1) == ('Text', MESSAGE_OWNER['ME'], t, 0)
+        corr.retain(lambda i: corr.get_type(i) != MESSAGE_TYPE['INFO_MESSAGE'])
+        assert list(map(lambda x: x.get_type(), corr)) == [MESSAGE_TYPE['GC_TEXT'], 0, MESSAGE_TYPE['INLINE']]
+        assert corr.min_time() == t - 1
+        corr.insert(1, InfoMessage('Inserted', t))
+        keys = list(map(corr.get_key, range(len(corr))))
+        assert keys == sorted(keys) and corr.find(keys[1]) == 1
+        del corr[1]
+        assert corr.find(keys[1]) is None and corr.find(keys[2]) == 1
+
 
 class TestHistory:
 
@@ -175,3 +292,517 @@ class TestHistory:
         assert len(messages) == 0
         history.delete_friend_from_db(friend.tox_id)
         assert not history.friend_exists_in_db(friend.tox_id)
+
+    def test_history_migration(self):
+        create_singletons()
+        encr.ToxES()
+        db_name = 'old_history'
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        path = ProfileHelper.get_path() + db_name + '.hstr'
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE friends(tox_id TEXT PRIMARY KEY)')
+        db.execute('INSERT INTO friends VALUES (?)', (tox_id, ))
+        db.execute('CREATE TABLE id' + tox_id + '(id INTEGER PRIMARY KEY, message TEXT, owner INTEGER, '
+                   'unix_time REAL, message_type INTEGER)')
+        db.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) VALUES (?, ?, ?, ?)',
+                       (('Message #' + str(i), MESSAGE_OWNER['ME'], float(i), 0) for i in range(10)))
+        db.commit()
+        db.close()
+        history = History(db_name)
+        assert history.friend_exists_in_db(tox_id)
+        messages = history.messages_getter(tox_id).get_all()
+        assert len(messages) == 10
+        assert messages[0][0] == 'Message #9'
+        db = sqlite3.connect(path)
+        tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        db.close()
+        assert ('id' + tox_id, ) not in tables
+        history.delete_friend_from_db(tox_id)
+
+    def test_history_pages(self):
+        create_singletons()
+        history = History('pages')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        messages = [('Message #' + str(i), MESSAGE_OWNER['ME'], float(i // 2), 0) for i in range(100)]
+        history.save_messages_to_db(tox_id, messages)
+        getter = history.messages_getter(tox_id)
+        pages = [getter.get(PAGE_SIZE) for _ in range(3)]
+        assert list(map(len, pages)) == [PAGE_SIZE, PAGE_SIZE, 100 - 2 * PAGE_SIZE]
+        loaded = pages[0] + pages[1] + pages[2]
+        assert sorted(loaded, key=lambda m: int(m[0][9:])) == messages
+        assert not getter.get(PAGE_SIZE)
+        getter = history.messages_getter(tox_id)
+        assert getter.get_before(10.0, 3) == [messages[19], messages[18], messages[17]]
+        assert getter.get(2) == [messages[16], messages[15]]
+        assert getter.get_after(48.0) == [messages[98], messages[99]]
+        history.delete_friend_from_db(tox_id)
+
+    def test_history_search(self):
+        create_singletons()
+        history = History('search')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        messages = [('Message #' + str(i), MESSAGE_OWNER['ME'], float(i), 0) for i in range(100)]
+        history.save_messages_to_db(tox_id, messages)
+        assert history.search('message #42', tox_id) == [(tox_id, 42.0, 'Message #42')]
+        assert len(history.search('#4[0-9]', tox_id)) == 10
+        assert history.search('Message', tox_id, 10.0, 2) == [(tox_id, 9.0, 'Message #9'), (tox_id, 8.0, 'Message #8')]
+        getter = history.messages_getter(tox_id)
+        getter.get(PAGE_SIZE)
+        key = getter.search('#1')
+        assert key[0] == 19.0 and getter.search('#1', key)[0] == 18.0
+        assert getter.search('#1', key, False) is None  # newer messages are loaded
+        page, index = getter.get_page(key, 10)
+        assert len(page) == 10 and page[index] == messages[19] and page[0] == messages[14]
+        friend = Friend(history.messages_getter(tox_id), 0, 'Friend', '', None, tox_id)
+        friend.load_corr()
+        assert [friend.search_string('4')] + [friend.search_prev() for _ in range(3)] == [-6, -16, -26, -36]
+        index = friend.search_prev()  # the newest not loaded message, only its page is loaded
+        assert friend.get_search_page()[index].get_data()[0] == 'Message #54' and friend.get_corr_count() == PAGE_SIZE
+        assert friend.search_next() == -36 and friend.get_search_page() is None
+        history.delete_message(tox_id, 42.0)
+        assert not history.search('message #42', tox_id)
+        history.delete_friend_from_db(tox_id)
+
+    def test_history_writer(self):
+        create_singletons()
+        Settings.get_instance()['save_history'] = True
+        history = History('writer')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        friend = Friend(history.messages_getter(tox_id), 0, 'Friend', 'I am friend!', None, tox_id)
+        for i in range(10):
+            friend.append_message(TextMessage('Message #' + str(i), MESSAGE_OWNER['NOT_SENT'], float(i), 0))
+        friend.mark_as_sent(0.0)
+        assert not friend.get_corr_for_saving()
+        history.save_messages_to_db(tox_id, [])  # waits for writer
+        messages = history.messages_getter(tox_id).get_all()
+        assert len(messages) == 10
+        assert messages[-1] == ('Message #0', MESSAGE_OWNER['ME'], 0.0, 0)
+        assert messages[0][1] == MESSAGE_OWNER['NOT_SENT']
+        history.delete_friend_from_db(tox_id)
+
+    def test_history_encryption(self):
+        create_singletons()
+        encr.ToxES().set_password('test_password')
+        history = History('encrypted')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, [('Secret message', MESSAGE_OWNER['ME'], 1.0, 0)])
+        db = sqlite3.connect(ProfileHelper.get_path() + 'encrypted.hstr')
+        assert db.execute('SELECT typeof(message) FROM messages').fetchall() == [('blob', )]
+        assert history.messages_getter(tox_id).get_all() == [('Secret message', MESSAGE_OWNER['ME'], 1.0, 0)]
+        assert history.search('secret', tox_id) == [(tox_id, 1.0, 'Secret message')]
+        encr.ToxES.get_instance().set_password('')
+        history.change_password()
+        assert db.execute('SELECT typeof(message) FROM messages').fetchall() == [('text', )]
+        db.close()
+        history.delete_friend_from_db(tox_id)
+
+    def test_history_locking(self):
+        create_singletons()
+        encr.ToxES().set_password('test_password')
+        history = History('locked')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, [('Secret message', MESSAGE_OWNER['ME'], 1.0, 0)])
+        history.save()
+        encr.ToxES.get_instance().set_password('another_password')
+        history = History('locked')  # history of another password is kept, but not read
+        assert history.is_locked() and not history.messages_getter(tox_id).get_all()
+        db = sqlite3.connect(ProfileHelper.get_path() + 'locked.hstr')
+        assert db.execute('SELECT count(*) FROM messages').fetchone()[0] == 1
+        db.close()
+        encr.ToxES.get_instance().set_password('test_password')
+        history.change_password()
+        assert not history.is_locked()
+        assert history.messages_getter(tox_id).get_all() == [('Secret message', MESSAGE_OWNER['ME'], 1.0, 0)]
+        history.delete_friend_from_db(tox_id)
+        history.save()
+        encr.ToxES().set_password('')
+
+    def test_history_unavailable(self):
+        create_singletons()
+        path = ProfileHelper.get_path() + 'unavailable.hstr'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        db = sqlite3.connect(path, isolation_level=None)
+        db.execute('PRAGMA journal_mode = WAL;')
+        db.execute('BEGIN EXCLUSIVE;')  # another process writes to db, so it can't be upgraded
+        timeout, database.TIMEOUT = database.TIMEOUT, 0.1
+        try:
+            history = History('unavailable')
+        finally:
+            database.TIMEOUT = timeout
+            db.rollback()
+            db.close()
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        assert history.is_locked() and not history.friend_exists_in_db(tox_id)
+        assert not history.messages_getter(tox_id).get_all()
+        history.change_password()
+        history.save()
+
+    def test_history_export(self):
+        create_singletons()
+        history = History('export')
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        history.save_messages_to_db(tox_id, (('Message #' + str(i), i % 2, float(i), 0) for i in range(2500)))
+        exporter = HistoryExporter(history, tox_id, 'Friend', 'Me', 'jsonl', 100.0, 2200.0,
+                                   [('Unsaved', MESSAGE_OWNER['ME'], 2100.5, 0)])
+        assert exporter.count() == 2101
+        progress = []
+        fl = io.StringIO()
+        assert exporter.write(fl, progress.append) == 2101
+        assert progress == [1000, 2000, 2100, 2101]
+        lines = fl.getvalue().splitlines()
+        assert json.loads(lines[0]) == {'time': 100.0, 'author': 'Me', 'owner': 0, 'type': 0, 'message': 'Message #100'}
+        assert json.loads(lines[-1])['message'] == 'Unsaved'
+        exporter = HistoryExporter(history, tox_id, 'Friend', 'Me', 'txt', 0.0, 2.0)
+        fl = io.StringIO()
+        exporter.write(fl)
+        expected = '[{}] Me: Message #0\n\n[{}] Friend: Message #1\n'
+        assert fl.getvalue() == expected.format(util.convert_time(0.0), util.convert_time(1.0))
+        history.delete_friend_from_db(tox_id)
+        exporter = HistoryExporter(None, tox_id, 'Friend', 'Me', unsaved=[('Selected', MESSAGE_OWNER['ME'], 0.0, 0)])
+        fl = io.StringIO()
+        assert exporter.count() == exporter.write(fl) == 1  # selected messages of loaded correspondence
+        assert fl.getvalue() == '[{}] Me: Selected\n'.format(util.convert_time(0.0))
+
+    def test_history_compaction(self):
+        create_singletons()
+        s = Settings.get_instance()
+        path = ProfileHelper.get_path() + 'compaction.hstr'
+        if os.path.exists(path):
+            os.remove(path)
+        history = History('compaction')
+        history.compact()  # no retention policies
+        assert history.get_compaction_report() == {}
+        db = sqlite3.connect(path)
+        assert db.execute('PRAGMA auto_vacuum;').fetchone()[0] == 2  # new db is created with incremental vacuum
+        db.close()
+        s['history_max_age'], s['history_max_messages'] = 1, 30
+        tox_id = '76518406F6A9F2217E8DC487CC783C25CC16A15EB36FF32E335A235342C48A39218F515C39A6'
+        history.delete_friend_from_db(tox_id)
+        history.add_friend_to_db(tox_id)
+        t = time.time()
+        messages = [('Old #' + str(i), MESSAGE_OWNER['ME'], t - 2 * 24 * 60 * 60 + i, 0) for i in range(10)]
+        messages.append(('Unsent', MESSAGE_OWNER['NOT_SENT'], t - 2 * 24 * 60 * 60 + 10, 0))
+        messages.extend(('New #' + str(i), MESSAGE_OWNER['FRIEND'], t + i, 0) for i in range(40))
+        history.save_messages_to_db(tox_id, messages)
+        history.compact()
+        assert history.get_compaction_report() == {tox_id: (20, 20 * len('New #0'))}
+        messages = history.messages_getter(tox_id).get_all()
+        assert len(messages) == 31
+        assert messages[-1][0] == 'Unsent'
+        assert messages[-2][0] == 'New #10'
+        history.delete_friend_from_db(tox_id)
+
+
+class TestOutbox:
+
+    def test_split_message(self):
+        message = ('word ' * 1000 + 'x' * 3000 + '.' * 10).encode('utf-8')
+        parts = list(split_message(message))
+        assert b''.join(parts) == message
+        assert all(map(lambda part: len(part) <= TOX_MAX_MESSAGE_LENGTH, parts))
+        assert parts[0].endswith(b' ')
+        assert list(split_message(b'short')) == [b'short']
+
+    def test_outbox_session(self):
+        create_singletons()
+        friend = create_random_friend()
+
+        class Tox:
+            sent = []
+
+            def friend_send_message(self, number, message_type, message):
+                self.sent.append(message)
+                return len(self.sent) - 1
+
+        class Profile:
+            def get_friend_by_number(self, number):
+                return friend
+
+        t = time.time()
+        friend.append_message(TextMessage('First', MESSAGE_OWNER['NOT_SENT'], t, 0))
+        friend.append_message(TextMessage('Second ' * 500, MESSAGE_OWNER['NOT_SENT'], t + 1, 0))
+        tox = Tox()
+        outbox = Outbox(tox, Profile())
+        outbox.friend_online(friend.number)
+        outbox.friend_online(friend.number)  # the same session, nothing is resent
+        assert tox.sent[0] == b'First' and len(tox.sent) == 4
+        assert outbox.get_pending_count(friend.number) == 0
+        for message_id in range(4):
+            friend.receipt(message_id)
+            outbox.receipt(friend.number)
+        assert not friend.get_unsent_messages()
+        friend.append_message(TextMessage('Third', MESSAGE_OWNER['NOT_SENT'], t + 2, 0))
+        outbox.friend_offline(friend.number)
+        outbox.add_message(friend.number, t + 2, 0, 'Third')
+        assert len(tox.sent) == 4
+        outbox.friend_online(friend.number)
+        assert tox.sent[-1] == b'Third'
+
+    def test_outbox_send_error(self):
+        create_singletons()
+        friend = create_random_friend()
+
+        class Tox:
+            sent = []
+
+            def friend_send_message(self, number, message_type, message):
+                if message == b'Second':
+                    raise ValueError('friend is not connected')
+                self.sent.append(message)
+                return len(self.sent) - 1
+
+        class Profile:
+            def get_friend_by_number(self, number):
+                return friend
+
+        t = time.time()
+        for i, text in enumerate(('First', 'Second', 'Third')):
+            friend.append_message(TextMessage(text, MESSAGE_OWNER['NOT_SENT'], t + i, 0))
+        tox = Tox()
+        outbox = Outbox(tox, Profile())
+        outbox.friend_online(friend.number)
+        assert tox.sent == [b'First', b'Third']  # items after failed one are sent
+        assert outbox.get_pending_count(friend.number) == 0
+        for message_id in range(2):
+            friend.receipt(message_id)
+        assert list(map(lambda m: m.get_data()[0], friend.get_unsent_messages())) == ['Second']
+
+
+class TestRefreshScheduler:
+
+    def test_coalescing(self):
+        refreshes = []
+        scheduler = RefreshScheduler(lambda regions, contacts: refreshes.append((regions, contacts)))
+        for contact in ('first', 'second', 'first'):
+            scheduler.schedule(CONTACTS_LIST, contact)
+        for _ in range(10):
+            scheduler.schedule(MESSAGES_PAGE)
+            scheduler.schedule(HEADER)
+        assert scheduler.is_dirty(HEADER)
+        scheduler.flush()
+        scheduler.flush()  # nothing is dirty
+        assert refreshes == [(CONTACTS_LIST | MESSAGES_PAGE, {'first', 'second'})]
+        scheduler.schedule(HEADER)
+        scheduler.cancel(HEADER)
+        scheduler.flush()
+        assert len(refreshes) == 1
+        stats = scheduler.get_stats()
+        assert stats['contacts_list'] == (3, 1, 2)
+        assert stats['messages_page'] == (10, 1, 9)
+        assert stats['header'] == (11, 0, 11)
+
+
+class TestSettings:
+
+    def test_settings_saving(self):
+        create_singletons()
+        path = ProfileHelper.get_path() + 'saving.json'
+        if os.path.exists(path):
+            os.remove(path)
+        settings = Settings('saving')
+        settings.flush()
+        settings['sorting'] = 2
+        settings.save()
+        settings['sorting'] = 4
+        settings.save()  # changes are written once
+        with open(path) as fl:
+            assert json.loads(fl.read())['sorting'] == 0
+        settings.flush()
+        with open(path) as fl:
+            assert json.loads(fl.read())['sorting'] == 4
+        os.remove(path)
+        settings.save()
+        settings.flush()
+        assert not os.path.exists(path)  # nothing was changed
+        settings['plugins'] = settings['plugins'] + ['ABCD']
+        settings.save()
+        settings.close()
+        with open(path) as fl:
+            assert json.loads(fl.read())['plugins'] == ['ABCD']
+        create_singletons()
+
+    def test_contacts_data(self):
+        create_singletons()
+        key, other_key = 'AB' * 32, 'CD' * 32
+        with open(ProfileHelper.get_path() + 'contacts.json', 'w') as fl:  # settings of old version
+            fl.write(json.dumps({'friends_aliases': [[key, 'Alias']], 'notes': {key: 'Note'},
+                                 'auto_accept_from_friends': [key], 'blocked': [other_key]}))
+        settings = Settings('contacts')
+        assert 'blocked' not in settings and 'friends_aliases' not in settings
+        assert settings.get_contact_value(key + '0' * 12, 'alias') == 'Alias'
+        assert settings.get_contact_value(key, 'note') == 'Note' and settings.get_contact_value(key, 'auto_accept')
+        assert settings.get_contacts_with('blocked') == [other_key]
+        settings.set_contact_value(other_key, 'blocked', False)
+        assert other_key not in settings['contacts']
+        settings.remove_contact_values(key, 'alias', 'note')
+        assert settings['contacts'] == {key: {'auto_accept': True}}
+        settings.close()
+        create_singletons()
+
+
+class TestFileTransfers:
+
+    def test_interval_set(self):
+        ranges = IntervalSet()
+        assert ranges.add(10, 20) == 10 and ranges.add(0, 5) == 5
+        assert ranges.add(3, 12) == 5 and ranges.get_ranges() == [(0, 20)]
+        assert ranges.add(30, 40) == 10 and ranges.add(35, 40) == 0
+        assert not ranges.covers(15, 35) and ranges.covers(32, 40)
+        assert ranges.get_size() == 30
+
+    def test_receive_to_buffer(self):
+        data = bytes(range(256)) * 20
+        transfer = ReceiveToBuffer(None, 0, len(data), 0)
+        chunks = [(i, data[i:i + 1000]) for i in range(0, len(data), 1000)]
+        for position, chunk in chunks[:0:-1] + chunks[-1:]:  # out of order, the last chunk is received twice
+            transfer.write_chunk(position, chunk)
+        assert not transfer.is_complete()
+        transfer.write_chunk(0, chunks[0][1])
+        assert transfer.is_complete()
+        transfer.write_chunk(len(data), None)
+        assert transfer.get_data() == data and transfer.state == TOX_FILE_TRANSFER_STATE['FINISHED']
+        transfer = ReceiveToBuffer(None, 0, len(data), 0)
+        transfer.write_chunk(1000, chunks[1][1])
+        transfer.write_chunk(len(data), None)
+        assert transfer.state == TOX_FILE_TRANSFER_STATE['CANCELLED']  # broken image isn't shown
+
+    def test_receive_transfer_resume(self):
+        class Tox:
+            def file_get_file_id(self, friend_number, file_number):
+                return 'file_id'
+
+        data = bytes(range(256)) * 20
+        path = ProfileHelper.get_path() + 'received.bin'
+        transfer = ReceiveTransfer(path, Tox(), 0, len(data), 0)
+        assert os.path.getsize(path) == len(data)  # preallocated
+        transfer.write_chunk(0, data[:1000])
+        transfer.write_chunk(2000, data[2000:3000])
+        transfer.checkpoint()
+        transfer._file.close()  # crash
+        assert transfer.total_size() == 1000 and resume_position(path, 0) == 1000
+        transfer = ReceiveTransfer(path, Tox(), 0, len(data), 0, 1000)
+        for i in range(1000, len(data), 1000):
+            transfer.write_chunk(i, data[i:i + 1000])
+        transfer.write_chunk(len(data), None)
+        assert transfer._done == len(data) and not os.path.exists(path + JOURNAL_EXTENSION)
+        with open(path, 'rb') as fl:
+            assert fl.read() == data
+        os.remove(path)
+
+    def test_receive_transfer_huge_size(self):
+        class Tox:
+            def file_get_file_id(self, friend_number, file_number):
+                return 'file_id'
+
+        path = ProfileHelper.get_path() + 'huge.bin'
+        transfer = ReceiveTransfer(path, Tox(), 0, 2 ** 64 - 1, 0)  # size is sent by friend
+        assert os.path.getsize(path) == 0  # not preallocated
+        transfer.write_chunk(0, bytes(1000))
+        transfer._file.close()
+        assert os.path.getsize(path) == 1000
+        os.remove(path)
+
+    def test_receive_transfer_cancelled(self):
+        create_singletons()
+
+        class Tox:
+            def file_get_file_id(self, friend_number, file_number):
+                return 'file_id'
+
+        data = bytes(range(256)) * 20
+        path = ProfileHelper.get_path() + 'cancelled.bin'
+        transfers_io = TransfersIO(1, 4)
+        transfers_io.start()
+        transfer = ReceiveTransfer(path, Tox(), 0, len(data), 0)
+        for i in range(0, 3000, 1000):
+            transfers_io.execute((0, 0), transfer.write_chunk, i, data[i:i + 1000])
+        transfer.cancelled()  # journal is saved after queued chunks are written
+        transfers_io.execute((0, 0), transfer.write_chunk, 3000, data[3000:4000])
+        transfers_io.stop()
+        assert transfer._file.closed and resume_position(path, 0) == 3000
+        os.remove(path)
+        os.remove(path + JOURNAL_EXTENSION)
+
+    def test_progress_rate(self):
+        data = bytes(100000)
+        transfer = ReceiveToBuffer(None, 0, len(data), 0)
+        signals = []
+        transfer.set_state_changed_handler(lambda *args: signals.append(args))
+        for i in range(0, 50000, 1000):
+            transfer.write_chunk(i, data[i:i + 1000])
+        assert len(signals) == 1 and signals[0][2] == -1  # other chunks were in progress interval, speed is unknown
+        transfer._sample_time -= 1  # the last 49000 bytes were received in 1 second
+        transfer._signal_time -= 1
+        transfer.write_chunk(50000, data[50000:51000])
+        assert len(signals) == 2 and 49000 < signals[1][3] <= 50000 and signals[1][2] == 0
+        assert transfer.get_speed() == signals[1][3]
+        transfer.write_chunk(51000, data[51000:])
+        transfer.write_chunk(len(data), None)  # state changes are emitted immediately
+        assert len(signals) == 3 and signals[2][0] == TOX_FILE_TRANSFER_STATE['FINISHED']
+
+    def test_chunk_reader(self):
+        data = bytes(range(256)) * 40
+        positions = list(range(0, len(data), 1000)) + [500, 9900, 7000]  # sequential reads, then seeks
+        for executor in (None, lambda function, *args: function(*args)):  # without and with read-ahead
+            reader = ChunkReader(io.BytesIO(data), 4000, executor)
+            for position in positions:
+                chunk = reader.read(position, 1000)
+                assert chunk.tobytes() == data[position:position + 1000]
+                assert (c_char * len(chunk)).from_buffer(chunk).raw == data[position:position + 1000]  # no copy
+
+
+class TestTransfersIO:
+
+    def test_transfers_io(self):
+        transfers_io = TransfersIO(2, 2)
+        transfers_io.start()
+        written = {1: [], 2: []}
+
+        def write(key, i):
+            time.sleep(0.001)
+            written[key].append(i)
+
+        for i in range(10):
+            for key in written:
+                transfers_io.execute(key, write, key, i)
+        transfers_io.stop()
+        assert written == {1: list(range(10)), 2: list(range(10))}  # order of tasks of transfer is kept
+        stats = transfers_io.get_stats()
+        assert stats['tasks'] == 20 and stats['depth'] == 0
+
+    def test_full_queue(self):
+        transfers_io = TransfersIO(1, 2)
+        transfers_io.start()
+        disk, blocked = threading.Event(), threading.Event()  # slow disk
+
+        def write():
+            blocked.set()
+            disk.wait()
+
+        transfers_io.execute(1, write)
+        blocked.wait()
+        start = time.perf_counter()
+        for i in range(10):
+            transfers_io.execute(1, lambda: None)
+        assert time.perf_counter() - start < 0.5  # tox thread isn't blocked by full queue
+        stats = transfers_io.get_stats()
+        assert stats['depth'] == 11 and stats['max_depth'] == 10 and stats['overflows'] == 1
+        disk.set()
+        transfers_io.stop()
+        assert transfers_io.get_stats()['tasks'] == 11
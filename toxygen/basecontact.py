@@ -15,7 +15,7 @@ class BaseContact:
         """
         :param name: name, example: 'Toxygen user'
         :param status_message: status message, example: 'Toxing on Toxygen'
-        :param widget: ContactItem instance
+        :param widget: widget with name, status message, connection status and avatar labels
         :param tox_id: tox id of contact
         """
         self._name, self._status_message = name, status_message
@@ -77,16 +77,22 @@ class BaseContact:
     # Avatars
     # -----------------------------------------------------------------------------------------------------------------
 
-    def load_avatar(self):
+    def get_avatar_path(self):
         """
-        Tries to load avatar of contact or uses default avatar
+        :return: path to avatar of contact or to default avatar
         """
         prefix = ProfileHelper.get_path() + 'avatars/'
         avatar_path = prefix + '{}.png'.format(self._tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
         if not os.path.isfile(avatar_path) or not os.path.getsize(avatar_path):  # load default image
             avatar_path = curr_directory() + '/images/avatar.png'
+        return avatar_path
+
+    def load_avatar(self):
+        """
+        Tries to load avatar of contact or uses default avatar
+        """
         width = self._widget.avatar_label.width()
-        pixmap = QtGui.QPixmap(avatar_path)
+        pixmap = QtGui.QPixmap(self.get_avatar_path())
         self._widget.avatar_label.setPixmap(pixmap.scaled(width, width, QtCore.Qt.KeepAspectRatio,
                                                           QtCore.Qt.SmoothTransformation))
         self._widget.avatar_label.repaint()
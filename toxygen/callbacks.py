@@ -5,9 +5,9 @@ from profile import Profile
 from toxcore_enums_and_consts import *
 from toxav_enums import *
 from tox import bin_to_string
+from ctypes import string_at
 from plugin_support import PluginLoader
-import queue
-import threading
+from transfers_io import TransfersIO
 import util
 import cv2
 import numpy as np
@@ -40,42 +40,15 @@ def invoke_in_main_thread(fn, *args, **kwargs):
     QtCore.QCoreApplication.postEvent(_invoker, InvokeEvent(fn, *args, **kwargs))
 
 
-class FileTransfersThread(threading.Thread):
-
-    def __init__(self):
-        self._queue = queue.Queue()
-        self._timeout = 0.01
-        self._continue = True
-        super().__init__()
-
-    def execute(self, function, *args, **kwargs):
-        self._queue.put((function, args, kwargs))
-
-    def stop(self):
-        self._continue = False
-
-    def run(self):
-        while self._continue:
-            try:
-                function, args, kwargs = self._queue.get(timeout=self._timeout)
-                function(*args, **kwargs)
-            except queue.Empty:
-                pass
-            except queue.Full:
-                util.log('Queue is Full in _thread')
-            except Exception as ex:
-                util.log('Exception in _thread: ' + str(ex))
-
-_thread = FileTransfersThread()
+_io = TransfersIO()
 
 
 def start():
-    _thread.start()
+    _io.start()
 
 
 def stop():
-    _thread.stop()
-    _thread.join()
+    _io.stop()
 
 # -----------------------------------------------------------------------------------------------------------------
 # Callbacks - current user
@@ -112,8 +85,7 @@ def friend_status(tox, friend_num, new_status, user_data):
     if friend.status is None and Settings.get_instance()['sound_notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
         sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
     invoke_in_main_thread(friend.set_status, new_status)
-    invoke_in_main_thread(QtCore.QTimer.singleShot, 5000, lambda: profile.send_files(friend_num))
-    invoke_in_main_thread(profile.update_filtration)
+    invoke_in_main_thread(profile.update_filtration, friend)
 
 
 def friend_connection_status(tox, friend_num, new_status, user_data):
@@ -125,12 +97,14 @@ def friend_connection_status(tox, friend_num, new_status, user_data):
     friend = profile.get_friend_by_number(friend_num)
     if new_status == TOX_CONNECTION['NONE']:
         invoke_in_main_thread(profile.friend_exit, friend_num)
-        invoke_in_main_thread(profile.update_filtration)
+        invoke_in_main_thread(profile.update_filtration, friend)
         if Settings.get_instance()['sound_notifications'] and profile.status != TOX_USER_STATUS['BUSY']:
             sound_notification(SOUND_NOTIFICATION['FRIEND_CONNECTION_STATUS'])
-    elif friend.status is None:
-        invoke_in_main_thread(profile.send_avatar, friend_num)
-        invoke_in_main_thread(PluginLoader.get_instance().friend_online, friend_num)
+    else:
+        invoke_in_main_thread(profile.friend_online, friend_num)  # does nothing if friend was already online
+        if friend.status is None:
+            invoke_in_main_thread(profile.send_avatar, friend_num)
+            invoke_in_main_thread(PluginLoader.get_instance().friend_online, friend_num)
 
 
 def friend_name(tox, friend_num, name, size, user_data):
@@ -151,7 +125,6 @@ def friend_status_message(tox, friend_num, status_message, size, user_data):
     friend = profile.get_friend_by_number(friend_num)
     invoke_in_main_thread(friend.set_status_message, status_message)
     print('User #{} has new status'.format(friend_num))
-    invoke_in_main_thread(profile.send_messages, friend_num)
     if profile.get_active_number() == friend_num:
         invoke_in_main_thread(profile.set_active)
 
@@ -183,7 +156,7 @@ def friend_request(tox, public_key, message, message_size, user_data):
     profile = Profile.get_instance()
     key = ''.join(chr(x) for x in public_key[:TOX_PUBLIC_KEY_SIZE])
     tox_id = bin_to_string(key, TOX_PUBLIC_KEY_SIZE)
-    if tox_id not in Settings.get_instance()['blocked']:
+    if not Settings.get_instance().get_contact_value(tox_id, 'blocked'):
         invoke_in_main_thread(profile.process_friend_request, tox_id, str(message, 'utf-8'))
 
 
@@ -192,10 +165,7 @@ def friend_typing(tox, friend_number, typing, user_data):
 
 
 def friend_read_receipt(tox, friend_number, message_id, user_data):
-    profile = Profile.get_instance()
-    profile.get_friend_by_number(friend_number).dec_receipt()
-    if friend_number == profile.get_active_number():
-        invoke_in_main_thread(profile.receipt)
+    invoke_in_main_thread(Profile.get_instance().receipt, friend_number, message_id)
 
 # -----------------------------------------------------------------------------------------------------------------
 # Callbacks - file transfers
@@ -239,15 +209,15 @@ def tox_file_recv(window, tray):
 
 def file_recv_chunk(tox, friend_number, file_number, position, chunk, length, user_data):
     """
-    Incoming chunk
+    Incoming chunk. It's written to disk by worker thread
     """
-    _thread.execute(Profile.get_instance().incoming_chunk, friend_number, file_number, position,
-                    chunk[:length] if length else None)
+    _io.execute((friend_number, file_number), Profile.get_instance().incoming_chunk, friend_number, file_number,
+                position, string_at(chunk, length) if length else None)
 
 
 def file_chunk_request(tox, friend_number, file_number, position, size, user_data):
     """
-    Outgoing chunk
+    Outgoing chunk. Data is read ahead by worker thread
     """
     Profile.get_instance().outgoing_chunk(friend_number, file_number, position, size)
 
@@ -1,10 +1,13 @@
 from PyQt5 import QtCore, QtGui
 from history import *
+from settings import Settings
 import basecontact
 import util
 from messages import *
 import file_transfers as ft
 import re
+import itertools
+from collections import deque
 
 
 class Contact(basecontact.BaseContact):
@@ -13,26 +16,30 @@ class Contact(basecontact.BaseContact):
     Properties: number, message getter, history etc. Base class for friend and gc classes
     """
 
-    def __init__(self, message_getter, number, name, status_message, widget, tox_id):
+    def __init__(self, message_getter, number, name, status_message, model, tox_id):
         """
         :param message_getter: gets messages from db
         :param number: number of friend.
+        :param model: ContactsModel of friends list or None
         """
-        super().__init__(name, status_message, widget, tox_id)
+        self._model, self._avatar = model, None
+        super().__init__(name, status_message, None, tox_id)
         self._number = number
         self._new_messages = False
         self._visible = True
         self._alias = False
         self._message_getter = message_getter
-        self._corr = []
+        self._corr = Correspondence()
         self._unsaved_messages = 0
+        self._reset_indexes()
         self._history_loaded = self._new_actions = False
         self._curr_text = self._search_string = ''
         self._search_index = 0
+        self._search_key = self._search_page = None  # (unix_time, id) of found not loaded message and page with it
 
     def __del__(self):
         self.set_visibility(False)
-        del self._widget
+        del self._model
         if hasattr(self, '_message_getter'):
             del self._message_getter
 
@@ -48,13 +55,19 @@ class Contact(basecontact.BaseContact):
             return
         if self._message_getter is None:
             return
-        data = list(self._message_getter.get(PAGE_SIZE))
+        if first_time:  # messages received before friend became active are newer than history
+            min_time = self._corr.min_time()
+            if min_time is not None:
+                data = self._message_getter.get_before(min_time, PAGE_SIZE)
+            else:
+                data = self._message_getter.get(PAGE_SIZE)
+        else:
+            data = self._message_getter.get(PAGE_SIZE)
         if data is not None and len(data):
             data.reverse()
         else:
             return
-        data = list(map(lambda tupl: TextMessage(*tupl), data))
-        self._corr = data + self._corr
+        self._extend_left(data)
         self._history_loaded = True
 
     def load_all_corr(self):
@@ -66,35 +79,107 @@ class Contact(basecontact.BaseContact):
         data = list(self._message_getter.get_all())
         if data is not None and len(data):
             data.reverse()
-            data = list(map(lambda tupl: TextMessage(*tupl), data))
-            self._corr = data + self._corr
+            self._extend_left(data)
             self._history_loaded = True
 
+    def _extend_left(self, data):
+        """
+        Adds messages loaded from db to the beginning of correspondence
+        """
+        self._corr.extend_left(map(lambda tupl: TextMessage(*tupl), data))
+        self._index_messages(0, len(data), True)
+
     def get_corr_for_saving(self):
         """
         Get data to save in db
         :return: list of unsaved messages or []
         """
-        messages = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        return list(map(lambda x: x.get_data(), messages[-self._unsaved_messages:])) if self._unsaved_messages else []
+        if self._unsaved is None:
+            return []
+        indexes = range(self._corr.find(self._unsaved), len(self._corr))
+        return list(map(self._corr.get_data, filter(lambda i: self._corr.get_type(i) <= 1, indexes)))
+
+    def get_corr(self, start=None, end=None):
+        """
+        :return: list of messages with indexes in [start, end)
+        """
+        return self._corr[start:end]
 
-    def get_corr(self):
-        return self._corr[:]
+    def get_corr_count(self):
+        return len(self._corr)
 
     def append_message(self, message):
         """
         :param message: text or file transfer message
         """
         self._corr.append(message)
+        self._index_messages(len(self._corr) - 1, len(self._corr))
         if message.get_type() <= 1:
-            self._unsaved_messages += 1
+            # messages are saved in order: after the first unsaved one the rest wait for saving of profile
+            if self._unsaved_messages or not self._save_message(message):
+                if not self._unsaved_messages:
+                    self._unsaved = self._corr.get_key(-1)
+                self._unsaved_messages += 1
+
+    def _save_message(self, message):
+        """
+        Passes message to history writer
+        :return: True if message will be saved
+        """
+        getter = getattr(self, '_message_getter', None)
+        return getter is not None and getter.add_message(message.get_data())
 
     def get_last_message_text(self):
-        messages = list(filter(lambda x: x.get_type() <= 1 and x.get_owner() != MESSAGE_OWNER['FRIEND'], self._corr))
-        if messages:
-            return messages[-1].get_data()[0]
-        else:
+        if self._last_own is None:
             return ''
+        return self._corr.get_text(self._corr.find(self._last_own))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Indexes of correspondence
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _reset_indexes(self):
+        self._unsent = deque()  # keys of unsent messages, the oldest first
+        self._last_own = None  # key of the newest text message which is not from contact
+        self._unsaved = None  # key of the oldest unsaved text message
+        self._time_keys = {}  # time of text message - key of message
+
+    def _index_messages(self, start, end, prepended=False):
+        """
+        Adds messages with indexes in [start, end) to indexes. Messages must be the newest or the oldest
+        (prepended=True) in correspondence
+        """
+        unsent, last_own = [], None
+        for i in range(start, end):
+            key, message_type, owner = self._corr.get_key(i), self._corr.get_type(i), self._corr.get_owner(i)
+            if owner == MESSAGE_OWNER['NOT_SENT']:
+                unsent.append(key)
+            if message_type in TEXT_TYPES:
+                if prepended or self._corr.get_time(i) not in self._time_keys:
+                    self._time_keys[self._corr.get_time(i)] = key
+                if message_type <= 1 and owner != MESSAGE_OWNER['FRIEND']:
+                    last_own = key
+        if prepended:
+            self._unsent.extendleft(reversed(unsent))
+            if self._last_own is None:
+                self._last_own = last_own
+        else:
+            self._unsent.extend(unsent)
+            if last_own is not None:
+                self._last_own = last_own
+
+    def _retain(self, predicate):
+        """
+        Deletes messages for which predicate(index of message) is false and rebuilds indexes
+        """
+        self._corr.retain(predicate)
+        self._reset_indexes()
+        self._index_messages(0, len(self._corr))
+        text_messages = filter(lambda i: self._corr.get_type(i) <= 1, range(len(self._corr) - 1, -1, -1))
+        unsaved = list(itertools.islice(text_messages, self._unsaved_messages))
+        self._unsaved_messages = len(unsaved)
+        if unsaved:
+            self._unsaved = self._corr.get_key(unsaved[-1])
 
     # -----------------------------------------------------------------------------------------------------------------
     # Unsent messages
@@ -104,20 +189,31 @@ class Contact(basecontact.BaseContact):
         """
         :return list of unsent messages
         """
-        messages = filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(messages)
+        return list(map(self._corr.__getitem__, self._get_unsent_indexes()))
 
     def get_unsent_messages_for_saving(self):
         """
         :return list of unsent messages for saving
         """
-        messages = filter(lambda x: x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr)
-        return list(map(lambda x: x.get_data(), messages))
+        indexes = filter(lambda i: self._corr.get_type(i) <= 1, self._get_unsent_indexes())
+        return list(map(self._corr.get_data, indexes))
+
+    def _get_unsent_indexes(self):
+        return map(self._corr.find, self._unsent)
 
-    def mark_as_sent(self):
+    def mark_as_sent(self, time):
+        """
+        :param time: time of unsent message
+        """
         try:
-            message = list(filter(lambda x: x.get_owner() == MESSAGE_OWNER['NOT_SENT'], self._corr))[0]
-            message.mark_as_sent()
+            key = self._time_keys[time]
+            i = self._corr.find(key)
+            if self._corr.get_owner(i) != MESSAGE_OWNER['NOT_SENT']:
+                return
+            self._unsent.remove(key)
+            self._corr.set_owner(i, MESSAGE_OWNER['ME'])
+            if getattr(self, '_message_getter', None) is not None:
+                self._message_getter.message_sent(time)
         except Exception as ex:
             util.log('Mark as sent ex: ' + str(ex))
 
@@ -126,27 +222,38 @@ class Contact(basecontact.BaseContact):
     # -----------------------------------------------------------------------------------------------------------------
 
     def delete_message(self, time):
-        elem = list(filter(lambda x: type(x) in (TextMessage, GroupChatMessage) and x.get_data()[2] == time, self._corr))[0]
-        tmp = list(filter(lambda x: x.get_type() <= 1, self._corr))
-        if elem in tmp[-self._unsaved_messages:] and self._unsaved_messages:
+        key = self._time_keys.pop(time)
+        i = self._corr.find(key)
+        if key in self._unsent:
+            self._unsent.remove(key)
+        if self._unsaved is not None and key >= self._unsaved and self._corr.get_type(i) <= 1:
             self._unsaved_messages -= 1
-        self._corr.remove(elem)
-        self._message_getter.delete_one()
+            if key == self._unsaved:
+                newer = filter(lambda j: self._corr.get_type(j) <= 1, range(i + 1, len(self._corr)))
+                self._unsaved = self._corr.get_key(next(newer)) if self._unsaved_messages else None
+        del self._corr[i]
+        if key == self._last_own:
+            older = filter(lambda j: self._corr.get_type(j) <= 1 and
+                           self._corr.get_owner(j) != MESSAGE_OWNER['FRIEND'], range(i - 1, -1, -1))
+            self._last_own = next(map(self._corr.get_key, older), None)
         self._search_index = 0
 
     def delete_old_messages(self):
         """
         Delete old messages (reduces RAM usage if messages saving is not enabled)
         """
-        def save_message(x):
-            if x.get_type() == 2 and (x.get_status() >= 2 or x.get_status() is None):
+        first = len(self._corr) - SAVE_MESSAGES
+
+        def save_message(i):
+            if i >= first:
                 return True
-            return x.get_owner() == MESSAGE_OWNER['NOT_SENT']
+            if self._corr.get_type(i) == 2:
+                status = self._corr[i].get_status()
+                if status is None or status >= 2:
+                    return True
+            return self._corr.get_owner(i) == MESSAGE_OWNER['NOT_SENT']
 
-        old = filter(save_message, self._corr[:-SAVE_MESSAGES])
-        self._corr = list(old) + self._corr[-SAVE_MESSAGES:]
-        text_messages = filter(lambda x: x.get_type() <= 1, self._corr)
-        self._unsaved_messages = min(self._unsaved_messages, len(list(text_messages)))
+        self._retain(save_message)
         self._search_index = 0
 
     def clear_corr(self, save_unsent=False):
@@ -156,16 +263,18 @@ class Contact(basecontact.BaseContact):
         if hasattr(self, '_message_getter'):
             del self._message_getter
         self._search_index = 0
+        self._search_key = self._search_page = None
         # don't delete data about active file transfer
+        def active_transfer(i):
+            return self._corr.get_type(i) == 2 and self._corr[i].get_status() in ft.ACTIVE_FILE_TRANSFERS
+
         if not save_unsent:
-            self._corr = list(filter(lambda x: x.get_type() == 2 and
-                                               x.get_status() in ft.ACTIVE_FILE_TRANSFERS, self._corr))
             self._unsaved_messages = 0
+            self._retain(active_transfer)
         else:
-            self._corr = list(filter(lambda x: (x.get_type() == 2 and x.get_status() in ft.ACTIVE_FILE_TRANSFERS)
-                                               or (x.get_type() <= 1 and x.get_owner() == MESSAGE_OWNER['NOT_SENT']),
-                                     self._corr))
-            self._unsaved_messages = len(self.get_unsent_messages())
+            self._unsaved_messages = len(self._corr)
+            self._retain(lambda i: active_transfer(i) or (self._corr.get_type(i) <= 1 and
+                                                          self._corr.get_owner(i) == MESSAGE_OWNER['NOT_SENT']))
 
     # -----------------------------------------------------------------------------------------------------------------
     # Chat history search
@@ -173,35 +282,73 @@ class Contact(basecontact.BaseContact):
 
     def search_string(self, search_string):
         self._search_string, self._search_index = search_string, 0
+        self._search_key = self._search_page = None
         return self.search_prev()
 
     def search_prev(self):
-        while True:
+        """
+        Search for older message which contains search string. Loaded messages are searched first, then history
+        :return: negative index of loaded message, index of message on page of history (see get_search_page) or
+        None if message was not found
+        """
+        if self._search_key is None:
             l = len(self._corr)
             for i in range(self._search_index - 1, -l - 1, -1):
-                if self._corr[i].get_type() > 1:
+                if self._corr.get_type(i) > 1:
                     continue
-                message = self._corr[i].get_data()[0]
+                message = self._corr.get_text(i)
                 if re.search(self._search_string, message, re.IGNORECASE) is not None:
                     self._search_index = i
                     return i
             self._search_index = -l
-            self.load_corr(False)
-            if len(self._corr) == l:
-                return None  # not found
+        return self._search_in_history(True)
 
     def search_next(self):
-        if not self._search_index:
+        """
+        Search for newer message which contains search string
+        :return: the same as search_prev
+        """
+        if self._search_key is not None:  # found message is on page of history
+            index = self._search_in_history(False)
+            if index is not None:
+                return index
+            start = -len(self._corr) - 1
+        elif self._search_index:
+            start = self._search_index
+        else:
             return None
-        for i in range(self._search_index + 1, 0):
-            if self._corr[i].get_type() > 1:
+        for i in range(start + 1, 0):
+            if self._corr.get_type(i) > 1:
                 continue
-            message = self._corr[i].get_data()[0]
+            message = self._corr.get_text(i)
             if re.search(self._search_string, message, re.IGNORECASE) is not None:
-                self._search_index = i
+                self._search_index, self._search_key, self._search_page = i, None, None
                 return i
         return None  # not found
 
+    def _search_in_history(self, older):
+        """
+        Search for not loaded message in history. Only page of history with found message is loaded, newer messages
+        are not loaded
+        :param older: search for older message than current result, else for newer
+        :return: index of message on page or None
+        """
+        if not hasattr(self, '_message_getter') or self._message_getter is None:
+            return None
+        key = self._message_getter.search(self._search_string, self._search_key, older)
+        if key is None:
+            return None
+        data, index = self._message_getter.get_page(key)
+        self._search_key, self._search_page = key, list(map(lambda tupl: TextMessage(*tupl), data))
+        return index
+
+    def get_search_page(self):
+        """
+        :return: list of messages of history page with the last found message, oldest first. None if found message
+        is loaded
+        """
+        return self._search_page
+
     # -----------------------------------------------------------------------------------------------------------------
     # Current text - text from message area
     # -----------------------------------------------------------------------------------------------------------------
@@ -224,7 +371,13 @@ class Contact(basecontact.BaseContact):
         :param value: new name
         """
         if not self._alias:
-            super().set_name(value)
+            self._set_name(value)
+
+    def _set_name(self, value):
+        self._name = str(value, 'utf-8')
+        self._changed()
+
+    name = property(basecontact.BaseContact.get_name, _set_name)
 
     def set_alias(self, alias):
         self._alias = bool(alias)
@@ -241,9 +394,41 @@ class Contact(basecontact.BaseContact):
 
     visibility = property(get_visibility, set_visibility)
 
-    def set_widget(self, widget):
-        self._widget = widget
-        self.init_widget()
+    # -----------------------------------------------------------------------------------------------------------------
+    # Data in friends' list. Contacts are painted by delegate of friends list
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _changed(self):
+        """
+        Repaints contact in friends list
+        """
+        if getattr(self, '_model', None) is not None:
+            self._model.contact_changed(self)
+
+    def init_widget(self):
+        if self._model is not None:
+            self.load_avatar()
+
+    def set_status_message(self, value):
+        self._status_message = str(value, 'utf-8')
+        self._changed()
+
+    status_message = property(basecontact.BaseContact.get_status_message, set_status_message)
+
+    def set_status(self, value):
+        self._status = value
+        self._changed()
+
+    status = property(basecontact.BaseContact.get_status, set_status)
+
+    def load_avatar(self):
+        size = 32 if Settings.get_instance()['compact_mode'] else 64
+        pixmap = QtGui.QPixmap(self.get_avatar_path())
+        self._avatar = pixmap.scaled(size, size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        self._changed()
+
+    def get_pixmap(self):
+        return self._avatar
 
     # -----------------------------------------------------------------------------------------------------------------
     # Unread messages and other actions from friend
@@ -254,7 +439,7 @@ class Contact(basecontact.BaseContact):
 
     def set_actions(self, value):
         self._new_actions = value
-        self._widget.connection_status.update(self.status, value)
+        self._changed()
 
     actions = property(get_actions, set_actions)  # unread messages, incoming files, av calls
 
@@ -264,14 +449,12 @@ class Contact(basecontact.BaseContact):
     def inc_messages(self):
         self._new_messages += 1
         self._new_actions = True
-        self._widget.connection_status.update(self.status, True)
-        self._widget.messages.update(self._new_messages)
+        self._changed()
 
     def reset_messages(self):
         self._new_actions = False
         self._new_messages = 0
-        self._widget.messages.update(self._new_messages)
-        self._widget.connection_status.update(self.status, False)
+        self._changed()
 
     messages = property(get_messages)
 
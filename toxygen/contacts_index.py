@@ -0,0 +1,73 @@
+from bisect import bisect_left, insort
+import unicodedata
+
+
+def normalize(text):
+    """
+    :return: text in form used for case insensitive search
+    """
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+class ContactsIndex:
+    """
+    Search index for filtration of friends list. Contact matches query if one of its names (name, alias, name hidden
+    by alias) contains query or its public key starts with query. Names are normalized once when they change. Result
+    of the last search is kept and refined when query grows
+    """
+
+    def __init__(self):
+        self._names = {}  # contact - normalized names separated by new line
+        self._public_keys = {}  # contact - normalized public key
+        self._keys = []  # sorted normalized public keys
+        self._contacts = {}  # normalized public key - contact
+        self._query, self._result = None, None  # last search
+
+    def update(self, contact, *names):
+        """
+        Adds contact to index or updates its names
+        :param contact: contact, its current name is indexed
+        :param names: other names of contact, e.g. name hidden by alias
+        """
+        if contact not in self._names and contact.tox_id is not None:
+            key = self._public_keys[contact] = normalize(contact.tox_id)
+            insort(self._keys, key)
+            self._contacts[key] = contact
+        self._names[contact] = '\n'.join(map(normalize, (contact.name, ) + names))
+        if self._query is not None:
+            if self._matches(contact, self._query):
+                self._result.add(contact)
+            else:
+                self._result.discard(contact)
+
+    def remove(self, contact):
+        if self._names.pop(contact, None) is None:
+            return
+        key = self._public_keys.pop(contact, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+            del self._contacts[key]
+        if self._query is not None:
+            self._result.discard(contact)
+
+    def _matches(self, contact, query):
+        return query in self._names[contact] or self._public_keys.get(contact, '').startswith(query)
+
+    def search(self, query):
+        """
+        :param query: filter string
+        :return: set of matching contacts or None if all contacts match
+        """
+        query = normalize(query)
+        if not query:
+            return None
+        if self._query is not None and query.startswith(self._query):  # refine previous result
+            result = set(filter(lambda c: self._matches(c, query), self._result))
+        else:
+            result = set(filter(lambda c: query in self._names[c], self._names))
+            i = bisect_left(self._keys, query)
+            while i < len(self._keys) and self._keys[i].startswith(query):
+                result.add(self._contacts[self._keys[i]])
+                i += 1
+        self._query, self._result = query, result
+        return set(result)
@@ -0,0 +1,117 @@
+from sqlite3 import connect
+from contextlib import contextmanager
+import threading
+import os.path
+
+
+TIMEOUT = 11
+
+CACHED_STATEMENTS = 256
+
+
+class Database:
+    """
+    Long-lived connection to sqlite db. Only one connection per db file is opened, it's shared between gui thread,
+    history writer and export jobs. All access is serialized with lock
+    """
+
+    _databases = {}  # key - absolute path to db file, value - Database instance
+
+    _databases_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        :param path: absolute path to db file
+        """
+        self._path = path
+        self._lock = threading.RLock()
+        created = not os.path.exists(path) or not os.path.getsize(path)
+        self._connection = connect(path, timeout=TIMEOUT, check_same_thread=False,
+                                   cached_statements=CACHED_STATEMENTS)
+        if created:  # mode can be set only before file header is written, otherwise full VACUUM is needed
+            self._connection.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        self._connection.execute('PRAGMA journal_mode = WAL;')
+        self._connection.execute('PRAGMA synchronous = NORMAL;')
+
+    @staticmethod
+    def open(path):
+        """
+        Returns shared connection to db, opens it if needed
+        :param path: path to db file
+        """
+        path = os.path.abspath(path)
+        with Database._databases_lock:
+            if path not in Database._databases:
+                Database._databases[path] = Database(path)
+            return Database._databases[path]
+
+    def get_path(self):
+        return self._path
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager. Yields cursor, commits changes on exit or rolls them back if exception was raised
+        """
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                yield cursor
+                self._connection.commit()
+            except:
+                self._connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def fetchall(self, sql, parameters=()):
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+            try:
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def fetchone(self, sql, parameters=()):
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+            try:
+                return cursor.fetchone()
+            finally:
+                cursor.close()
+
+    def execute(self, sql):
+        """
+        Executes statements outside of transaction (VACUUM and some pragmas can't be used in transaction). Statements
+        are completely stepped through, unlike with cursor
+        """
+        with self._lock:
+            self._connection.executescript(sql)
+
+    def get_size(self):
+        """
+        :return: tuple (size of db in bytes, size of free pages in bytes)
+        """
+        with self._lock:
+            page_size = self.fetchone('PRAGMA page_size;')[0]
+            page_count = self.fetchone('PRAGMA page_count;')[0]
+            free_count = self.fetchone('PRAGMA freelist_count;')[0]
+        return page_count * page_size, free_count * page_size
+
+    def create_function(self, name, num_params, func):
+        with self._lock:
+            self._connection.create_function(name, num_params, func)
+
+    def checkpoint(self):
+        """
+        Moves all changes from WAL file to db file
+        """
+        with self._lock:
+            self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+
+    def close(self):
+        with Database._databases_lock:
+            if Database._databases.get(self._path) is self:
+                del Database._databases[self._path]
+        with self._lock:
+            self._connection.close()
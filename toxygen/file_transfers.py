@@ -1,8 +1,16 @@
 from toxcore_enums_and_consts import TOX_FILE_KIND, TOX_FILE_CONTROL
 from os.path import basename, getsize, exists, dirname
-from os import remove, rename, chdir
-from time import time, sleep
+from os import remove, rename, chdir, fsync
+from time import time, perf_counter, monotonic
+from math import exp
+from bisect import bisect_left, bisect_right
 from tox import Tox
+from transfers_io import TransfersIO
+from util import atomic_write, log
+from functools import partial
+from shutil import disk_usage
+import json
+import threading
 import settings
 from PyQt5 import QtCore
 
@@ -28,13 +36,201 @@ SHOW_PROGRESS_BAR = (0, 1, 4)
 ALLOWED_FILES = ('toxygen_inline.png', 'utox-inline.png', 'sticker.png')
 
 
+PROGRESS_RATE = 10  # default max number of progress updates of transfer per second
+
+SPEED_SAMPLE_INTERVAL = 0.5  # sec, speed of transfer is measured over this interval
+
+SPEED_TIME_CONSTANT = 3  # sec, weight of older speed samples decays with this time constant
+
+READ_BLOCK_SIZE = 256 * 1024  # size of read-ahead buffer of sent file
+
+READ_OVERLAP = 4096  # blocks overlap, so chunk on border of block is in the next block. Chunks are smaller
+
+STALL_REPORT_TIME = 1  # sec, sending which waited for disk longer is logged
+
+CHECKPOINT_INTERVAL = 5  # sec, how often received ranges of file are saved to journal
+
+JOURNAL_EXTENSION = '.toxpart'
+
+
 def is_inline(file_name):
     return file_name in ALLOWED_FILES or file_name.startswith('qTox_Screenshot_')
 
 
+def load_checkpoint(path):
+    """
+    Loads received ranges of partially received file from its journal
+    :param path: path to received file
+    :return: IntervalSet or None if there is no valid journal
+    """
+    try:
+        with open(path + JOURNAL_EXTENSION) as fl:
+            ranges = json.loads(fl.read())['ranges']
+        size = getsize(path)
+        if all(0 <= start < end <= size for start, end in ranges):
+            return IntervalSet(ranges)
+    except Exception:
+        pass
+    return None
+
+
+def resume_position(path, position):
+    """
+    :param path: path to partially received file
+    :param position: position saved when transfer was paused
+    :return: position from which transfer should be resumed
+    """
+    if not exists(path):
+        return 0
+    received = load_checkpoint(path)
+    return position if received is None else received.get_first_gap()
+
+
+class IntervalSet:
+    """
+    Sorted set of non-overlapping ranges [start, end). Tracks which parts of file were received
+    """
+
+    __slots__ = ('_starts', '_ends')
+
+    def __init__(self, ranges=()):
+        self._starts, self._ends = [], []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        """
+        Adds range [start, end)
+        :return: number of new positions in set
+        """
+        if start >= end:
+            return 0
+        if self._ends and self._ends[-1] == start:  # the most common case - chunks are received in order
+            self._ends[-1] = end
+            return end - start
+        i = bisect_left(self._ends, start)  # ranges i...j-1 intersect or touch new range, they are merged
+        j = bisect_right(self._starts, end)
+        old = 0
+        if i < j:
+            old = sum(self._ends[i:j]) - sum(self._starts[i:j])
+            start, end = min(start, self._starts[i]), max(end, self._ends[j - 1])
+        self._starts[i:j], self._ends[i:j] = [start], [end]
+        return end - start - old
+
+    def covers(self, start, end):
+        """
+        :return: True if all positions in [start, end) are in set
+        """
+        i = bisect_right(self._starts, start) - 1
+        return start >= end or (i >= 0 and self._ends[i] >= end)
+
+    def get_size(self):
+        """
+        :return: number of positions in set
+        """
+        return sum(self._ends) - sum(self._starts)
+
+    def get_first_gap(self):
+        """
+        :return: first position after 0 which is not in set
+        """
+        return self._ends[0] if self._starts and not self._starts[0] else 0
+
+    def get_ranges(self):
+        return list(zip(self._starts, self._ends))
+
+
+class Block:
+    """
+    Part of file in reusable buffer
+    """
+
+    __slots__ = ('view', 'start', 'end')
+
+    def __init__(self, size):
+        self.view = memoryview(bytearray(size))
+        self.start = self.end = -1  # part of file in buffer, nothing is loaded
+
+    def load(self, fl, position):
+        fl.seek(position)
+        self.start = position
+        self.end = position + fl.readinto(self.view)
+
+    def contains(self, position, size):
+        """
+        :return: True if chunk can be served from block - it's loaded or block contains end of file
+        """
+        return self.start <= position and (position + size <= self.end or
+                                           position <= self.end < self.start + len(self.view))
+
+    def get_chunk(self, position, size):
+        start = position - self.start
+        return self.view[start:min(start + size, self.end - self.start)]
+
+
+class ChunkReader:
+    """
+    Reads file by large blocks into two buffers which are reused for all blocks. Chunks are served as memoryview slices
+    of buffers, so they are passed to toxcore without copying. While chunks of one block are sent, the next block is
+    read in background
+    """
+
+    __slots__ = ('_file', '_executor', '_lock', '_current', '_next', '_stall_time')
+
+    def __init__(self, fl, block_size=READ_BLOCK_SIZE, executor=None):
+        """
+        :param fl: file opened in binary mode
+        :param block_size: size of buffer
+        :param executor: function(function) which calls function in background thread. None - no read-ahead
+        """
+        self._file = fl
+        self._executor = executor
+        self._lock = threading.Lock()  # held while block is loaded
+        self._current = Block(block_size)
+        self._next = Block(block_size) if executor is not None else None
+        self._stall_time = 0.
+
+    def read(self, position, size):
+        """
+        :param position: position in file
+        :param size: max size of chunk
+        :return: memoryview with data of file. It's valid until the next call
+        """
+        if not self._current.contains(position, size):
+            start = perf_counter()
+            with self._lock:  # waits for read-ahead
+                if self._next is not None and self._next.contains(position, size):
+                    self._current, self._next = self._next, self._current
+                else:
+                    self._current.load(self._file, position)
+            self._stall_time += perf_counter() - start
+            block = self._current
+            if self._next is not None and block.end == block.start + len(block.view):  # not end of file
+                self._executor(self._read_ahead, block.end - min(READ_OVERLAP, len(block.view) // 2))
+        return self._current.get_chunk(position, size)
+
+    def _read_ahead(self, position):
+        with self._lock:
+            if not self._file.closed:
+                self._next.load(self._file, position)
+
+    def close(self):
+        """
+        Closes file. Waits for read-ahead
+        """
+        with self._lock:
+            self._file.close()
+
+    def get_stall_time(self):
+        """
+        :return: time in seconds which was spent waiting for data
+        """
+        return self._stall_time
+
+
 class StateSignal(QtCore.QObject):
 
-    signal = QtCore.pyqtSignal(int, float, int)  # state, progress, time in sec
+    signal = QtCore.pyqtSignal(int, float, int, float)  # state, progress, time left in sec, speed in bytes/sec
 
 
 class TransferFinishedSignal(QtCore.QObject):
@@ -54,9 +250,14 @@ class FileTransfer(QtCore.QObject):
         self._friend_number = friend_number
         self.state = TOX_FILE_TRANSFER_STATE['RUNNING']
         self._file_number = file_number
-        self._creation_time = None
         self._size = float(size)
         self._done = 0
+        self._speed = 0.  # bytes/sec, exponentially weighted moving average
+        self._sample_time, self._sample_done = None, 0  # start of current speed sample
+        s = settings.Settings.get_instance()
+        rate = s.get('file_transfers_progress_rate', PROGRESS_RATE) if s is not None else PROGRESS_RATE
+        self._progress_interval = 1 / rate if rate else 0
+        self._signal_time, self._signal_state = 0, None  # last emitted progress
         self._state_changed = StateSignal()
         self._finished = TransferFinishedSignal()
         self._file_id = None
@@ -71,12 +272,36 @@ class FileTransfer(QtCore.QObject):
         self._finished.signal.connect(handler)
 
     def signal(self):
+        """
+        Emits state, progress, time left and speed of transfer
+        """
         percentage = self._done / self._size if self._size else 0
-        if self._creation_time is None or not percentage:
-            t = -1
-        else:
-            t = ((time() - self._creation_time) / percentage) * (1 - percentage)
-        self._state_changed.signal.emit(self.state, percentage, int(t))
+        t = (self._size - self._done) / self._speed if self._speed else -1
+        self._signal_time, self._signal_state = monotonic(), self.state
+        self._state_changed.signal.emit(self.state, percentage, int(t), self._speed)
+
+    def progress(self):
+        """
+        Called after every chunk. Updates speed, emits signal if state changed or if progress wasn't emitted during
+        progress interval
+        """
+        now = monotonic()
+        if self._sample_time is None:
+            self._sample_time, self._sample_done = now, self._done
+        elif now - self._sample_time >= SPEED_SAMPLE_INTERVAL:
+            interval = now - self._sample_time
+            speed = (self._done - self._sample_done) / interval
+            weight = 1 - exp(-interval / SPEED_TIME_CONSTANT) if self._speed else 1
+            self._speed += weight * (speed - self._speed)
+            self._sample_time, self._sample_done = now, self._done
+        if self.state != self._signal_state or now - self._signal_time >= self._progress_interval:
+            self.signal()
+
+    def get_speed(self):
+        """
+        :return: speed of transfer in bytes/sec, 0 if transfer isn't running
+        """
+        return self._speed if self.state == TOX_FILE_TRANSFER_STATE['RUNNING'] else 0.
 
     def finished(self):
         self._finished.signal.emit(self._friend_number, self._file_number)
@@ -96,16 +321,29 @@ class FileTransfer(QtCore.QObject):
     def cancel(self):
         self.send_control(TOX_FILE_CONTROL['CANCEL'])
         if hasattr(self, '_file'):
-            self._file.close()
+            self._execute_io(self._close)
         self.signal()
 
     def cancelled(self):
         if hasattr(self, '_file'):
-            sleep(0.1)
-            self._file.close()
+            self._execute_io(self._close)
         self.state = TOX_FILE_TRANSFER_STATE['CANCELLED']
         self.signal()
 
+    def _execute_io(self, function, *args):
+        """
+        Calls function in the same worker thread as other disk operations of transfer, after operations which are
+        already queued. Function is called now if there are no workers
+        """
+        io = TransfersIO.get_instance()
+        if io is not None:
+            io.execute((self._friend_number, self._file_number), function, *args)
+        else:
+            function(*args)
+
+    def _close(self):
+        self._file.close()
+
     def pause(self, by_friend):
         if not by_friend:
             self.send_control(TOX_FILE_CONTROL['PAUSE'])
@@ -130,7 +368,7 @@ class SendTransfer(FileTransfer):
 
     def __init__(self, path, tox, friend_number, kind=TOX_FILE_KIND['DATA'], file_id=None):
         if path is not None:
-            self._file = open(path, 'rb')
+            self._file = open(path, 'rb', buffering=0)  # reader has own buffer
             size = getsize(path)
         else:
             size = 0
@@ -139,6 +377,15 @@ class SendTransfer(FileTransfer):
         self._file_number = tox.file_send(friend_number, kind, size, file_id,
                                           bytes(basename(path), 'utf-8') if path else b'')
         self._file_id = self.get_file_id()
+        if path is not None:
+            io = TransfersIO.get_instance()
+            executor = partial(io.execute, (friend_number, self._file_number)) if io is not None else None
+            self._reader = ChunkReader(self._file, executor=executor)
+
+    def _close(self):
+        self._reader.close()  # file isn't closed while block is read ahead
+        if self._reader.get_stall_time() >= STALL_REPORT_TIME:
+            log('Sending of {} waited for disk {:.1f} s'.format(self._path, self._reader.get_stall_time()))
 
     def send_chunk(self, position, size):
         """
@@ -146,19 +393,16 @@ class SendTransfer(FileTransfer):
         :param position: start position in file
         :param size: chunk max size
         """
-        if self._creation_time is None:
-            self._creation_time = time()
         if size:
-            self._file.seek(position)
-            data = self._file.read(size)
+            data = self._reader.read(position, size)
             self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
             self._done += size
         else:
             if hasattr(self, '_file'):
-                self._file.close()
+                self._close()
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.finished()
-        self.signal()
+        self.progress()
 
 
 class SendAvatar(SendTransfer):
@@ -184,6 +428,7 @@ class SendFromBuffer(FileTransfer):
         super(SendFromBuffer, self).__init__(None, tox, friend_number, len(data))
         self.state = TOX_FILE_TRANSFER_STATE['OUTGOING_NOT_STARTED']
         self._data = data
+        self._view = memoryview(bytearray(data))  # writable copy can be passed to toxcore without copying of chunks
         self._file_number = tox.file_send(friend_number, TOX_FILE_KIND['DATA'],
                                           len(data), None, bytes(file_name, 'utf-8'))
 
@@ -191,16 +436,14 @@ class SendFromBuffer(FileTransfer):
         return self._data
 
     def send_chunk(self, position, size):
-        if self._creation_time is None:
-            self._creation_time = time()
         if size:
-            data = self._data[position:position + size]
+            data = self._view[position:position + size]
             self._tox.file_send_chunk(self._friend_number, self._file_number, position, data)
             self._done += size
         else:
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.finished()
-        self.signal()
+        self.progress()
 
 
 class SendFromFileBuffer(SendTransfer):
@@ -220,23 +463,68 @@ class SendFromFileBuffer(SendTransfer):
 
 
 class ReceiveTransfer(FileTransfer):
+    """
+    Receive file. File is preallocated as sparse file. Received ranges are saved to journal next to file every
+    CHECKPOINT_INTERVAL seconds, so transfer can be resumed after restart or crash
+    """
+    CHECKPOINTS = True
 
     def __init__(self, path, tox, friend_number, size, file_number, position=0):
         super(ReceiveTransfer, self).__init__(path, tox, friend_number, size, file_number)
-        self._file = open(self._path, 'wb')
-        self._file_size = position
-        self._file.truncate(position)
-        self._missed = set()
+        resume = position and exists(self._path)
+        if resume:
+            self._received = load_checkpoint(self._path) or IntervalSet(((0, position), ))
+        else:
+            self._received = IntervalSet()
+        self._file = open(self._path, 'r+b' if resume else 'wb')
+        try:
+            # no data is written - file system doesn't allocate space for holes. Size is sent by friend, file which
+            # can't fit on disk isn't preallocated, receiving of it fails on write
+            if int(size) <= disk_usage(dirname(self._path) or '.').free:
+                self._file.truncate(int(size))
+        except (OSError, OverflowError):
+            pass
         self._file_id = self.get_file_id()
-        self._done = position
+        self._done = self._received.get_size()
+        self._checkpoint_time = time()
 
     def cancel(self):
         super(ReceiveTransfer, self).cancel()
+        self._execute_io(self._remove_file)  # after queued chunks are written and file is closed
+
+    def cancelled(self):
+        if self.CHECKPOINTS:
+            self._execute_io(self.checkpoint)  # after queued chunks are written
+        super(ReceiveTransfer, self).cancelled()
+
+    def _remove_file(self):
         remove(self._path)
+        self._remove_checkpoint()
 
     def total_size(self):
-        self._missed.add(self._file_size)
-        return min(self._missed)
+        """
+        :return: size of received part at the beginning of file - position for resume
+        """
+        return self._received.get_first_gap()
+
+    def checkpoint(self):
+        """
+        Saves received ranges to journal. Data is flushed to disk first, so journal never lists unsaved data
+        """
+        if self._file.closed:  # transfer is finished or cancelled
+            return
+        self._checkpoint_time = time()
+        try:
+            self._file.flush()
+            fsync(self._file.fileno())
+            data = json.dumps({'size': int(self._size), 'ranges': self._received.get_ranges()})
+            atomic_write(self._path + JOURNAL_EXTENSION, bytes(data, 'utf-8'))
+        except Exception as ex:
+            log('Saving of checkpoint failed: ' + str(ex))
+
+    def _remove_checkpoint(self):
+        if exists(self._path + JOURNAL_EXTENSION):
+            remove(self._path + JOURNAL_EXTENSION)
 
     def write_chunk(self, position, data):
         """
@@ -244,58 +532,62 @@ class ReceiveTransfer(FileTransfer):
         :param position: position in file to save data
         :param data: raw data (string)
         """
-        if self._creation_time is None:
-            self._creation_time = time()
+        if self._file.closed:  # chunk was queued before transfer was cancelled
+            return
         if data is None:
             self._file.close()
+            self._remove_checkpoint()
             self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
             self.finished()
         else:
-            data = bytearray(data)
-            if self._file_size < position:
-                self._file.seek(0, 2)
-                self._file.write(b'\0' * (position - self._file_size))
-                self._missed.add(self._file_size)
-            else:
-                self._missed.discard(position)
             self._file.seek(position)
             self._file.write(data)
-            l = len(data)
-            if position + l > self._file_size:
-                self._file_size = position + l
-            self._done += l
-        self.signal()
+            self._done += self._received.add(position, position + len(data))
+            if self.CHECKPOINTS and time() - self._checkpoint_time > CHECKPOINT_INTERVAL:
+                self.checkpoint()
+        self.progress()
 
 
 class ReceiveToBuffer(FileTransfer):
     """
-    Inline image - save in buffer not in file system
+    Inline image - save in buffer not in file system. Buffer is allocated once, chunks are copied into it
     """
 
     def __init__(self, tox, friend_number, size, file_number):
         super(ReceiveToBuffer, self).__init__(None, tox, friend_number, size, file_number)
-        self._data = bytes()
-        self._data_size = 0
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._received = IntervalSet()
 
     def get_data(self):
         return self._data
 
+    def is_complete(self):
+        """
+        :return: True if all announced data was received
+        """
+        return self._received.covers(0, len(self._data))
+
     def write_chunk(self, position, data):
-        if self._creation_time is None:
-            self._creation_time = time()
         if data is None:
-            self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+            self._view.release()
+            self._data = bytes(self._data)
+            if self.is_complete():
+                self.state = TOX_FILE_TRANSFER_STATE['FINISHED']
+            else:  # gaps are zeroed, broken image isn't shown
+                log('Inline image was received partially: {} of {} bytes'.format(self._received.get_size(),
+                                                                                   len(self._data)))
+                self.state = TOX_FILE_TRANSFER_STATE['CANCELLED']
             self.finished()
         else:
-            data = bytes(data)
-            l = len(data)
-            if self._data_size < position:
-                self._data += (b'\0' * (position - self._data_size))
-            self._data = self._data[:position] + data + self._data[position + l:]
-            if position + l > self._data_size:
-                self._data_size = position + l
-            self._done += l
-        self.signal()
+            end = position + len(data)
+            if end > len(self._data):  # more data than announced
+                self._view.release()
+                self._data.extend(bytes(end - len(self._data)))
+                self._view = memoryview(self._data)
+            self._view[position:end] = data
+            self._done += self._received.add(position, end)
+        self.progress()
 
 
 class ReceiveAvatar(ReceiveTransfer):
@@ -303,6 +595,7 @@ class ReceiveAvatar(ReceiveTransfer):
     Get friend's avatar. Doesn't need file transfer item
     """
     MAX_AVATAR_SIZE = 512 * 1024
+    CHECKPOINTS = False
 
     def __init__(self, tox, friend_number, size, file_number):
         path = settings.ProfileHelper.get_path() + 'avatars/{}.png'.format(tox.friend_get_public_key(friend_number))
@@ -334,7 +627,7 @@ class ReceiveAvatar(ReceiveTransfer):
 
     def write_chunk(self, position, data):
         super(ReceiveAvatar, self).write_chunk(position, data)
-        if self.state:
+        if self.state == TOX_FILE_TRANSFER_STATE['FINISHED']:
             avatar_path = self._path[:-4]
             if exists(avatar_path):
                 chdir(dirname(avatar_path))
@@ -10,7 +10,8 @@ class Friend(contact.Contact):
 
     def __init__(self, message_getter, number, name, status_message, widget, tox_id):
         super().__init__(message_getter, number, name, status_message, widget, tox_id)
-        self._receipts = 0
+        self._receipts = {}  # message id - time of message
+        self._parts = {}  # time of message - [number of parts without receipt, the last part was sent]
 
     # -----------------------------------------------------------------------------------------------------------------
     # File transfers support
@@ -21,51 +22,85 @@ class Friend(contact.Contact):
         Update status of active transfer and load inline if needed
         """
         try:
-            tr = list(filter(lambda x: x.get_type() == MESSAGE_TYPE['FILE_TRANSFER'] and x.is_active(file_number),
-                             self._corr))[0]
-            tr.set_status(status)
-            i = self._corr.index(tr)
+            i = self._corr.find(self._transfers[file_number])
+            self._corr[i].set_status(status)
+            if not self._corr[i].is_active(file_number):
+                del self._transfers[file_number]
             if inline:  # inline was loaded
                 self._corr.insert(i, inline)
             return i - len(self._corr)
         except:
             pass
 
+    def _is_unsent_file(self, i):
+        return self._corr.get_type(i) == MESSAGE_TYPE['FILE_TRANSFER'] and self._corr[i].get_status() is None
+
     def get_unsent_files(self):
-        messages = filter(lambda x: type(x) is UnsentFile, self._corr)
-        return messages
+        return list(map(lambda i: self._corr[i], filter(self._is_unsent_file, range(len(self._corr)))))
 
     def clear_unsent_files(self):
-        self._corr = list(filter(lambda x: type(x) is not UnsentFile, self._corr))
+        self._retain(lambda i: not self._is_unsent_file(i))
 
     def remove_invalid_unsent_files(self):
-        def is_valid(message):
-            if type(message) is not UnsentFile:
+        def is_valid(i):
+            if not self._is_unsent_file(i):
                 return True
+            message = self._corr[i]
             if message.get_data()[1] is not None:
                 return True
             return os.path.exists(message.get_data()[0])
-        self._corr = list(filter(is_valid, self._corr))
+        self._retain(is_valid)
 
     def delete_one_unsent_file(self, time):
-        self._corr = list(filter(lambda x: not (type(x) is UnsentFile and x.get_data()[2] == time), self._corr))
+        self._retain(lambda i: not (self._is_unsent_file(i) and self._corr.get_time(i) == time))
+
+    def _reset_indexes(self):
+        super()._reset_indexes()
+        self._transfers = {}  # file number - key of active transfer message
+
+    def _index_messages(self, start, end, prepended=False):
+        super()._index_messages(start, end, prepended)
+        for i in filter(lambda i: self._corr.get_type(i) == MESSAGE_TYPE['FILE_TRANSFER'], range(start, end)):
+            message = self._corr[i]
+            if message.get_status() is not None and message.is_active(message.get_file_number()):  # not unsent file
+                self._transfers[message.get_file_number()] = self._corr.get_key(i)
 
     # -----------------------------------------------------------------------------------------------------------------
     # History support
     # -----------------------------------------------------------------------------------------------------------------
 
-    def get_receipts(self):
-        return self._receipts
-
-    receipts = property(get_receipts)  # read receipts
-
-    def inc_receipts(self):
-        self._receipts += 1
+    def add_receipts(self, time, message_ids, last=True):
+        """
+        Parts of message were sent to friend
+        :param time: time of message
+        :param message_ids: ids of sent parts of message
+        :param last: the last part of message was sent
+        """
+        parts = self._parts.setdefault(time, [0, False])
+        parts[0] += len(message_ids)
+        parts[1] = last
+        for message_id in message_ids:
+            self._receipts[message_id] = time
 
-    def dec_receipt(self):
-        if self._receipts:
-            self._receipts -= 1
-            self.mark_as_sent()
+    def receipt(self, message_id):
+        """
+        Read receipt received. Message is marked as sent when all its parts were received
+        :return: time of message if it was marked as sent, else None
+        """
+        time = self._receipts.pop(message_id, None)
+        if time is None:
+            return None
+        parts = self._parts[time]
+        parts[0] -= 1
+        if parts[0] or not parts[1]:
+            return None
+        del self._parts[time]
+        self.mark_as_sent(time)
+        return time
+
+    def clear_receipts(self):
+        self._receipts.clear()
+        self._parts.clear()
 
     # -----------------------------------------------------------------------------------------------------------------
     # Full status
@@ -1,13 +1,12 @@
 import contact
 import util
-from PyQt5 import QtGui, QtCore
 import toxcore_enums_and_consts as constants
 
 
 class GroupChat(contact.Contact):
 
-    def __init__(self, name, status_message, widget, tox, group_number):
-        super().__init__(None, group_number, name, status_message, widget, None)
+    def __init__(self, name, status_message, model, tox, group_number):
+        super().__init__(None, group_number, name, status_message, model, None)
         self._tox = tox
         self.set_status(constants.TOX_USER_STATUS['NONE'])
 
@@ -21,13 +20,8 @@ class GroupChat(contact.Contact):
     def new_title(self, title):
         super().set_name(title)
 
-    def load_avatar(self):
-        path = util.curr_directory() + '/images/group.png'
-        width = self._widget.avatar_label.width()
-        pixmap = QtGui.QPixmap(path)
-        self._widget.avatar_label.setPixmap(pixmap.scaled(width, width, QtCore.Qt.KeepAspectRatio,
-                                                          QtCore.Qt.SmoothTransformation))
-        self._widget.avatar_label.repaint()
+    def get_avatar_path(self):
+        return util.curr_directory() + '/images/group.png'
 
     def remove_invalid_unsent_files(self):
         pass
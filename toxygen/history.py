@@ -1,16 +1,46 @@
-from sqlite3 import connect
 import settings
-from os import chdir
 import os.path
+import re
+import threading
+import queue
+import time
+import itertools
+import util
 from toxes import ToxES
+from database import Database
+from toxencryptsave_enums_and_consts import TOX_PASS_SALT_LENGTH
 
 
-PAGE_SIZE = 42
+SQLITE_HEADER = b'SQLite format 3\x00'
 
-TIMEOUT = 11
+PAGE_SIZE = 42
 
 SAVE_MESSAGES = 250
 
+SCHEMA_VERSION = 3
+
+SEARCH_RESULTS = 100
+
+EXPORT_BATCH_SIZE = 1000
+
+WRITE_QUEUE_SIZE = 4096
+
+WRITE_BATCH_SIZE = 128
+
+WRITE_INTERVAL = 0.5  # max delay of saving in seconds
+
+COMPACT_DELAY = 60  # delay of the first compaction after start in seconds
+
+COMPACT_INTERVAL = 60 * 60
+
+COMPACT_BATCH_SIZE = 500  # max number of messages deleted in one transaction
+
+COMPACT_PAUSE = 0.05  # pause between batches in seconds
+
+VACUUM_PAGES = 256  # max number of pages freed by one incremental vacuum step
+
+INDEX_MERGE_PAGES = 256  # max number of pages written by one merge step of full-text index
+
 MESSAGE_OWNER = {
     'ME': 0,
     'FRIEND': 1,
@@ -19,197 +49,797 @@ MESSAGE_OWNER = {
 
 
 class History:
+    """
+    Chat history. If profile has password, text of every message is encrypted separately with key derived once per
+    session, so history file is never decrypted as a whole
+    """
 
     def __init__(self, name):
         self._name = name
-        chdir(settings.ProfileHelper.get_path())
         path = settings.ProfileHelper.get_path() + self._name + '.hstr'
-        if os.path.exists(path):
+        if os.path.exists(path):  # old versions encrypted whole file
+            self._decrypt_file(path)
+        self._db = Database.open(path)
+        self._db.create_function('regexp', 2, self._regexp)
+        self._key = None
+        self._locked = False
+        self._available = True
+        try:
+            with self._db.transaction() as cursor:
+                cursor.execute('PRAGMA secure_delete = ON;')  # don't leave plain text in free pages
+            version = self._db.fetchone('PRAGMA user_version;')[0]
+            if version < SCHEMA_VERSION:
+                with self._db.transaction() as cursor:
+                    self._upgrade(cursor, version)
+        except Exception as ex:  # db is locked by another process or damaged - history isn't loaded and saved
+            util.log('History {} is unavailable: {}'.format(path, ex))
+            self._available = False
+            self._locked = True
+        self._fts = self._available and \
+            self._db.fetchone("SELECT 0 FROM sqlite_master WHERE name = 'messages_fts';") is not None
+        self._writer = HistoryWriter(self._db)
+        self._writer.start()
+        if self._available:
+            self._init_encryption()
+        self._compactor = HistoryCompactor(self._db, self.is_locked)
+        self._compactor.start()
+
+    @staticmethod
+    def _decrypt_file(path):
+        """
+        Decrypts history file encrypted as a whole by old versions. File which can't be decrypted is kept under
+        another name, new history is created instead of it
+        """
+        with open(path, 'rb') as fin:
+            if fin.read(len(SQLITE_HEADER)) in (SQLITE_HEADER, b''):  # plain db
+                return
+            fin.seek(0)
+            data = fin.read()
+        try:
             decr = ToxES.get_instance()
-            try:
-                with open(path, 'rb') as fin:
-                    data = fin.read()
-                if decr.is_data_encrypted(data):
-                    data = decr.pass_decrypt(data)
-                    with open(path, 'wb') as fout:
-                        fout.write(data)
-            except:
-                os.remove(path)
-        db = connect(name + '.hstr', timeout=TIMEOUT)
-        cursor = db.cursor()
+            if decr.is_data_encrypted(data):
+                data = decr.pass_decrypt(data)
+                util.atomic_write(path, data)
+        except Exception as ex:
+            backup = '{}.{}.bak'.format(path, int(time.time()))
+            util.log('History file {} can\'t be decrypted and was moved to {}: {}'.format(path, backup, ex))
+            os.replace(path, backup)
+
+    @staticmethod
+    def _upgrade(cursor, version):
+        """
+        Updates db schema to current version
+        :param version: current version of db schema
+        """
+        if version < 1:
+            History._create_messages_table(cursor)
+        if version < 2:
+            History._create_search_index(cursor)
+        if version < 3:
+            cursor.execute('CREATE TABLE IF NOT EXISTS meta('
+                           '    name TEXT PRIMARY KEY,'
+                           '    value BLOB'
+                           ')')
+        cursor.execute('PRAGMA user_version = {};'.format(SCHEMA_VERSION))
+
+    @staticmethod
+    def _create_messages_table(cursor):
+        """
+        Old versions stored messages in separate table id<tox_id> for every friend - all these tables are moved to
+        single messages table
+        """
         cursor.execute('CREATE TABLE IF NOT EXISTS friends('
                        '    tox_id TEXT PRIMARY KEY'
                        ')')
-        db.close()
+        cursor.execute('ALTER TABLE friends RENAME TO old_friends;')
+        cursor.execute('CREATE TABLE friends('
+                       '    id INTEGER PRIMARY KEY,'
+                       '    tox_id TEXT UNIQUE'
+                       ')')
+        cursor.execute('INSERT INTO friends(tox_id) SELECT tox_id FROM old_friends;')
+        cursor.execute('DROP TABLE old_friends;')
+        cursor.execute('CREATE TABLE IF NOT EXISTS messages('
+                       '    id INTEGER PRIMARY KEY,'
+                       '    friend_id INTEGER,'
+                       '    message TEXT,'
+                       '    owner INTEGER,'
+                       '    unix_time REAL,'
+                       '    message_type INTEGER'
+                       ')')
+        cursor.execute('CREATE INDEX IF NOT EXISTS messages_friend_time ON messages(friend_id, unix_time);')
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'id%';")
+        for (table, ) in cursor.fetchall():
+            tox_id = table[2:]
+            cursor.execute('INSERT OR IGNORE INTO friends(tox_id) VALUES (?);', (tox_id, ))
+            cursor.execute('INSERT INTO messages(friend_id, message, owner, unix_time, message_type) '
+                           'SELECT (SELECT id FROM friends WHERE tox_id = ?), message, owner, unix_time, message_type '
+                           'FROM "' + table + '" ORDER BY unix_time;', (tox_id, ))
+            cursor.execute('DROP TABLE "' + table + '";')
 
-    def save(self):
+    @staticmethod
+    def _create_search_index(cursor):
+        """
+        Full-text index over text of messages. It's updated by triggers. Search works without it (slower) if sqlite
+        was built without FTS5
+        """
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', "
+                           "content_rowid='id', tokenize='trigram');")
+        except:
+            print('Full-text search is not supported')
+            return
+        cursor.execute("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages "
+                       "WHEN typeof(new.message) = 'text' BEGIN "
+                       "    INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message); "
+                       "END;")
+        cursor.execute("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages "
+                       "WHEN typeof(old.message) = 'text' BEGIN "
+                       "    INSERT INTO messages_fts(messages_fts, rowid, message) "
+                       "    VALUES ('delete', old.id, old.message); "
+                       "END;")
+        cursor.execute("CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN "
+                       "    INSERT INTO messages_fts(messages_fts, rowid, message) "
+                       "    SELECT 'delete', old.id, old.message WHERE typeof(old.message) = 'text'; "
+                       "    INSERT INTO messages_fts(rowid, message) "
+                       "    SELECT new.id, new.message WHERE typeof(new.message) = 'text'; "
+                       "END;")
+        cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');")
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Encryption
+    # -----------------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _has_password():
         encr = ToxES.get_instance()
-        if encr.has_password():
-            path = settings.ProfileHelper.get_path() + self._name + '.hstr'
-            with open(path, 'rb') as fin:
-                data = fin.read()
-            data = encr.pass_encrypt(bytes(data))
-            with open(path, 'wb') as fout:
-                fout.write(data)
+        return encr is not None and encr.has_password()
+
+    def _init_encryption(self):
+        """
+        Derives key from password and salt stored in db. Plain text history is encrypted if profile has password.
+        History encrypted with another password is locked: its messages are kept as is, but not loaded and new
+        messages are not saved until the right password is set
+        """
+        meta = dict(self._db.fetchall("SELECT name, value FROM meta WHERE name IN ('salt', 'check');"))
+        self._locked = False
+        if 'salt' in meta:
+            if self._has_password():
+                encr = ToxES.get_instance()
+                key = encr.derive_key(meta['salt'])
+                try:
+                    encr.key_decrypt(meta['check'], key)
+                    self._key = key
+                    return
+                except:
+                    encr.free_key(key)
+            util.log('History is encrypted with another password and is locked')
+            self._locked = True
+        elif self._has_password():
+            self._change_key()
+
+    def is_locked(self):
+        """
+        :return: True if history was encrypted with another password or db is unavailable and can't be read
+        """
+        return self._locked
+
+    def _change_key(self):
+        """
+        Re-encrypts all messages with key derived from current password and new salt. Without password messages are
+        stored as plain text
+        """
+        self._writer.flush()
+        encr = ToxES.get_instance()
+        salt = os.urandom(TOX_PASS_SALT_LENGTH)
+        key = encr.derive_key(salt) if self._has_password() else None
+        try:
+            with self._db.transaction() as cursor:
+                cursor.execute('SELECT id, message FROM messages;')
+                messages = cursor.fetchall()
+                cursor.executemany('UPDATE messages SET message = ? WHERE id = ?;',
+                                   ((self._encrypt(self._decrypt(message), key), message_id)
+                                    for message_id, message in messages))
+                cursor.execute("DELETE FROM meta WHERE name IN ('salt', 'check');")
+                if key is not None:
+                    cursor.executemany('INSERT INTO meta(name, value) VALUES (?, ?);',
+                                       (('salt', salt), ('check', encr.key_encrypt(salt, key))))
+        except:
+            print('Database is locked!')
+            if key is not None:
+                encr.free_key(key)
+            return
+        if self._key is not None:
+            encr.free_key(self._key)
+        self._key = key
+        self._db.checkpoint()
+
+    @staticmethod
+    def _encrypt(message, key):
+        """
+        :param message: text of message
+        :param key: key or None
+        :return: encrypted text or text if there is no key
+        """
+        if key is None:
+            return message
+        return ToxES.get_instance().key_encrypt(bytes(message, 'utf-8'), key)
+
+    def _decrypt(self, message):
+        """
+        :param message: text or encrypted text of message
+        :return: text of message
+        """
+        if isinstance(message, bytes):
+            return str(ToxES.get_instance().key_decrypt(message, self._key), 'utf-8')
+        return message
+
+    def change_password(self):
+        """
+        Re-encrypts history after profile password was changed. Locked history is unlocked if the new password is
+        the password of history
+        """
+        if not self._available:
+            return
+        if self._locked:
+            self._init_encryption()
+        else:
+            self._change_key()
+
+    def compact(self):
+        """
+        Applies retention policies immediately
+        """
+        self._writer.flush()
+        self._compactor.compact()
+
+    def get_compaction_report(self):
+        """
+        :return: result of the last compaction - dict, key - tox_id, value - (number of deleted messages, reclaimed
+        bytes)
+        """
+        return self._compactor.get_report()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Saving
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def save(self):
+        self._compactor.stop()
+        self._writer.stop()
+        if self._key is not None:
+            ToxES.get_instance().free_key(self._key)
+            self._key = None
+        self._db.close()
 
     def export(self, directory):
-        path = settings.ProfileHelper.get_path() + self._name + '.hstr'
+        """
+        Copies history to directory. Messages in copy are encrypted with the same password as in profile
+        """
+        self._writer.flush()
+        self._db.checkpoint()
         new_path = directory + self._name + '.hstr'
-        with open(path, 'rb') as fin:
+        with open(self._db.get_path(), 'rb') as fin:
             data = fin.read()
-        encr = ToxES.get_instance()
-        if encr.has_password():
-            data = encr.pass_encrypt(data)
         with open(new_path, 'wb') as fout:
             fout.write(data)
 
     def add_friend_to_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
         try:
-            cursor = db.cursor()
-            cursor.execute('INSERT INTO friends VALUES (?);', (tox_id, ))
-            cursor.execute('CREATE TABLE id' + tox_id + '('
-                           '    id INTEGER PRIMARY KEY,'
-                           '    message TEXT,'
-                           '    owner INTEGER,'
-                           '    unix_time REAL,'
-                           '    message_type INTEGER'
-                           ')')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('INSERT INTO friends(tox_id) VALUES (?);', (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def delete_friend_from_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
+        self._writer.flush()
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM friends WHERE tox_id=?;', (tox_id, ))
-            cursor.execute('DROP TABLE id' + tox_id + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?);',
+                               (tox_id, ))
+                cursor.execute('DELETE FROM friends WHERE tox_id = ?;', (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def friend_exists_in_db(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
-        cursor = db.cursor()
-        cursor.execute('SELECT 0 FROM friends WHERE tox_id=?', (tox_id, ))
-        result = cursor.fetchone()
-        db.close()
+        if not self._available:
+            return False
+        result = self._db.fetchone('SELECT 0 FROM friends WHERE tox_id = ?;', (tox_id, ))
         return result is not None
 
     def save_messages_to_db(self, tox_id, messages_iter):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
+        self._writer.flush()
+        if self._locked:
+            return
         try:
-            cursor = db.cursor()
-            cursor.executemany('INSERT INTO id' + tox_id + '(message, owner, unix_time, message_type) '
-                               'VALUES (?, ?, ?, ?);', messages_iter)
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('SELECT id FROM friends WHERE tox_id = ?;', (tox_id, ))
+                friend_id = cursor.fetchone()[0]
+                cursor.executemany('INSERT INTO messages(friend_id, message, owner, unix_time, message_type) '
+                                   'VALUES (?, ?, ?, ?, ?);',
+                                   ((friend_id, self._encrypt(m[0], self._key)) + tuple(m[1:]) for m in messages_iter))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
+
+    def add_message(self, tox_id, message_data):
+        """
+        Queues message for saving. Messages are written in background in the same order as they were added
+        :param message_data: (message, owner, unix_time, message_type)
+        :return: False if history is not saved
+        """
+        s = settings.Settings.get_instance()
+        if not s['save_history'] or self._locked:
+            return False
+        if not s['save_unsent_only'] or message_data[1] == MESSAGE_OWNER['NOT_SENT']:
+            self._writer.execute('INSERT INTO messages(friend_id, message, owner, unix_time, message_type) '
+                                 'VALUES ((SELECT id FROM friends WHERE tox_id = ?), ?, ?, ?, ?);',
+                                 (tox_id, self._encrypt(message_data[0], self._key)) + tuple(message_data[1:]))
+        return True
+
+    def message_sent(self, tox_id, unix_time):
+        """
+        Queues update of saved unsent message
+        :param unix_time: time of message which was sent
+        """
+        s = settings.Settings.get_instance()
+        if not s['save_history']:
+            return
+        if s['save_unsent_only']:
+            sql = 'DELETE FROM messages '
+        else:
+            sql = 'UPDATE messages SET owner = 0 '
+        self._writer.execute(sql + 'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                                   'AND unix_time = ? AND owner = 2;', (tox_id, unix_time))
 
     def update_messages(self, tox_id, unsent_time):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
-        try:
-            cursor = db.cursor()
-            cursor.execute('UPDATE id' + tox_id + ' SET owner = 0 '
-                           'WHERE unix_time < ' + str(unsent_time) + ' AND owner = 2;')
-            db.commit()
-        except:
-            print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
+        """
+        Queues update of all saved unsent messages older than unsent_time
+        """
+        self._writer.execute('UPDATE messages SET owner = 0 '
+                             'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                             'AND unix_time < ? AND owner = 2;', (tox_id, unsent_time))
 
     def delete_message(self, tox_id, time):
-        start, end = str(time - 0.01), str(time + 0.01)
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
+        start, end = time - 0.01, time + 0.01
+        self._writer.flush()
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ' WHERE unix_time < ' + end + ' AND unix_time > ' +
-                           start + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages '
+                               'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                               'AND unix_time < ? AND unix_time > ?;', (tox_id, end, start))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
 
     def delete_messages(self, tox_id):
-        chdir(settings.ProfileHelper.get_path())
-        db = connect(self._name + '.hstr', timeout=TIMEOUT)
+        self._writer.flush()
         try:
-            cursor = db.cursor()
-            cursor.execute('DELETE FROM id' + tox_id + ';')
-            db.commit()
+            with self._db.transaction() as cursor:
+                cursor.execute('DELETE FROM messages WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?);',
+                               (tox_id, ))
         except:
             print('Database is locked!')
-            db.rollback()
-        finally:
-            db.close()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Export
+    # -----------------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _range_conditions(start, end):
+        conditions, parameters = '', []
+        if start is not None:
+            conditions += ' AND unix_time >= ?'
+            parameters.append(start)
+        if end is not None:
+            conditions += ' AND unix_time < ?'
+            parameters.append(end)
+        return conditions, parameters
+
+    def count_messages(self, tox_id, start=None, end=None):
+        """
+        :return: number of friend's messages sent in [start, end)
+        """
+        self._writer.flush()
+        if self._locked:
+            return 0
+        conditions, parameters = self._range_conditions(start, end)
+        return self._db.fetchone('SELECT count(*) FROM messages '
+                                 'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?)' + conditions + ';',
+                                 [tox_id] + parameters)[0]
+
+    def messages_iter(self, tox_id, start=None, end=None, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Generator of friend's messages from the oldest to the newest. Messages are read in batches, db isn't locked
+        between them
+        :param start: min unix_time of message or None
+        :param end: messages sent at this time or later are skipped, None - no limit
+        :return: batches (lists) of (message, owner, unix_time, message_type)
+        """
+        self._writer.flush()
+        conditions, parameters = self._range_conditions(start, end)
+        key = (float('-inf'), 0)
+        while not self._locked:
+            rows = self._db.fetchall('SELECT message, owner, unix_time, message_type, id FROM messages '
+                                     'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                                     'AND (unix_time, id) > (?, ?)' + conditions +
+                                     ' ORDER BY unix_time, id LIMIT ?;',
+                                     [tox_id, key[0], key[1]] + parameters + [batch_size])
+            if not rows:
+                return
+            key = rows[-1][2], rows[-1][4]
+            yield list(map(lambda row: (self._decrypt(row[0]), ) + row[1:4], rows))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Search
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _regexp(self, pattern, message):
+        if isinstance(message, bytes):
+            message = self._decrypt(message)
+        return isinstance(message, str) and re.search(pattern, message, re.IGNORECASE) is not None
+
+    def search(self, text, tox_id=None, before=None, count=SEARCH_RESULTS):
+        """
+        Search for messages which contain text. Plain strings are looked up in full-text index, other patterns
+        are matched as case insensitive regular expressions. Encrypted messages aren't indexed and are decrypted
+        during search
+        :param text: string or regular expression
+        :param tox_id: search only in history of this friend. None - search in all friends' history
+        :param before: search only for messages sent before this time
+        :param count: max number of results
+        :return: list of (tox_id, unix_time, message), newest first
+        """
+        conditions, parameters = [], []
+        if before is not None:
+            conditions.append('messages.unix_time < ?')
+            parameters.append(before)
+        result = self._search(text, tox_id, conditions, parameters, count)
+        return list(map(lambda row: (row[0], row[1], self._decrypt(row[2])), result))
+
+    def _search(self, text, tox_id, conditions, parameters, count, newest_first=True):
+        """
+        :param conditions: other conditions for messages, e.g. range of time, parameters are values for them
+        :return: list of (tox_id, unix_time, message, id), message isn't decrypted
+        """
+        if self._locked:
+            return []
+        conditions, parameters = list(conditions), list(parameters)
+        if tox_id is not None:
+            conditions.insert(0, 'messages.friend_id = (SELECT id FROM friends WHERE tox_id = ?)')
+            parameters.insert(0, tox_id)
+        if self._fts and self._key is None and len(text) >= 3 and re.search(r'[\\^$.|?*+()\[\]{}]', text) is None:
+            source = 'messages_fts JOIN messages ON messages.id = messages_fts.rowid'
+            conditions.append('messages_fts MATCH ?')
+            parameters.append('"' + text.replace('"', '""') + '"')
+        else:
+            source = 'messages'
+            conditions.append('messages.message REGEXP ?')
+            parameters.append(text)
+        parameters.append(count)
+        order = 'DESC' if newest_first else 'ASC'
+        return self._db.fetchall('SELECT friends.tox_id, messages.unix_time, messages.message, messages.id FROM ' +
+                                 source + ' JOIN friends ON friends.id = messages.friend_id WHERE ' +
+                                 ' AND '.join(conditions) +
+                                 ' ORDER BY messages.unix_time {0}, messages.id {0} LIMIT ?;'.format(order),
+                                 parameters)
 
     def messages_getter(self, tox_id):
-        return History.MessageGetter(self._name, tox_id)
+        return History.MessageGetter(self, self._db, tox_id)
 
     class MessageGetter:
+        """
+        Loads friend's messages page by page from the newest to the oldest. Next page is selected by (unix_time, id)
+        of the oldest loaded message, so every page costs the same regardless of scrollback depth
+        """
 
-        def __init__(self, name, tox_id):
-            self._count = 0
-            self._name = name
+        def __init__(self, history, db, tox_id):
+            self._history = history
+            self._db = db
             self._tox_id = tox_id
-            self._db = self._cursor = None
-
-        def connect(self):
-            chdir(settings.ProfileHelper.get_path())
-            self._db = connect(self._name + '.hstr', timeout=TIMEOUT)
-            self._cursor = self._db.cursor()
-            self._cursor.execute('SELECT message, owner, unix_time, message_type FROM id' + self._tox_id +
-                                 ' ORDER BY unix_time DESC;')
-
-        def disconnect(self):
-            self._db.close()
-
-        def get_one(self):
-            self.connect()
-            self.skip()
-            data = self._cursor.fetchone()
-            self._count += 1
-            self.disconnect()
-            return data
+            self._last = None  # (unix_time, id) of the oldest loaded message
 
-        def get_all(self):
-            self.connect()
-            data = self._cursor.fetchall()
-            self.disconnect()
-            self._count = len(data)
-            return data
+        def _fetch_before(self, key, count, since=None):
+            """
+            :param key: (unix_time, id) or None to start from the newest message
+            :param count: max number of messages, -1 - no limit
+            :param since: min unix_time of message or None
+            :return: list of (message, owner, unix_time, message_type, id) ordered from the newest
+            """
+            if self._history.is_locked():
+                return []
+            key = key or (float('inf'), 0)
+            since = float('-inf') if since is None else since
+            return self._db.fetchall('SELECT message, owner, unix_time, message_type, id FROM messages '
+                                     'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                                     'AND (unix_time, id) < (?, ?) AND unix_time >= ? '
+                                     'ORDER BY unix_time DESC, id DESC LIMIT ?;',
+                                     (self._tox_id, ) + key + (since, count))
+
+        def _fetch_after(self, key, count):
+            """
+            :param key: (unix_time, id)
+            :param count: max number of messages
+            :return: list of (message, owner, unix_time, message_type, id) ordered from the oldest
+            """
+            if self._history.is_locked():
+                return []
+            return self._db.fetchall('SELECT message, owner, unix_time, message_type, id FROM messages '
+                                     'WHERE friend_id = (SELECT id FROM friends WHERE tox_id = ?) '
+                                     'AND (unix_time, id) > (?, ?) ORDER BY unix_time, id LIMIT ?;',
+                                     (self._tox_id, ) + key + (count, ))
+
+        def _decrypt_rows(self, rows):
+            return list(map(lambda row: (self._history._decrypt(row[0]), ) + row[1:4], rows))
+
+        def _move(self, rows):
+            if rows:
+                self._last = rows[-1][2], rows[-1][4]
+            return self._decrypt_rows(rows)
 
         def get(self, count):
-            self.connect()
-            self.skip()
-            data = self._cursor.fetchmany(count)
-            self.disconnect()
-            self._count += len(data)
-            return data
-
-        def skip(self):
-            if self._count:
-                self._cursor.fetchmany(self._count)
-
-        def delete_one(self):
-            if self._count:
-                self._count -= 1
+            """
+            :return: next page of older messages, newest first
+            """
+            return self._move(self._fetch_before(self._last, count))
+
+        def get_all(self):
+            """
+            :return: all messages older than already loaded, newest first
+            """
+            return self._move(self._fetch_before(self._last, -1))
+
+        def get_before(self, timestamp, count=PAGE_SIZE):
+            """
+            Get page of messages sent before timestamp. Next pages will continue from it
+            :return: list of messages, newest first
+            """
+            return self._move(self._fetch_before((timestamp, -1), count))
+
+        def get_page(self, key, count=PAGE_SIZE):
+            """
+            Get page of messages around message, e.g. search result. Doesn't affect paging
+            :param key: (unix_time, id) of message
+            :return: list of messages, oldest first, and index of message in it
+            """
+            older = self._fetch_before(key, count // 2)
+            older.reverse()
+            newer = self._fetch_after((key[0], key[1] - 1), count - len(older))
+            return self._decrypt_rows(older + newer), len(older)
+
+        def search(self, text, key=None, older=True):
+            """
+            Search for the nearest message which contains text among messages which are older than already loaded
+            :param key: (unix_time, id) of message to start from. None - start from the oldest loaded message
+            :param older: search for older message than key, else for newer
+            :return: (unix_time, id) of found message or None
+            """
+            conditions = ['(messages.unix_time, messages.id) {} (?, ?)'.format('<' if older else '>')]
+            parameters = list(key or self._last or (float('inf'), 0))
+            if not older and self._last is not None:
+                conditions.append('(messages.unix_time, messages.id) < (?, ?)')
+                parameters.extend(self._last)
+            result = self._history._search(text, self._tox_id, conditions, parameters, 1, older)
+            return (result[0][1], result[0][3]) if result else None
+
+        def add_message(self, message_data):
+            """
+            Queues message for saving
+            :return: False if history is not saved
+            """
+            return self._history.add_message(self._tox_id, message_data)
+
+        def message_sent(self, unix_time):
+            self._history.message_sent(self._tox_id, unix_time)
+
+        def get_after(self, timestamp, count=PAGE_SIZE):
+            """
+            Get messages sent after timestamp. Doesn't affect paging
+            :return: list of messages, oldest first
+            """
+            return self._decrypt_rows(self._fetch_after((timestamp, float('inf')), count))
+
+
+class HistoryWriter(threading.Thread):
+    """
+    Write-behind saving of history. Statements are queued by gui thread and executed in background in batches - one
+    transaction per WRITE_BATCH_SIZE statements or WRITE_INTERVAL seconds. Queue is bounded, so gui thread waits if
+    db can't keep up
+    """
+
+    def __init__(self, db):
+        super().__init__(daemon=True)
+        self._db = db
+        self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+
+    def execute(self, sql, parameters):
+        self._queue.put((sql, parameters))
+
+    def flush(self):
+        """
+        Waits until all queued statements are written
+        """
+        if self.is_alive():
+            done = threading.Event()
+            self._queue.put((None, done))
+            done.wait()
+
+    def stop(self):
+        """
+        Writes queued statements and stops thread
+        """
+        if self.is_alive():
+            self._queue.put((None, None))
+            self.join()
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + WRITE_INTERVAL
+            while batch[-1][0] is not None and len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._write(list(filter(lambda x: x[0] is not None, batch)))
+            for sql, event in filter(lambda x: x[0] is None, batch):
+                if event is None:
+                    stop = True
+                else:
+                    event.set()
+
+    def _write(self, statements):
+        if not statements:
+            return
+        try:
+            with self._db.transaction() as cursor:
+                # consecutive statements with the same sql are executed at once
+                for sql, group in itertools.groupby(statements, lambda x: x[0]):
+                    cursor.executemany(sql, map(lambda x: x[1], group))
+        except:
+            print('Database is locked!')
+
+
+class HistoryCompactor(threading.Thread):
+    """
+    Applies retention policies from settings: max age of messages, max number of messages per friend and max size of
+    db. Old messages are deleted in small batches, so gui thread never waits for db for long. Unsent messages are
+    never deleted. Free pages are returned to file system by incremental vacuum if db was created with it
+    """
+
+    def __init__(self, db, is_locked):
+        """
+        :param is_locked: function which returns True if history can't be read - it's not compacted then
+        """
+        super().__init__(daemon=True)
+        self._db = db
+        self._is_locked = is_locked
+        self._stop_event = threading.Event()
+        self._report = {}
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def get_report(self):
+        """
+        :return: dict, key - tox_id, value - (number of deleted messages, reclaimed bytes)
+        """
+        return dict(self._report)
+
+    def run(self):
+        if self._stop_event.wait(COMPACT_DELAY):
+            return
+        while True:
+            try:
+                self.compact()
+            except Exception as ex:
+                util.log('History compaction failed: ' + str(ex))
+            if self._stop_event.wait(COMPACT_INTERVAL):
+                return
+
+    def compact(self):
+        """
+        Deletes messages which don't fit retention policies. Db isn't changed if no policy is set
+        """
+        s = settings.Settings.get_instance()
+        if self._is_locked() or not (s['history_max_age'] or s['history_max_messages'] or s['history_max_size']):
+            return
+        # db of old version isn't converted - full vacuum rewrites whole file. Its free pages are reused
+        incremental = self._db.fetchone('PRAGMA auto_vacuum;')[0] == 2
+        report = {}  # key - friend_id
+        friends = self._db.fetchall('SELECT id, tox_id FROM friends;')
+        if s['history_max_age']:
+            min_time = time.time() - s['history_max_age'] * 24 * 60 * 60
+            for friend_id, tox_id in friends:
+                self._delete_messages(report, 'friend_id = ? AND unix_time < ?', (friend_id, min_time))
+        if s['history_max_messages']:
+            for friend_id, tox_id in friends:
+                # the newest message which doesn't fit is found in index, messages aren't counted
+                last = self._db.fetchone('SELECT unix_time, id FROM messages WHERE friend_id = ? AND owner != 2 '
+                                         'ORDER BY unix_time DESC, id DESC LIMIT 1 OFFSET ?;',
+                                         (friend_id, s['history_max_messages']))
+                if last is not None:
+                    self._delete_messages(report, 'friend_id = ? AND (unix_time, id) <= (?, ?)', (friend_id, ) + last)
+        if s['history_max_size']:
+            max_size = s['history_max_size'] * 1024 * 1024
+            count = None  # messages are counted once, then number of deleted messages is subtracted
+            while not self._stop_event.is_set():
+                size, free = self._db.get_size()
+                excess = size - free - max_size
+                if excess <= 0:
+                    break
+                if count is None:
+                    count = self._db.fetchone('SELECT count(*) FROM messages WHERE owner != 2;')[0]
+                if not count:
+                    break
+                # number of messages to delete is estimated using average size of message
+                limit = -(-excess * count // (size - free))
+                # messages were inserted in chronological order, so the oldest messages have the smallest ids
+                deleted = self._delete_messages(report, '1', (), limit, 'id')
+                if not deleted:
+                    break
+                count -= deleted
+                self._merge_index()
+                if incremental:
+                    self._vacuum()
+        if report:
+            self._merge_index()
+        if incremental:
+            self._vacuum()
+        self._report = {tox_id: report[friend_id] for friend_id, tox_id in friends if friend_id in report}
+        if self._report:
+            util.log('History compaction: {} messages deleted'.format(sum(map(lambda x: x[0], report.values()))))
+
+    def _delete_messages(self, report, condition, parameters, limit=None, order='unix_time, id'):
+        """
+        Deletes the oldest sent messages which match condition
+        :param report: dict which is updated with number of deleted messages and their size per friend
+        :param limit: max number of deleted messages or None
+        :return: number of deleted messages
+        """
+        deleted = 0
+        while not self._stop_event.is_set() and (limit is None or deleted < limit):
+            count = COMPACT_BATCH_SIZE if limit is None else min(COMPACT_BATCH_SIZE, limit - deleted)
+            with self._db.transaction() as cursor:
+                cursor.execute('SELECT id, friend_id, length(message) FROM messages WHERE owner != 2 AND ' +
+                               condition + ' ORDER BY ' + order + ' LIMIT ?;', parameters + (count, ))
+                rows = cursor.fetchall()
+                cursor.executemany('DELETE FROM messages WHERE id = ?;', map(lambda row: (row[0], ), rows))
+            for _, friend_id, length in rows:
+                messages, size = report.get(friend_id, (0, 0))
+                report[friend_id] = messages + 1, size + (length or 0)
+            deleted += len(rows)
+            if len(rows) < count:
+                break
+            self._stop_event.wait(COMPACT_PAUSE)
+        return deleted
+
+    def _merge_index(self):
+        """
+        Merges segments of full-text index step by step. Deleted messages take space in index until it's merged
+        """
+        if self._db.fetchone("SELECT 0 FROM sqlite_master WHERE name = 'messages_fts';") is None:
+            return
+        while not self._stop_event.is_set():
+            with self._db.transaction() as cursor:
+                cursor.execute('SELECT total_changes();')
+                changes = cursor.fetchone()[0]
+                cursor.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES ('merge', ?);",
+                               (-INDEX_MERGE_PAGES, ))
+                cursor.execute('SELECT total_changes();')
+                changes = cursor.fetchone()[0] - changes
+            if changes <= 1:  # only merge command itself, nothing to merge
+                return
+            self._stop_event.wait(COMPACT_PAUSE)
+
+    def _vacuum(self):
+        """
+        Returns free pages to file system step by step
+        """
+        free = None
+        while not self._stop_event.is_set():
+            last_free, free = free, self._db.get_size()[1]
+            if not free or free == last_free:
+                return
+            self._db.execute('PRAGMA incremental_vacuum({});'.format(VACUUM_PAGES))
+            self._stop_event.wait(COMPACT_PAUSE)
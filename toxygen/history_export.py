@@ -0,0 +1,128 @@
+from history import MESSAGE_OWNER
+from util import convert_time, log
+import threading
+import json
+
+
+FORMATS = {
+    'txt': 'Text',
+    'html': 'HTML',
+    'jsonl': 'JSON Lines'
+}
+
+
+class HistoryExporter:
+    """
+    Writes friend's history to file batch by batch, so whole history is never loaded in memory
+    """
+
+    def __init__(self, history, tox_id, friend_name, profile_name, fmt='txt', start=None, end=None, unsaved=()):
+        """
+        :param history: History instance or None - only unsaved messages are exported then
+        :param tox_id: friend's tox id
+        :param fmt: one of FORMATS
+        :param start: min unix_time of exported message or None
+        :param end: max unix_time of exported message (exclusive) or None
+        :param unsaved: list of messages which are not saved in db yet (newer than saved messages)
+        """
+        self._history = history
+        self._tox_id = tox_id
+        self._names = {MESSAGE_OWNER['FRIEND']: friend_name}
+        self._profile_name = profile_name
+        self._fmt = fmt
+        self._start, self._end = start, end
+        self._unsaved = list(filter(self._in_range, unsaved))
+        self._stop = False
+
+    def _in_range(self, message):
+        return (self._start is None or message[2] >= self._start) and (self._end is None or message[2] < self._end)
+
+    def _get_name(self, owner):
+        return self._names.get(owner, self._profile_name)
+
+    def _format(self, message):
+        text, owner, unix_time, message_type = message
+        if self._fmt == 'jsonl':
+            return json.dumps({'time': unix_time, 'author': self._get_name(owner), 'owner': owner,
+                               'type': message_type, 'message': text}, ensure_ascii=False) + '\n'
+        t = convert_time(unix_time) if owner != MESSAGE_OWNER['NOT_SENT'] else 'Unsent'
+        if self._fmt == 'txt':
+            return '[{}] {}: {}\n'.format(t, self._get_name(owner), text)
+        return '[{}] <b>{}:</b> {}<br>'.format(t, self._get_name(owner), text)
+
+    def _batches(self):
+        if self._history is not None:
+            yield from self._history.messages_iter(self._tox_id, self._start, self._end)
+        if self._unsaved:
+            yield self._unsaved
+
+    def count(self):
+        """
+        :return: number of messages which will be exported
+        """
+        if self._history is None:
+            return len(self._unsaved)
+        return self._history.count_messages(self._tox_id, self._start, self._end) + len(self._unsaved)
+
+    def stop(self):
+        self._stop = True
+
+    def write(self, fl, progress=None):
+        """
+        Writes history to file
+        :param fl: file opened in text mode
+        :param progress: callback, called after every batch with number of written messages
+        :return: number of written messages
+        """
+        separator = {'txt': '\n', 'html': '<br>', 'jsonl': ''}[self._fmt]
+        if self._fmt == 'html':
+            fl.write('<html><head><meta charset="UTF-8"><title>{}</title></head><body>'.format(
+                self._names[MESSAGE_OWNER['FRIEND']]))
+        count = 0
+        for batch in self._batches():
+            if self._stop:
+                break
+            lines = map(self._format, batch)
+            if count:
+                fl.write(separator)
+            fl.write(separator.join(lines))
+            count += len(batch)
+            if progress is not None:
+                progress(count)
+        if self._fmt == 'html':
+            fl.write('</body></html>')
+        return count
+
+
+class HistoryExportThread(threading.Thread):
+    """
+    Exports history to file in background. Callbacks are called from this thread
+    """
+
+    def __init__(self, exporter, path, progress=None, finished=None):
+        """
+        :param exporter: HistoryExporter instance
+        :param path: path to new file
+        :param progress: callback, gets number of written messages and total number of messages
+        :param finished: callback, gets number of written messages or None if export failed
+        """
+        super().__init__(daemon=True)
+        self._exporter = exporter
+        self._path = path
+        self._progress = progress
+        self._finished = finished
+
+    def stop(self):
+        self._exporter.stop()
+
+    def run(self):
+        count = None
+        try:
+            total = self._exporter.count()
+            progress = (lambda done: self._progress(done, total)) if self._progress is not None else None
+            with open(self._path, 'wt', encoding='utf-8') as fl:
+                count = self._exporter.write(fl, progress)
+        except Exception as ex:
+            log('History export failed: ' + str(ex))
+        if self._finished is not None:
+            self._finished(count)
@@ -4,18 +4,9 @@ from list_items import *
 
 class ItemsFactory:
 
-    def __init__(self, friends_list, messages):
-        self._friends = friends_list
+    def __init__(self, messages):
         self._messages = messages
 
-    def friend_item(self):
-        item = ContactItem()
-        elem = QtWidgets.QListWidgetItem(self._friends)
-        elem.setSizeHint(QtCore.QSize(250, item.height()))
-        self._friends.addItem(elem)
-        self._friends.setItemWidget(elem, item)
-        return item
-
     def message_item(self, text, time, name, sent, message_type, append, pixmap):
         item = MessageItem(text, time, name, sent, message_type, self._messages)
         if pixmap is not None:
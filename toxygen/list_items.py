@@ -212,36 +212,185 @@ class MessageItem(QtWidgets.QWidget):
         return text
 
 
-class ContactItem(QtWidgets.QWidget):
+CONTACT_ROLE = QtCore.Qt.UserRole  # role of contact instance in ContactsModel
+
+
+class ContactsModel(QtCore.QAbstractListModel):
+    """
+    Model of friends list. Rows are contacts from list of profile (the same list object is used), contacts are
+    painted by ContactDelegate, so friends list doesn't create widgets
+    """
+
+    def __init__(self, contacts, parent=None):
+        super().__init__(parent)
+        self._contacts = contacts
+        self._rows = {}  # id of contact - its row, all changes of rows are made by model
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._contacts)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._contacts):
+            return None
+        contact = self._contacts[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return contact.name
+        elif role == QtCore.Qt.ToolTipRole:
+            return contact.status_message
+        elif role == CONTACT_ROLE:
+            return contact
+        return None
+
+    def append(self, contact):
+        row = len(self._contacts)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._contacts.append(contact)
+        self._rows[id(contact)] = row
+        self.endInsertRows()
+
+    def remove(self, row):
+        """
+        :return: removed contact
+        """
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        contact = self._contacts.pop(row)
+        del self._rows[id(contact)]
+        self._update_rows(row, len(self._contacts))
+        self.endRemoveRows()
+        return contact
+
+    def move(self, row, new_row):
+        """
+        Moves one contact
+        :param row: current row of contact
+        :param new_row: row of contact after moving
+        """
+        if row == new_row:
+            return
+        destination = new_row + 1 if new_row > row else new_row  # row before which contact is inserted
+        self.beginMoveRows(QtCore.QModelIndex(), row, row, QtCore.QModelIndex(), destination)
+        self._contacts.insert(new_row, self._contacts.pop(row))
+        self._update_rows(min(row, new_row), max(row, new_row) + 1)
+        self.endMoveRows()
+
+    def sort_contacts(self, key):
+        """
+        Sorts all contacts. Selection and hidden rows of view are kept
+        """
+        old = list(self._contacts)
+        self._contacts.sort(key=key)
+        if old == self._contacts:
+            return
+        self.layoutAboutToBeChanged.emit()
+        self._update_rows(0, len(self._contacts))
+        indexes = self.persistentIndexList()
+        self.changePersistentIndexList(indexes, [self.index(self._rows[id(old[index.row()])]) for index in indexes])
+        self.layoutChanged.emit()
+
+    def _update_rows(self, start, end):
+        """
+        Updates rows of contacts in range [start, end)
+        """
+        for row in range(start, end):
+            self._rows[id(self._contacts[row])] = row
+
+    def get_row(self, contact):
+        """
+        :return: row of contact or None if contact is not in list
+        """
+        return self._rows.get(id(contact))
+
+    def contact_changed(self, contact):
+        """
+        Repaints row of contact
+        """
+        row = self.get_row(contact)
+        if row is None:  # contact is not in list yet
+            return
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+
+class ContactDelegate(QtWidgets.QStyledItemDelegate):
     """
-    Contact in friends list
+    Paints contact in friends list. Only visible rows are painted
     """
 
     def __init__(self, parent=None):
-        QtWidgets.QWidget.__init__(self, parent)
-        mode = settings.Settings.get_instance()['compact_mode']
-        self.setBaseSize(QtCore.QSize(250, 40 if mode else 70))
-        self.avatar_label = QtWidgets.QLabel(self)
+        super().__init__(parent)
+        self._compact = settings.Settings.get_instance()['compact_mode']
+        self._status_pixmaps = {}
+        self._name_font = QtGui.QFont()
+        self._name_font.setFamily(settings.Settings.get_instance()['font'])
+        self._name_font.setPointSize(10 if self._compact else 12)
+        self._name_font.setBold(True)
+        self._status_font = QtGui.QFont(self._name_font)
+        self._status_font.setPointSize(10)
+        self._status_font.setBold(False)
+        self._unread_font = QtGui.QFont(self._name_font)
+        self._unread_font.setPointSize(12)
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(250, 40 if self._compact else 70)
+
+    def _get_status_pixmap(self, status, unread):
+        if status == TOX_USER_STATUS['NONE']:
+            name = 'online'
+        elif status == TOX_USER_STATUS['AWAY']:
+            name = 'idle'
+        elif status == TOX_USER_STATUS['BUSY']:
+            name = 'busy'
+        else:
+            name = 'offline'
+        if unread:
+            name += '_notification'
+        if name not in self._status_pixmaps:
+            self._status_pixmaps[name] = QtGui.QPixmap(curr_directory() + '/images/{}.png'.format(name))
+        return self._status_pixmaps[name]
+
+    @staticmethod
+    def _draw_text(painter, font, rect, text):
+        text = ''.join('\u25AF' if len(bytes(c, 'utf-8')) >= 4 else c for c in text)
+        painter.setFont(font)
+        text = QtGui.QFontMetrics(font).elidedText(text, QtCore.Qt.ElideRight, rect.width())
+        painter.drawText(rect, QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, text)
+
+    def paint(self, painter, option, index):
+        contact = index.data(CONTACT_ROLE)
+        if contact is None:
+            return
+        widget = option.widget
+        style = widget.style() if widget is not None else QtWidgets.QApplication.style()
+        style.drawPrimitive(QtWidgets.QStyle.PE_PanelItemViewItem, option, painter, widget)
+        painter.save()
+        x, y, mode = option.rect.x(), option.rect.y(), self._compact
         size = 32 if mode else 64
-        self.avatar_label.setGeometry(QtCore.QRect(3, 4, size, size))
-        self.avatar_label.setScaledContents(False)
-        self.avatar_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.name = DataLabel(self)
-        self.name.setGeometry(QtCore.QRect(50 if mode else 75, 3 if mode else 10, 150, 15 if mode else 25))
-        font = QtGui.QFont()
-        font.setFamily(settings.Settings.get_instance()['font'])
-        font.setPointSize(10 if mode else 12)
-        font.setBold(True)
-        self.name.setFont(font)
-        self.status_message = DataLabel(self)
-        self.status_message.setGeometry(QtCore.QRect(50 if mode else 75, 20 if mode else 30, 170, 15 if mode else 20))
-        font.setPointSize(10)
-        font.setBold(False)
-        self.status_message.setFont(font)
-        self.connection_status = StatusCircle(self)
-        self.connection_status.setGeometry(QtCore.QRect(230, -2 if mode else 5, 32, 32))
-        self.messages = UnreadMessagesCount(self)
-        self.messages.setGeometry(QtCore.QRect(20 if mode else 52, 20 if mode else 50, 30, 20))
+        pixmap = contact.get_pixmap()
+        if pixmap is not None:
+            rect = QtCore.QRect(x + 3, y + 4, size, size)
+            left = rect.x() + (size - pixmap.width()) // 2
+            top = rect.y() + (size - pixmap.height()) // 2
+            painter.drawPixmap(left, top, pixmap)
+        painter.setPen(option.palette.color(QtGui.QPalette.Text))
+        left = x + (50 if mode else 75)
+        self._draw_text(painter, self._name_font, QtCore.QRect(left, y + (3 if mode else 10), 150, 15 if mode else 25),
+                        contact.name)
+        self._draw_text(painter, self._status_font,
+                        QtCore.QRect(left, y + (20 if mode else 30), 170, 15 if mode else 20), contact.status_message)
+        unread = contact.actions
+        status_x = x + 230 + (0 if unread else 2)
+        painter.drawPixmap(status_x, y + (-2 if mode else 5), self._get_status_pixmap(contact.status, unread))
+        messages = contact.messages
+        if messages:
+            rect = QtCore.QRect(x + (20 if mode else 52), y + (20 if mode else 50), 30, 20)
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            painter.setPen(QtCore.Qt.NoPen)
+            painter.setBrush(QtGui.QColor(settings.Settings.get_instance()['unread_color']))
+            painter.drawRoundedRect(rect, 10, 10)
+            painter.setPen(QtGui.QColor('white'))
+            painter.setFont(self._unread_font)
+            painter.drawText(rect, QtCore.Qt.AlignCenter, str(messages))
+        painter.restore()
 
 
 class StatusCircle(QtWidgets.QWidget):
@@ -277,33 +426,6 @@ class StatusCircle(QtWidgets.QWidget):
         self.label.setPixmap(pixmap)
 
 
-class UnreadMessagesCount(QtWidgets.QWidget):
-
-    def __init__(self, parent=None):
-        super(UnreadMessagesCount, self).__init__(parent)
-        self.resize(30, 20)
-        self.label = QtWidgets.QLabel(self)
-        self.label.setGeometry(QtCore.QRect(0, 0, 30, 20))
-        self.label.setVisible(False)
-        font = QtGui.QFont()
-        font.setFamily(settings.Settings.get_instance()['font'])
-        font.setPointSize(12)
-        font.setBold(True)
-        self.label.setFont(font)
-        self.label.setAlignment(QtCore.Qt.AlignVCenter | QtCore.Qt.AlignCenter)
-        color = settings.Settings.get_instance()['unread_color']
-        self.label.setStyleSheet('QLabel { color: white; background-color: ' + color + '; border-radius: 10; }')
-
-    def update(self, messages_count):
-        color = settings.Settings.get_instance()['unread_color']
-        self.label.setStyleSheet('QLabel { color: white; background-color: ' + color + '; border-radius: 10; }')
-        if messages_count:
-            self.label.setVisible(True)
-            self.label.setText(str(messages_count))
-        else:
-            self.label.setVisible(False)
-
-
 class FileTransferItem(QtWidgets.QListWidget):
 
     def __init__(self, file_name, size, time, user, friend_number, file_number, state, width, parent=None):
@@ -428,11 +550,15 @@ class FileTransferItem(QtWidgets.QListWidget):
         self.accept_or_pause.setIcon(icon)
         self.accept_or_pause.setIconSize(QtCore.QSize(30, 30))
 
-    def update_transfer_state(self, state, progress, time):
+    def update_transfer_state(self, state, progress, time, speed=0.):
         self.pb.setValue(int(progress * 100))
         if time + 1:
             m, s = divmod(time, 60)
             self.time_left.setText('{0:02d}:{1:02d}'.format(m, s))
+        if speed >= 1024 * 1024:
+            self.pb.setToolTip('{:.1f} MB/s'.format(speed / (1024 * 1024)))
+        elif speed:
+            self.pb.setToolTip('{} KB/s'.format(int(speed // 1024)))
         if self.state != state and self.state in ACTIVE_FILE_TRANSFERS:
             if state == TOX_FILE_TRANSFER_STATE['CANCELLED']:
                 self.setStyleSheet('QListWidget { border: 1px solid #B40404; }')
@@ -6,6 +6,10 @@ import plugin_support
 from mainscreen_widgets import *
 import settings
 import toxes
+from callbacks import invoke_in_main_thread
+
+
+FILTER_DELAY = 200  # ms after the last key press in contacts filter
 
 
 class MainWindow(QtWidgets.QMainWindow, Singleton):
@@ -187,7 +191,11 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.contact_name = LineEdit(Form)
         self.contact_name.setGeometry(QtCore.QRect(0, 0, 150, 25))
         self.contact_name.setObjectName("contact_name")
-        self.contact_name.textChanged.connect(self.filtering)
+        self.filter_timer = QtCore.QTimer(Form)  # friends list is filtered when user stops typing
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY)
+        self.filter_timer.timeout.connect(self.filtering)
+        self.contact_name.textChanged.connect(lambda x: self.filter_timer.start())
 
         self.online_contacts = ComboBox(Form)
         self.online_contacts.setGeometry(QtCore.QRect(150, 0, 120, 25))
@@ -267,9 +275,10 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         QtCore.QMetaObject.connectSlotsByName(Form)
 
     def setup_left_center(self, widget):
-        self.friends_list = QtWidgets.QListWidget(widget)
+        self.friends_list = QtWidgets.QListView(widget)
         self.friends_list.setObjectName("friends_list")
         self.friends_list.setGeometry(0, 0, 270, 310)
+        self.friends_list.setUniformItemSizes(True)
         self.friends_list.clicked.connect(self.friend_click)
         self.friends_list.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.friends_list.customContextMenuRequested.connect(self.friend_right_click)
@@ -400,7 +409,7 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         elif event.key() == QtCore.Qt.Key_C and event.modifiers() & QtCore.Qt.ControlModifier and self.messages.selectedIndexes():
             rows = list(map(lambda x: self.messages.row(x), self.messages.selectedItems()))
             indexes = (rows[0] - self.messages.count(), rows[-1] - self.messages.count())
-            s = self.profile.export_history(self.profile.active_friend, True, indexes)
+            s = self.profile.export_messages(self.profile.active_friend, indexes)
             clipboard = QtWidgets.QApplication.clipboard()
             clipboard.setText(s)
         elif event.key() == QtCore.Qt.Key_Z and event.modifiers() & QtCore.Qt.ControlModifier and self.messages.selectedIndexes():
@@ -579,15 +588,15 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
     # -----------------------------------------------------------------------------------------------------------------
 
     def friend_right_click(self, pos):
-        item = self.friends_list.itemAt(pos)
-        num = self.friends_list.indexFromItem(item).row()
+        index = self.friends_list.indexAt(pos)
+        num = index.row()
         friend = Profile.get_instance().get_friend(num)
         if friend is None:
             return
         settings = Settings.get_instance()
-        allowed = friend.tox_id in settings['auto_accept_from_friends']
+        allowed = settings.get_contact_value(friend.tox_id, 'auto_accept', False)
         auto = QtWidgets.QApplication.translate("MainWindow", 'Disallow auto accept') if allowed else QtWidgets.QApplication.translate("MainWindow", 'Allow auto accept')
-        if item is not None:
+        if index.isValid():
             self.listMenu = QtWidgets.QMenu()
             is_friend = type(friend) is Friend
             if is_friend:
@@ -598,6 +607,8 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
             clear_history_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Clear history'))
             export_to_text_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as text'))
             export_to_html_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Export as HTML'))
+            export_to_json_item = history_menu.addAction(QtWidgets.QApplication.translate("MainWindow",
+                                                                                          'Export as JSON Lines'))
 
             copy_menu = self.listMenu.addMenu(QtWidgets.QApplication.translate("MainWindow", 'Copy'))
             copy_name_item = copy_menu.addAction(QtWidgets.QApplication.translate("MainWindow", 'Name'))
@@ -638,28 +649,25 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
             copy_name_item.triggered.connect(lambda: self.copy_name(friend))
             copy_status_item.triggered.connect(lambda: self.copy_status(friend))
             export_to_text_item.triggered.connect(lambda: self.export_history(num))
-            export_to_html_item.triggered.connect(lambda: self.export_history(num, False))
+            export_to_html_item.triggered.connect(lambda: self.export_history(num, 'html'))
+            export_to_json_item.triggered.connect(lambda: self.export_history(num, 'jsonl'))
             parent_position = self.friends_list.mapToGlobal(QtCore.QPoint(0, 0))
             self.listMenu.move(parent_position + pos)
             self.listMenu.show()
 
     def show_note(self, friend):
         s = Settings.get_instance()
-        note = s['notes'][friend.tox_id] if friend.tox_id in s['notes'] else ''
+        note = s.get_contact_value(friend.tox_id, 'note', '')
         user = QtWidgets.QApplication.translate("MainWindow", 'Notes about user')
         user = '{} {}'.format(user, friend.name)
 
         def save_note(text):
-            if friend.tox_id in s['notes']:
-                del s['notes'][friend.tox_id]
-            if text:
-                s['notes'][friend.tox_id] = text
+            s.set_contact_value(friend.tox_id, 'note', text)
             s.save()
         self.note = MultilineEdit(user, note, save_note)
         self.note.show()
 
-    def export_history(self, num, as_text=True):
-        s = self.profile.export_history(num, as_text)
+    def export_history(self, num, fmt='txt'):
         directory = QtWidgets.QFileDialog.getExistingDirectory(None,
                                                            QtWidgets.QApplication.translate("MainWindow",
                                                                                             'Choose folder'),
@@ -667,9 +675,21 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
                                                            QtWidgets.QFileDialog.ShowDirsOnly | QtWidgets.QFileDialog.DontUseNativeDialog)
 
         if directory:
-            name = 'exported_history_{}.{}'.format(convert_time(time.time()), 'txt' if as_text else 'html')
-            with open(directory + '/' + name, 'wt') as fl:
-                fl.write(s)
+            name = 'exported_history_{}.{}'.format(convert_time(time.time()), fmt)
+            progress_dialog = QtWidgets.QProgressDialog(QtWidgets.QApplication.translate("MainWindow",
+                                                                                         'Exporting history...'),
+                                                        QtWidgets.QApplication.translate("MainWindow", 'Cancel'),
+                                                        0, 0, self)
+            progress_dialog.setMinimumDuration(500)
+
+            def progress(done, total):
+                progress_dialog.setMaximum(total)
+                progress_dialog.setValue(done)
+
+            thread = self.profile.export_history_to_file(num, directory + '/' + name, fmt,
+                                                         progress=lambda *args: invoke_in_main_thread(progress, *args),
+                                                         finished=lambda _: invoke_in_main_thread(progress_dialog.reset))
+            progress_dialog.canceled.connect(thread.stop)
 
     def set_alias(self, num):
         self.profile.set_alias(num)
@@ -706,10 +726,7 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
     def auto_accept(self, num, value):
         settings = Settings.get_instance()
         tox_id = self.profile.friend_public_key(num)
-        if value:
-            settings['auto_accept_from_friends'].append(tox_id)
-        else:
-            settings['auto_accept_from_friends'].remove(tox_id)
+        settings.set_contact_value(tox_id, 'auto_accept', value)
         settings.save()
 
     def invite_friend_to_gc(self, friend_number, group_number):
@@ -721,6 +738,8 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
 
     def friend_click(self, index):
         num = index.row()
+        if hasattr(self, 'search_field'):  # page of history of previous friend
+            self.search_field.hide_page()
         self.profile.set_active(num)
 
     def mouseReleaseEvent(self, event):
@@ -736,6 +755,7 @@ class MainWindow(QtWidgets.QMainWindow, Singleton):
         self.profile.update()
 
     def filtering(self):
+        self.filter_timer.stop()
         ind = self.online_contacts.currentIndex()
         d = {0: 0, 1: 1, 2: 2, 3: 4, 4: 1 | 4, 5: 2 | 4}
         self.profile.filtration_and_sorting(d[ind], self.contact_name.text())
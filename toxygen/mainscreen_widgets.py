@@ -369,6 +369,7 @@ class SearchScreen(QtWidgets.QWidget):
         self.setMaximumSize(width, 40)
         self.setMinimumSize(width, 40)
         self._messages = messages
+        self._page = None  # list with page of not loaded history which contains found message
 
         self.search_text = LineEdit(self)
         self.search_text.setGeometry(0, 0, width - 160, 40)
@@ -417,6 +418,7 @@ class SearchScreen(QtWidgets.QWidget):
 
     def search(self):
         Profile.get_instance().update()
+        Profile.get_instance().flush_updates()  # messages are used below
         text = self.search_text.text()
         friend = Profile.get_instance().get_curr_friend()
         if text and friend and util.is_re_valid(text):
@@ -431,34 +433,54 @@ class SearchScreen(QtWidgets.QWidget):
 
     def next(self):
         friend = Profile.get_instance().get_curr_friend()
-        text = self.search_text.text()
         if friend is not None:
             index = friend.search_next()
-            if index is not None:
-                count = self._messages.count()
-                index += count
-                item = self._messages.item(index)
-                self._messages.scrollToItem(item)
-                self._messages.itemWidget(item).select_text(text)
-            else:
-                self.not_found(text)
+            self.load_messages(index)
 
     def load_messages(self, index):
+        """
+        Shows found message. Message which is not loaded is shown on page of history over messages list
+        """
         text = self.search_text.text()
-        if index is not None:
-            profile = Profile.get_instance()
-            count = self._messages.count()
-            while count + index < 0:
-                profile.load_history()
-                count = self._messages.count()
-            index += count
-            item = self._messages.item(index)
-            self._messages.scrollToItem(item)
-            self._messages.itemWidget(item).select_text(text)
-        else:
+        if index is None:
             self.not_found(text)
+            return
+        profile = Profile.get_instance()
+        page = profile.get_curr_friend().get_search_page()
+        if page is not None:
+            self._show_page(page)
+            messages = self._page
+        else:
+            self.hide_page()
+            messages = self._messages
+            if messages.count() + index < 0:  # loaded, but not shown yet
+                profile.load_history(-index - messages.count())
+            index += messages.count()
+        item = messages.item(index)
+        messages.scrollToItem(item)
+        messages.itemWidget(item).select_text(text)
+
+    def _show_page(self, messages):
+        if self._page is None:
+            self._page = QtWidgets.QListWidget(self._messages.parent())
+            self._page.setObjectName("messages")
+            self._page.setSpacing(1)
+            self._page.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
+            self._page.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+            self._page.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self._page.setGeometry(self._messages.geometry())
+        Profile.get_instance().create_history_page(self._page, messages)
+        self._page.show()
+        self._page.raise_()
+
+    def hide_page(self):
+        if self._page is not None:
+            self._page.hide()
 
     def closeEvent(self, *args):
+        if self._page is not None:
+            self._page.deleteLater()
+            self._page = None
         Profile.get_instance().update()
         self._messages.setGeometry(0, 0, self._messages.width(), self._messages.height() + 40)
         super().closeEvent(*args)
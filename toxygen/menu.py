@@ -212,6 +212,7 @@ class ProfileSettings(CenteredWidget):
             if not len(self.password.text()) or len(self.password.text()) >= 8:
                 e = toxes.ToxES.get_instance()
                 e.set_password(self.password.text())
+                Profile.get_instance().change_history_password()
                 self.close()
             else:
                 self.not_match.setText(
@@ -422,7 +423,7 @@ class PrivacySettings(CenteredWidget):
         self.blocked_users_label.setGeometry(QtCore.QRect(10, 470, 350, 30))
         self.comboBox = QtWidgets.QComboBox(self)
         self.comboBox.setGeometry(QtCore.QRect(10, 500, 350, 30))
-        self.comboBox.addItems(settings['blocked'])
+        self.comboBox.addItems(settings.get_contacts_with('blocked'))
         self.unblock = QtWidgets.QPushButton(self)
         self.unblock.setGeometry(QtCore.QRect(10, 540, 350, 30))
         self.unblock.clicked.connect(lambda: self.unblock_user())
@@ -1,3 +1,6 @@
+from array import array
+from bisect import bisect_left
+import sys
 
 
 MESSAGE_TYPE = {
@@ -10,9 +13,15 @@ MESSAGE_TYPE = {
     'GC_ACTION': 6
 }
 
+TEXT_TYPES = (MESSAGE_TYPE['TEXT'], MESSAGE_TYPE['ACTION'], MESSAGE_TYPE['GC_TEXT'], MESSAGE_TYPE['GC_ACTION'])
+
+STORED_BY_COLUMNS = TEXT_TYPES + (MESSAGE_TYPE['INFO_MESSAGE'], )
+
 
 class Message:
 
+    __slots__ = ('_time', '_type', '_owner')
+
     def __init__(self, message_type, owner, time):
         self._time = time
         self._type = message_type
@@ -24,6 +33,9 @@ class Message:
     def get_owner(self):
         return self._owner
 
+    def get_time(self):
+        return self._time
+
     def mark_as_sent(self):
         self._owner = 0
 
@@ -33,6 +45,8 @@ class TextMessage(Message):
     Plain text or action message
     """
 
+    __slots__ = ('_message', )
+
     def __init__(self, message, owner, time, message_type):
         super(TextMessage, self).__init__(message_type, owner, time)
         self._message = message
@@ -43,6 +57,8 @@ class TextMessage(Message):
 
 class GroupChatMessage(TextMessage):
 
+    __slots__ = ('_user_name', )
+
     def __init__(self, message, owner, time, message_type, name):
         super().__init__(message, owner, time, message_type)
         self._user_name = name
@@ -56,6 +72,8 @@ class TransferMessage(Message):
     Message with info about file transfer
     """
 
+    __slots__ = ('_status', '_size', '_file_name', '_friend_number', '_file_number')
+
     def __init__(self, owner, time, status, size, name, friend_number, file_number):
         super(TransferMessage, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], owner, time)
         self._status = status
@@ -83,6 +101,9 @@ class TransferMessage(Message):
 
 
 class UnsentFile(Message):
+
+    __slots__ = ('_data', '_path')
+
     def __init__(self, path, data, time):
         super(UnsentFile, self).__init__(MESSAGE_TYPE['FILE_TRANSFER'], 0, time)
         self._data, self._path = data, path
@@ -99,6 +120,8 @@ class InlineImage(Message):
     Inline image
     """
 
+    __slots__ = ('_data', )
+
     def __init__(self, data):
         super(InlineImage, self).__init__(MESSAGE_TYPE['INLINE'], None, None)
         self._data = data
@@ -109,5 +132,178 @@ class InlineImage(Message):
 
 class InfoMessage(TextMessage):
 
+    __slots__ = ()
+
     def __init__(self, message, time):
         super(InfoMessage, self).__init__(message, None, time, MESSAGE_TYPE['INFO_MESSAGE'])
+
+
+class Correspondence:
+    """
+    Messages of contact. Text messages are stored by columns: times, owners and types in arrays, interned texts in
+    list. Message objects for them are created on access only. Other messages (file transfers, inline images) are
+    stored as objects. Every message gets key - number which doesn't change while message exists. Keys grow from the
+    oldest message to the newest one, so message can be found by key using binary search
+    """
+
+    __slots__ = ('_keys', '_times', '_owners', '_types', '_texts', '_objects', '_first_key', '_last_key')
+
+    def __init__(self, messages=()):
+        self._keys = array('d')
+        self._first_key, self._last_key = 0., -1.  # keys of deleted messages are never reused
+        self._times = array('d')  # nan if message has no time
+        self._owners = array('b')  # -1 if message has no owner
+        self._types = array('b')
+        self._texts = []  # text of message or None for non-text messages
+        self._objects = []  # peer name for group chat messages, message object for non-text messages, else None
+        self.extend(messages)
+
+    @staticmethod
+    def _columns(messages):
+        """
+        Splits messages into columns
+        """
+        times, owners, types, texts, objects = array('d'), array('b'), array('b'), [], []
+        for message in messages:
+            t, owner, message_type = message.get_time(), message.get_owner(), message.get_type()
+            times.append(float('nan') if t is None else t)
+            owners.append(-1 if owner is None else owner)
+            types.append(message_type)
+            if message_type in STORED_BY_COLUMNS:  # classified by type, class of message can be a subclass
+                data = message.get_data()
+                texts.append(sys.intern(data[0]))
+                objects.append(sys.intern(data[4]) if len(data) > 4 else None)  # group chat message has peer name
+            else:
+                texts.append(None)
+                objects.append(message)
+        return times, owners, types, texts, objects
+
+    def _message(self, i):
+        """
+        :return: message object for i-th message
+        """
+        text, obj = self._texts[i], self._objects[i]
+        if text is None:
+            return obj
+        t, owner, message_type = self._times[i], self._owners[i], self._types[i]
+        if message_type == MESSAGE_TYPE['INFO_MESSAGE']:
+            return InfoMessage(text, t)
+        if obj is not None:
+            return GroupChatMessage(text, owner, t, message_type, obj)
+        return TextMessage(text, owner, t, message_type)
+
+    def __len__(self):
+        return len(self._types)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(map(self._message, range(len(self))[key]))
+        return self._message(key)
+
+    def __iter__(self):
+        return map(self._message, range(len(self)))
+
+    def __delitem__(self, i):
+        for column in (self._keys, self._times, self._owners, self._types, self._texts, self._objects):
+            del column[i]
+
+    def append(self, message):
+        self.extend((message, ))
+
+    def extend(self, messages):
+        count = len(self)
+        for column, values in zip((self._times, self._owners, self._types, self._texts, self._objects),
+                                  self._columns(messages)):
+            column.extend(values)
+        count = len(self) - count
+        self._keys.extend(map(float, range(int(self._last_key) + 1, int(self._last_key) + 1 + count)))
+        self._last_key += count
+
+    def extend_left(self, messages):
+        """
+        Adds messages to the beginning
+        """
+        times, owners, types, texts, objects = self._columns(messages)
+        self._times, self._owners, self._types = times + self._times, owners + self._owners, types + self._types
+        self._texts, self._objects = texts + self._texts, objects + self._objects
+        count = len(types)
+        self._keys = array('d', map(float, range(int(self._first_key) - count, int(self._first_key)))) + self._keys
+        self._first_key -= count
+
+    def insert(self, i, message):
+        if i < 0:
+            i += len(self)
+        if i >= len(self):
+            return self.append(message)
+        if i <= 0:
+            return self.extend_left((message, ))
+        key = (self._keys[i - 1] + self._keys[i]) / 2
+        self._keys.insert(i, key)
+        for column, values in zip((self._times, self._owners, self._types, self._texts, self._objects),
+                                  self._columns((message, ))):
+            column.insert(i, values[0])
+
+    def retain(self, predicate):
+        """
+        Deletes messages for which predicate(index of message) is false
+        """
+        indexes = list(filter(predicate, range(len(self))))
+        self._keys = array('d', map(self._keys.__getitem__, indexes))
+        self._times = array('d', map(self._times.__getitem__, indexes))
+        self._owners = array('b', map(self._owners.__getitem__, indexes))
+        self._types = array('b', map(self._types.__getitem__, indexes))
+        self._texts = list(map(self._texts.__getitem__, indexes))
+        self._objects = list(map(self._objects.__getitem__, indexes))
+
+    def index(self, message):
+        """
+        :return: index of non-text message object
+        """
+        return self._objects.index(message)
+
+    def find(self, key):
+        """
+        :return: index of message with given key or None if message was deleted
+        """
+        i = bisect_left(self._keys, key)
+        return i if i < len(self._keys) and self._keys[i] == key else None
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Columns
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def get_key(self, i):
+        return self._keys[i]
+
+    def get_time(self, i):
+        t = self._times[i]
+        return t if t == t else None
+
+    def get_owner(self, i):
+        owner = self._owners[i]
+        return owner if owner >= 0 else None
+
+    def set_owner(self, i, owner):
+        self._owners[i] = owner
+
+    def get_type(self, i):
+        return self._types[i]
+
+    def get_text(self, i):
+        """
+        :return: text of message or None if it's not text message
+        """
+        return self._texts[i]
+
+    def get_data(self, i):
+        """
+        :return: data of text message in format of TextMessage.get_data()
+        """
+        return self._texts[i], self._owners[i], self._times[i], self._types[i]
+
+    def min_time(self):
+        """
+        :return: time of the oldest message or None
+        """
+        times = [t for t in self._times if t == t]
+        return min(times) if times else None
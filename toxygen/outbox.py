@@ -0,0 +1,220 @@
+from PyQt5 import QtCore
+from toxcore_enums_and_consts import TOX_MAX_MESSAGE_LENGTH
+from messages import UnsentFile
+from util import Singleton, log
+from collections import deque
+import itertools
+import time
+
+
+OUTBOX_INTERVAL = 100  # ms between sending rounds
+
+PARTS_PER_ROUND = 8  # max number of message parts sent to one friend in one round
+
+SEND_QUEUE_BUDGET = 64  # max number of message parts without read receipt per friend
+
+FILES_DELAY = 5  # seconds between friend's connection and sending of files
+
+
+def split_message(message):
+    """
+    Message splitting in one pass. Message length cannot be > TOX_MAX_MESSAGE_LENGTH. Message is split after space,
+    comma or dot in the last fifth of part if possible
+    :param message: message text (bytes)
+    :return: generator of parts
+    """
+    size = TOX_MAX_MESSAGE_LENGTH * 4 // 5
+    start = 0
+    while len(message) - start > TOX_MAX_MESSAGE_LENGTH:
+        end = start + TOX_MAX_MESSAGE_LENGTH
+        for separator in (b' ', b',', b'.'):
+            index = message.find(separator, start + size, end)
+            if index != -1:
+                break
+        else:
+            index = end - 1
+        yield message[start:index + 1]
+        start = index + 1
+    yield message[start:]
+
+
+class PendingMessage:
+    """
+    Text message in outbox. Parts of message are created on sending
+    """
+
+    def __init__(self, time, message_type, text):
+        self._time = time
+        self._message_type = message_type
+        self._parts = split_message(text.encode('utf-8'))
+        self._part = next(self._parts)
+
+    def get_time(self):
+        return self._time
+
+    def get_message_type(self):
+        return self._message_type
+
+    def get_part(self):
+        """
+        :return: next part for sending or None if all parts were sent
+        """
+        return self._part
+
+    def part_sent(self):
+        """
+        :return: True if the last part was sent
+        """
+        self._part = next(self._parts, None)
+        return self._part is None
+
+
+class Outbox(Singleton):
+    """
+    Sends pending messages and files to friends. Every friend has queue of pending items, items are sent in order
+    when friend is online. Every item is sent at most once per connection session. Number of message parts sent in one
+    round and number of parts without read receipt are limited per friend
+    """
+
+    def __init__(self, tox, profile):
+        super().__init__()
+        self._tox = tox
+        self._profile = profile
+        self._queues = {}  # friend number - deque of PendingMessage and UnsentFile
+        self._sessions = {}  # friend number - [session id, start time, times of items attempted in session]
+        self._in_flight = {}  # friend number - number of sent message parts without read receipt
+        self._session_id = itertools.count()
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self._send_round)
+
+    def set_tox(self, tox):
+        self._tox = tox
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Sessions
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def friend_online(self, friend_number):
+        """
+        Friend connected - new session starts, all pending items are queued
+        """
+        if friend_number in self._sessions:  # already in this session
+            return
+        session_id = next(self._session_id)
+        self._sessions[friend_number] = [session_id, time.time(), set()]
+        self._in_flight[friend_number] = 0
+        friend = self._profile.get_friend_by_number(friend_number)
+        friend.load_corr()
+        friend.remove_invalid_unsent_files()
+        messages = map(lambda m: PendingMessage(m.get_data()[2], m.get_data()[3], m.get_data()[0]),
+                       filter(lambda m: m.get_type() <= 1, friend.get_unsent_messages()))
+        items = sorted(itertools.chain(messages, friend.get_unsent_files()), key=lambda item: item.get_time())
+        self._queues[friend_number] = deque(items)
+        QtCore.QTimer.singleShot(FILES_DELAY * 1000, lambda: self._resume_transfers(friend_number, session_id))
+        self._send(friend_number)
+        self._start()
+
+    def friend_offline(self, friend_number):
+        """
+        Friend disconnected - not sent items will be sent in the next session
+        """
+        self._sessions.pop(friend_number, None)
+        self._queues.pop(friend_number, None)
+        self._in_flight.pop(friend_number, None)
+
+    def receipt(self, friend_number):
+        """
+        Read receipt for message part received
+        """
+        if self._in_flight.get(friend_number):
+            self._in_flight[friend_number] -= 1
+            self._start()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Queueing
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def add_message(self, friend_number, unix_time, message_type, text):
+        """
+        Queues message if friend is online. Otherwise message will be sent in the next session
+        """
+        self._add(friend_number, PendingMessage(unix_time, message_type, text))
+
+    def _add(self, friend_number, item):
+        if friend_number not in self._sessions or item.get_time() in self._sessions[friend_number][2]:
+            return  # item will be sent in the next session
+        self._queues[friend_number].append(item)
+        self._send(friend_number)
+        self._start()
+
+    def get_pending_count(self, friend_number):
+        """
+        :return: number of items which will be sent in current session
+        """
+        return len(self._queues.get(friend_number, ()))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # Sending
+    # -----------------------------------------------------------------------------------------------------------------
+
+    def _start(self):
+        if not self._timer.isActive() and any(self._queues.values()):
+            self._timer.start(OUTBOX_INTERVAL)
+
+    def _send_round(self):
+        for friend_number in list(self._queues.keys()):
+            self._send(friend_number)
+        if not any(self._queues.values()):
+            self._timer.stop()
+
+    def _send(self, friend_number):
+        """
+        Sends items from the beginning of friend's queue within limits
+        """
+        queue, session = self._queues[friend_number], self._sessions[friend_number]
+        parts = 0
+        while queue and parts < PARTS_PER_ROUND:
+            item = queue[0]
+            try:
+                if type(item) is UnsentFile:
+                    if time.time() < session[1] + FILES_DELAY:
+                        break
+                    queue.popleft()
+                    session[2].add(item.get_time())
+                    self._send_file(friend_number, item)
+                    parts += 1
+                else:
+                    if self._in_flight[friend_number] >= SEND_QUEUE_BUDGET:
+                        break
+                    try:
+                        message_id = self._tox.friend_send_message(friend_number, item.get_message_type(),
+                                                                   item.get_part())
+                    except MemoryError:  # toxcore send queue is full, try in the next round
+                        break
+                    session[2].add(item.get_time())
+                    self._in_flight[friend_number] += 1
+                    parts += 1
+                    last = item.part_sent()
+                    self._profile.get_friend_by_number(friend_number).add_receipts(item.get_time(), [message_id],
+                                                                                 last)
+                    if last:
+                        queue.popleft()
+            except Exception as ex:  # only failed item is removed, it stays unsent and is sent in the next session
+                log('Sending of pending item failed with ' + str(ex))
+                session[2].add(item.get_time())
+                if queue and queue[0] is item:
+                    queue.popleft()
+
+    def _send_file(self, friend_number, message):
+        data = message.get_data()
+        if data[1] is not None:
+            self._profile.send_inline(data[1], data[0], friend_number, True)
+        else:
+            self._profile.send_file(data[0], friend_number, True)
+        self._profile.get_friend_by_number(friend_number).delete_one_unsent_file(message.get_time())
+        if friend_number == self._profile.get_active_number() and self._profile.is_active_a_friend():
+            self._profile.update()
+
+    def _resume_transfers(self, friend_number, session_id):
+        if friend_number in self._sessions and self._sessions[friend_number][0] == session_id:
+            self._profile.resume_transfers(friend_number)
@@ -121,9 +121,9 @@ class PluginLoader(util.Singleton):
             plugin[0].start()
         plugin[1] = not plugin[1]
         if plugin[1]:
-            self._settings['plugins'].append(key)
+            self._settings['plugins'] = self._settings['plugins'] + [key]
         else:
-            self._settings['plugins'].remove(key)
+            self._settings['plugins'] = [name for name in self._settings['plugins'] if name != key]
         self._settings.save()
 
     def command(self, text):
@@ -17,7 +17,12 @@ import items_factory
 import cv2
 import threading
 from group_chat import *
+from history_export import HistoryExporter, HistoryExportThread
+from outbox import Outbox
+from refresh import RefreshScheduler, CONTACTS_LIST, HEADER, MESSAGES_PAGE
+from contacts_index import ContactsIndex
 import re
+import io
 
 
 class Profile(basecontact.BaseContact, Singleton):
@@ -43,36 +48,42 @@ class Profile(basecontact.BaseContact, Singleton):
         self._call_widgets = {}  # dict of incoming call widgets
         self._incoming_calls = set()
         self._load_history = True
+        self._unsent_items = {}  # widgets of unsent messages of active friend. key - time of message
         self._waiting_for_reconnection = False
-        self._factory = items_factory.ItemsFactory(self._screen.friends_list, self._messages)
+        self._factory = items_factory.ItemsFactory(self._messages)
+        self._scheduler = RefreshScheduler(self._refresh)
         settings = Settings.get_instance()
         self._sorting = settings['sorting']
         self._show_avatars = settings['show_avatars']
-        self._filter_string = ''
-        self._friend_item_height = 40 if settings['compact_mode'] else 70
+        self._filter_string, self._filtered = '', None  # filtered - set of contacts matching filter string or None
+        self._contacts_index = ContactsIndex()
         self._paused_file_transfers = dict(settings['paused_file_transfers'])
         # key - file id, value: [path, friend number, is incoming, start position]
         screen.online_contacts.setCurrentIndex(int(self._sorting))
-        aliases = settings['friends_aliases']
         data = tox.self_get_friend_list()
         self._history = History(tox.self_get_public_key())  # connection to db
         self._contacts, self._active_friend = [], -1
+        self._contacts_model = ContactsModel(self._contacts)
+        screen.friends_list.setModel(self._contacts_model)
+        screen.friends_list.setItemDelegate(ContactDelegate(screen.friends_list))
+        self._friends, self._groups, self._tox_ids = {}, {}, {}  # indexes of contacts: number / public key - contact
         for i in data:  # creates list of friends
             tox_id = tox.friend_get_public_key(i)
-            try:
-                alias = list(filter(lambda x: x[0] == tox_id, aliases))[0][1]
-            except:
-                alias = ''
-            item = self.create_friend_item()
+            alias = settings.get_contact_value(tox_id, 'alias', '')
             name = alias or tox.friend_get_name(i) or tox_id
             status_message = tox.friend_get_status_message(i)
             if not self._history.friend_exists_in_db(tox_id):
                 self._history.add_friend_to_db(tox_id)
             message_getter = self._history.messages_getter(tox_id)
-            friend = Friend(message_getter, i, name, status_message, item, tox_id)
+            friend = Friend(message_getter, i, name, status_message, self._contacts_model, tox_id)
             friend.set_alias(alias)
-            self._contacts.append(friend)
-        self.filtration_and_sorting(self._sorting)
+            for path in settings['unsent_files'].get(tox_id, []):  # files are newer than history
+                friend.append_message(UnsentFile(path, None, time.time()))
+            self._add_contact(friend)
+            if alias:  # friend can be found by its name too
+                self._contacts_index.update(friend, tox.friend_get_name(i))
+        self._outbox = Outbox(tox, self)
+        self._sort_and_filter()
 
     # -----------------------------------------------------------------------------------------------------------------
     # Edit current user's data
@@ -126,61 +137,126 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         Filtration of friends list
         :param sorting: 0 - no sort, 1 - online only, 2 - online first, 4 - by name
-        :param filter_str: show contacts which name contains this substring
+        :param filter_str: show contacts which name or alias contains this substring or public key starts with it
         """
-        filter_str = filter_str.lower()
-        settings = Settings.get_instance()
+        sort = sorting != self._sorting  # contacts are already sorted if only filter string was changed
+        self._sorting, self._filter_string = sorting, filter_str
+        self._filtered = self._contacts_index.search(filter_str)
+        self._sort_and_filter(sort)
+        Settings.get_instance()['sorting'] = sorting  # will be saved with other settings
+
+    def _sort_and_filter(self, sort=True):
+        """
+        Sorts all contacts and updates their visibility
+        """
+        sort = sort or self._scheduler.is_dirty(CONTACTS_LIST)  # changed contacts are not moved yet
+        self._scheduler.cancel(CONTACTS_LIST)
         number = self.get_active_number()
         is_friend = self.is_active_a_friend()
-        if sorting > 1:
-            if sorting & 2:
-                self._contacts = sorted(self._contacts, key=lambda x: int(x.status is not None), reverse=True)
-            if sorting & 4:
-                if not sorting & 2:
-                    self._contacts = sorted(self._contacts, key=lambda x: x.name.lower())
-                else:  # save results of prev sorting
-                    online_friends = filter(lambda x: x.status is not None, self._contacts)
-                    count = len(list(online_friends))
-                    part1 = self._contacts[:count]
-                    part2 = self._contacts[count:]
-                    part1 = sorted(part1, key=lambda x: x.name.lower())
-                    part2 = sorted(part2, key=lambda x: x.name.lower())
-                    self._contacts = part1 + part2
-            else:  # sort by number
-                online_friends = filter(lambda x: x.status is not None, self._contacts)
-                count = len(list(online_friends))
-                part1 = self._contacts[:count]
-                part2 = self._contacts[count:]
-                part1 = sorted(part1, key=lambda x: x.number)
-                part2 = sorted(part2, key=lambda x: x.number)
-                self._contacts = part1 + part2
-            self._screen.friends_list.clear()
-            for contact in self._contacts:
-                contact.set_widget(self.create_friend_item())
+        if sort and self._sorting > 1:
+            self._contacts_model.sort_contacts(self._get_sort_key(self._sorting))
         for index, friend in enumerate(self._contacts):
-            friend.visibility = (friend.status is not None or not (sorting & 1)) and (filter_str in friend.name.lower())
-            friend.visibility = friend.visibility or friend.messages or friend.actions
-            if friend.visibility:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, self._friend_item_height))
-            else:
-                self._screen.friends_list.item(index).setSizeHint(QtCore.QSize(250, 0))
-        self._sorting, self._filter_string = sorting, filter_str
-        settings['sorting'] = self._sorting
-        settings.save()
+            self._update_visibility(index, friend)
         self.set_active_by_number_and_type(number, is_friend)
 
-    def update_filtration(self):
+    def _update_index(self, contact, *names):
         """
-        Update list of contacts when 1 of friends change connection status
+        Updates names of contact in search index and its place in friends list
+        :param names: other names of contact, e.g. name hidden by alias
         """
-        self.filtration_and_sorting(self._sorting, self._filter_string)
+        self._contacts_index.update(contact, *names)
+        self._filtered = self._contacts_index.search(self._filter_string)
+        self.update_filtration(contact)
+
+    def update_filtration(self, contact=None):
+        """
+        Update list of contacts when 1 of friends change connection status. List is updated in the next frame
+        :param contact: changed contact. If it's None, all contacts are updated
+        """
+        self._scheduler.schedule(CONTACTS_LIST, contact)
+
+    def _update_contact(self, contact):
+        """
+        Moves row of changed contact to its place and updates its visibility. Other contacts should be sorted
+        """
+        row = self._contacts_model.get_row(contact)
+        if row is None:
+            return
+        number, is_friend = self.get_active_number(), self.is_active_a_friend()
+        if self._sorting > 1:  # other contacts are sorted, only this contact is moved
+            key = self._get_sort_key(self._sorting)
+            value, others = key(contact), len(self._contacts) - 1
+            low, high = 0, others
+            while low < high:
+                middle = (low + high) // 2
+                if key(self._contacts[middle if middle < row else middle + 1]) <= value:
+                    low = middle + 1
+                else:
+                    high = middle
+            self._contacts_model.move(row, low)
+            row = low
+        self._update_visibility(row, contact)
+        self.set_active_by_number_and_type(number, is_friend)
+
+    @staticmethod
+    def _get_sort_key(sorting):
+        """
+        :param sorting: 2 - online first, 4 - by name, 6 - online first and by name
+        :return: key for sorting of contacts
+        """
+        if sorting & 4 and not sorting & 2:
+            return lambda x: x.name.lower()
+        elif sorting & 4:
+            return lambda x: (x.status is None, x.name.lower())
+        return lambda x: (x.status is None, x.number)
+
+    def _update_visibility(self, row, contact):
+        """
+        Shows or hides row of contact in friends list
+        """
+        matches = self._filtered is None or contact in self._filtered
+        visibility = (contact.status is not None or not (self._sorting & 1)) and matches
+        visibility = bool(visibility or contact.messages or contact.actions)
+        if visibility != contact.visibility:  # visibility of contact is state of its row
+            self._screen.friends_list.setRowHidden(row, not visibility)
+            contact.visibility = visibility
 
     # -----------------------------------------------------------------------------------------------------------------
     # Friend getters
     # -----------------------------------------------------------------------------------------------------------------
 
     def get_friend_by_number(self, num):
-        return list(filter(lambda x: x.number == num and type(x) is Friend, self._contacts))[0]
+        return self._friends[num]
+
+    def get_friend_by_tox_id(self, tox_id):
+        """
+        :param tox_id: tox id or public key of friend
+        :return: friend or None
+        """
+        return self._tox_ids.get(tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
+
+    def _add_contact(self, contact):
+        self._contacts_model.append(contact)
+        self._contacts_index.update(contact)
+        self._filtered = self._contacts_index.search(self._filter_string)
+        if type(contact) is Friend:
+            self._friends[contact.number] = contact
+            self._tox_ids[contact.tox_id] = contact
+        else:
+            self._groups[contact.number] = contact
+
+    def _remove_contact(self, num):
+        """
+        :param num: number of contact in list
+        """
+        contact = self._contacts_model.remove(num)
+        self._contacts_index.remove(contact)
+        self._filtered = self._contacts_index.search(self._filter_string)
+        if type(contact) is Friend:
+            del self._friends[contact.number]
+            del self._tox_ids[contact.tox_id]
+        else:
+            del self._groups[contact.number]
 
     def get_friend(self, num):
         if num < 0 or num >= len(self._contacts):
@@ -200,10 +276,14 @@ class Profile(basecontact.BaseContact, Singleton):
     def set_active(self, value=None):
         """
         Change current active friend or update info
-        :param value: number of new active friend in friend's list or None to update active user's data
+        :param value: number of new active friend in friend's list or None to update active user's data in the next
+        frame
         """
-        if value is None and self._active_friend == -1:  # nothing to update
+        if value is None:
+            if self._active_friend + 1:
+                self._scheduler.schedule(HEADER)
             return
+        self._scheduler.cancel(MESSAGES_PAGE | HEADER)
         if value == -1:  # all friends were deleted
             self._screen.account_name.setText('')
             self._screen.account_status.setText('')
@@ -216,89 +296,90 @@ class Profile(basecontact.BaseContact, Singleton):
         try:
             self.send_typing(False)
             self._screen.typing.setVisible(False)
-            if value is not None:
-                if self._active_friend + 1 and self._active_friend != value:
-                    try:
-                        self.get_curr_friend().curr_text = self._screen.messageEdit.toPlainText()
-                    except:
-                        pass
-                friend = self._contacts[value]
-                friend.remove_invalid_unsent_files()
-                if self._active_friend != value:
-                    self._screen.messageEdit.setPlainText(friend.curr_text)
-                self._active_friend = value
-                friend.reset_messages()
-                if not Settings.get_instance()['save_history']:
-                    friend.delete_old_messages()
-                self._messages.clear()
-                friend.load_corr()
-                messages = friend.get_corr()[-PAGE_SIZE:]
-                self._load_history = False
-                for message in messages:
-                    if message.get_type() <= 1:
-                        data = message.get_data()
-                        self.create_message_item(data[0],
-                                                 data[2],
-                                                 data[1],
-                                                 data[3])
-                    elif message.get_type() == MESSAGE_TYPE['FILE_TRANSFER']:
-                        if message.get_status() is None:
-                            self.create_unsent_file_item(message)
-                            continue
-                        item = self.create_file_transfer_item(message)
-                        if message.get_status() in ACTIVE_FILE_TRANSFERS:  # active file transfer
-                            try:
-                                ft = self._file_transfers[(message.get_friend_number(), message.get_file_number())]
-                                ft.set_state_changed_handler(item.update_transfer_state)
-                                ft.signal()
-                            except:
-                                print('Incoming not started transfer - no info found')
-                    elif message.get_type() == MESSAGE_TYPE['INLINE']:  # inline
-                        self.create_inline_item(message.get_data())
-                    elif message.get_type() < 5:  # info message
-                        data = message.get_data()
-                        self.create_message_item(data[0],
-                                                 data[2],
-                                                 '',
-                                                 data[3])
-                    else:
-                        data = message.get_data()
-                        self.create_gc_message_item(data[0], data[2], data[1], data[4], data[3])
-                self._messages.scrollToBottom()
-                self._load_history = True
-                if value in self._call:
-                    self._screen.active_call()
-                elif value in self._incoming_calls:
-                    self._screen.incoming_call()
+            if self._active_friend + 1 and self._active_friend != value:
+                try:
+                    self.get_curr_friend().curr_text = self._screen.messageEdit.toPlainText()
+                except:
+                    pass
+            friend = self._contacts[value]
+            friend.remove_invalid_unsent_files()
+            if self._active_friend != value:
+                self._screen.messageEdit.setPlainText(friend.curr_text)
+            self._active_friend = value
+            friend.reset_messages()
+            if not Settings.get_instance()['save_history']:
+                friend.delete_old_messages()
+            self._messages.clear()
+            self._unsent_items.clear()
+            friend.load_corr()
+            messages = friend.get_corr(-PAGE_SIZE)
+            self._load_history = False
+            for message in messages:
+                if message.get_type() <= 1:
+                    data = message.get_data()
+                    self.create_message_item(data[0],
+                                             data[2],
+                                             data[1],
+                                             data[3])
+                elif message.get_type() == MESSAGE_TYPE['FILE_TRANSFER']:
+                    if message.get_status() is None:
+                        self.create_unsent_file_item(message)
+                        continue
+                    item = self.create_file_transfer_item(message)
+                    if message.get_status() in ACTIVE_FILE_TRANSFERS:  # active file transfer
+                        try:
+                            ft = self._file_transfers[(message.get_friend_number(), message.get_file_number())]
+                            ft.set_state_changed_handler(item.update_transfer_state)
+                            ft.signal()
+                        except:
+                            print('Incoming not started transfer - no info found')
+                elif message.get_type() == MESSAGE_TYPE['INLINE']:  # inline
+                    self.create_inline_item(message.get_data())
+                elif message.get_type() < 5:  # info message
+                    data = message.get_data()
+                    self.create_message_item(data[0],
+                                             data[2],
+                                             '',
+                                             data[3])
                 else:
-                    self._screen.call_finished()
-            else:
-                friend = self.get_curr_friend()
-
-            self._screen.account_name.setText(friend.name)
-            self._screen.account_status.setText(friend.status_message)
-            self._screen.account_status.setToolTip(friend.get_full_status())
-            if friend.tox_id is None:
-                avatar_path = curr_directory() + '/images/group.png'
+                    data = message.get_data()
+                    self.create_gc_message_item(data[0], data[2], data[1], data[4], data[3])
+            self._messages.scrollToBottom()
+            self._load_history = True
+            if value in self._call:
+                self._screen.active_call()
+            elif value in self._incoming_calls:
+                self._screen.incoming_call()
             else:
-                avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(friend.tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
-            if not os.path.isfile(avatar_path):  # load default image
-                avatar_path = curr_directory() + '/images/avatar.png'
-            os.chdir(os.path.dirname(avatar_path))
-            pixmap = QtGui.QPixmap(avatar_path)
-            self._screen.account_avatar.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio,
-                                                                QtCore.Qt.SmoothTransformation))
+                self._screen.call_finished()
+            self._update_header(friend)
         except Exception as ex:  # no friend found. ignore
             log('Friend value: ' + str(value))
             log('Error in set active: ' + str(ex))
             raise
 
+    def _update_header(self, friend):
+        """
+        Shows name, status message and avatar of active contact
+        """
+        self._screen.account_name.setText(friend.name)
+        self._screen.account_status.setText(friend.status_message)
+        self._screen.account_status.setToolTip(friend.get_full_status())
+        if friend.tox_id is None:
+            avatar_path = curr_directory() + '/images/group.png'
+        else:
+            avatar_path = (ProfileHelper.get_path() + 'avatars/{}.png').format(friend.tox_id[:TOX_PUBLIC_KEY_SIZE * 2])
+        if not os.path.isfile(avatar_path):  # load default image
+            avatar_path = curr_directory() + '/images/avatar.png'
+        os.chdir(os.path.dirname(avatar_path))
+        pixmap = QtGui.QPixmap(avatar_path)
+        self._screen.account_avatar.setPixmap(pixmap.scaled(64, 64, QtCore.Qt.KeepAspectRatio,
+                                                            QtCore.Qt.SmoothTransformation))
+
     def set_active_by_number_and_type(self, number, is_friend):
-        for i in range(len(self._contacts)):
-            c = self._contacts[i]
-            if c.number == number and (type(c) is Friend == is_friend):
-                self._active_friend = i
-                break
+        contact = (self._friends if is_friend else self._groups).get(number)
+        if contact is not None:
+            self._active_friend = self._contacts_model.get_row(contact)
 
     active_friend = property(get_active, set_active)
 
@@ -322,6 +403,7 @@ class Profile(basecontact.BaseContact, Singleton):
         tmp = friend.name
         friend.set_name(name)
         name = str(name, 'utf-8')
+        self._update_index(friend, name)
         if friend.name == name and tmp != name:
             message = QtWidgets.QApplication.translate("MainWindow", 'User {} is now known as {}')
             message = message.format(tmp, name)
@@ -333,25 +415,49 @@ class Profile(basecontact.BaseContact, Singleton):
             self.set_active(None)
 
     def update(self):
+        """
+        Rebuilds page of messages of active contact in the next frame
+        """
         if self._active_friend + 1:
+            self._scheduler.schedule(MESSAGES_PAGE)
+
+    def flush_updates(self):
+        """
+        Performs scheduled updates of main window now
+        """
+        self._scheduler.flush()
+
+    def _refresh(self, regions, contacts):
+        """
+        Refreshes dirty regions of main window
+        """
+        if regions & CONTACTS_LIST:
+            if len(contacts) == 1 and None not in contacts:
+                self._update_contact(contacts.pop())
+            else:  # several contacts were changed - sorting of all contacts is faster than moving them one by one
+                self._sort_and_filter()
+        if not self._active_friend + 1:
+            return
+        if regions & MESSAGES_PAGE:
             self.set_active(self._active_friend)
+        elif regions & HEADER:
+            self._update_header(self.get_curr_friend())
 
     # -----------------------------------------------------------------------------------------------------------------
     # Friend connection status callbacks
     # -----------------------------------------------------------------------------------------------------------------
 
-    def send_files(self, friend_number):
-        friend = self.get_friend_by_number(friend_number)
-        friend.remove_invalid_unsent_files()
-        files = friend.get_unsent_files()
+    def friend_online(self, friend_number):
+        """
+        Friend connected. Pending messages and files are sent by outbox
+        """
+        self._outbox.friend_online(friend_number)
+
+    def resume_transfers(self, friend_number):
+        """
+        Resume outgoing file transfers which were paused when friend went offline
+        """
         try:
-            for fl in files:
-                data = fl.get_data()
-                if data[1] is not None:
-                    self.send_inline(data[1], data[0], friend_number, True)
-                else:
-                    self.send_file(data[0], friend_number, True)
-            friend.clear_unsent_files()
             for key in list(self._paused_file_transfers.keys()):
                 data = self._paused_file_transfers[key]
                 if not os.path.exists(data[0]):
@@ -359,8 +465,6 @@ class Profile(basecontact.BaseContact, Singleton):
                 elif data[1] == friend_number and not data[2]:
                     self.send_file(data[0], friend_number, True, key)
                     del self._paused_file_transfers[key]
-            if friend_number == self.get_active_number() and self.is_active_a_friend():
-                self.update()
         except Exception as ex:
             print('Exception in file sending: ' + str(ex))
 
@@ -368,7 +472,10 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         Friend with specified number quit
         """
-        self.get_friend_by_number(friend_number).status = None
+        friend = self.get_friend_by_number(friend_number)
+        friend.status = None
+        friend.clear_receipts()  # receipts for messages sent in this session will never come
+        self._outbox.friend_offline(friend_number)
         self.friend_typing(friend_number, False)
         if friend_number in self._call:
             self._call.finish_call(friend_number, True)
@@ -380,6 +487,7 @@ class Profile(basecontact.BaseContact, Singleton):
                 elif type(ft) is ReceiveTransfer and ft.state != TOX_FILE_TRANSFER_STATE['INCOMING_NOT_STARTED']:
                     self._paused_file_transfers[ft.get_id()] = [ft.get_path(), friend_num, True, ft.total_size()]
                 self.cancel_transfer(friend_num, file_num, True)
+        self._save_paused_transfers()
 
     # -----------------------------------------------------------------------------------------------------------------
     # Typing notifications
@@ -408,47 +516,18 @@ class Profile(basecontact.BaseContact, Singleton):
     # Private messages
     # -----------------------------------------------------------------------------------------------------------------
 
-    def receipt(self):
-        i = 0
-        while i < self._messages.count() and not self._messages.itemWidget(self._messages.item(i)).mark_as_sent():
-            i += 1
-
-    def send_messages(self, friend_number):
+    def receipt(self, friend_number, message_id):
         """
-        Send 'offline' messages to friend
+        Read receipt received. Called in main thread because correspondence of friend is changed
+        :param friend_number: number of friend
+        :param message_id: id of delivered message
         """
-        friend = self.get_friend_by_number(friend_number)
-        friend.load_corr()
-        messages = friend.get_unsent_messages()
-        try:
-            for message in messages:
-                self.split_and_send(friend_number, message.get_data()[-1], message.get_data()[0].encode('utf-8'))
-                friend.inc_receipts()
-        except Exception as ex:
-            log('Sending pending messages failed with ' + str(ex))
-
-    def split_and_send(self, number, message_type, message):
-        """
-        Message splitting. Message length cannot be > TOX_MAX_MESSAGE_LENGTH
-        :param number: friend's number
-        :param message_type: type of message
-        :param message: message text
-        """
-        while len(message) > TOX_MAX_MESSAGE_LENGTH:
-            size = TOX_MAX_MESSAGE_LENGTH * 4 // 5
-            last_part = message[size:TOX_MAX_MESSAGE_LENGTH]
-            if b' ' in last_part:
-                index = last_part.index(b' ')
-            elif b',' in last_part:
-                index = last_part.index(b',')
-            elif b'.' in last_part:
-                index = last_part.index(b'.')
-            else:
-                index = TOX_MAX_MESSAGE_LENGTH - size - 1
-            index += size + 1
-            self._tox.friend_send_message(number, message_type, message[:index])
-            message = message[index:]
-        self._tox.friend_send_message(number, message_type, message)
+        time = self.get_friend_by_number(friend_number).receipt(message_id)
+        self._outbox.receipt(friend_number)
+        if time is not None and friend_number == self.get_active_number():
+            item = self._unsent_items.pop(time, None)
+            if item is not None:
+                item.mark_as_sent()
 
     def new_message(self, friend_num, message_type, message):
         """
@@ -469,7 +548,7 @@ class Profile(basecontact.BaseContact, Singleton):
             friend.append_message(
                 TextMessage(message, MESSAGE_OWNER['FRIEND'], time.time(), message_type))
             if not friend.visibility:
-                self.update_filtration()
+                self.update_filtration(friend)
 
     def send_message(self, text, friend_num=None):
         """
@@ -492,19 +571,18 @@ class Profile(basecontact.BaseContact, Singleton):
             else:
                 message_type = TOX_MESSAGE_TYPE['NORMAL']
             friend = self.get_friend_by_number(friend_num)
-            friend.inc_receipts()
-            if friend.status is not None:
-                self.split_and_send(friend.number, message_type, text.encode('utf-8'))
             t = time.time()
             if friend.number == self.get_active_number() and self.is_active_a_friend():
                 self.create_message_item(text, t, MESSAGE_OWNER['NOT_SENT'], message_type)
                 self._screen.messageEdit.clear()
                 self._messages.scrollToBottom()
             friend.append_message(TextMessage(text, MESSAGE_OWNER['NOT_SENT'], t, message_type))
+            self._outbox.add_message(friend.number, t, message_type, text)
 
     def delete_message(self, time):
         friend = self.get_curr_friend()
         friend.delete_message(time)
+        self._unsent_items.pop(time, None)
         self._history.delete_message(friend.tox_id, time)
         self.update()
 
@@ -522,15 +600,11 @@ class Profile(basecontact.BaseContact, Singleton):
                 for friend in filter(lambda x: type(x) is Friend, self._contacts):
                     if not self._history.friend_exists_in_db(friend.tox_id):
                         self._history.add_friend_to_db(friend.tox_id)
-                    if not s['save_unsent_only']:
-                        messages = friend.get_corr_for_saving()
-                    else:
-                        messages = friend.get_unsent_messages_for_saving()
-                        self._history.delete_messages(friend.tox_id)
+                    # messages which weren't passed to history writer
+                    messages = friend.get_corr_for_saving()
+                    if s['save_unsent_only']:
+                        messages = filter(lambda x: x[1] == MESSAGE_OWNER['NOT_SENT'], messages)
                     self._history.save_messages_to_db(friend.tox_id, messages)
-                    unsent_messages = friend.get_unsent_messages()
-                    unsent_time = unsent_messages[0].get_data()[2] if len(unsent_messages) else time.time() + 1
-                    self._history.update_messages(friend.tox_id, unsent_time)
             self._history.save()
             del self._history
 
@@ -550,20 +624,22 @@ class Profile(basecontact.BaseContact, Singleton):
         if num is None or num == self.get_active_number():
             self.update()
 
-    def load_history(self):
+    def load_history(self, count=PAGE_SIZE):
         """
         Tries to load next part of messages
+        :param count: number of messages to load
         """
         if not self._load_history:
             return
         self._load_history = False
         friend = self.get_curr_friend()
-        friend.load_corr(False)
-        data = friend.get_corr()
-        if not data:
+        if friend.get_corr_count() < self._messages.count() + count:
+            friend.load_corr(False)
+        end = friend.get_corr_count() - self._messages.count()
+        if not friend.get_corr_count():
             return
+        data = friend.get_corr(max(end - count, 0), max(end, 0))
         data.reverse()
-        data = data[self._messages.count():self._messages.count() + PAGE_SIZE]
         for message in data:
             if message.get_type() <= 1:  # text message
                 data = message.get_data()
@@ -595,47 +671,68 @@ class Profile(basecontact.BaseContact, Singleton):
                                          False)
         self._load_history = True
 
+    def search_history(self, text):
+        """
+        Search for messages in history of all friends
+        :param text: string or regular expression
+        :return: list of (friend, unix_time, message), newest first
+        """
+        results = map(lambda x: (self.get_friend_by_tox_id(x[0]), ) + x[1:], self._history.search(text))
+        return list(filter(lambda x: x[0] is not None, results))  # history of deleted friend
+
     def export_db(self, directory):
         self._history.export(directory)
 
-    def export_history(self, num, as_text=True, _range=None):
-        friend = self._contacts[num]
-        if _range is None:
-            friend.load_all_corr()
-            corr = friend.get_corr()
-        elif _range[1] + 1:
-            corr = friend.get_corr()[_range[0]:_range[1] + 1]
+    def change_history_password(self):
+        """
+        Re-encrypts history with new profile password
+        """
+        if hasattr(self, '_history'):
+            self._history.change_password()
+
+    def export_messages(self, num, _range):
+        """
+        Exports selected messages as text. Only messages of loaded correspondence can be selected, so history isn't
+        read
+        :param _range: tuple of negative indexes of the first and the last selected messages in correspondence
+        :return: text
+        """
+        contact = self._contacts[num]
+        corr = contact.get_corr(_range[0], _range[1] + 1 or None)
+        messages = list(map(lambda x: x.get_data(), filter(lambda x: type(x) is TextMessage, corr)))
+        exporter = HistoryExporter(None, contact.tox_id, contact.name, self.name, 'txt', unsaved=messages)
+        fl = io.StringIO()
+        exporter.write(fl)
+        return fl.getvalue()
+
+    def export_history_to_file(self, num, path, fmt='txt', start=None, end=None, progress=None, finished=None):
+        """
+        Exports contact's history to file in background thread
+        :param fmt: txt, html or jsonl
+        :param start: min unix_time of exported message or None
+        :param end: max unix_time of exported message (exclusive) or None
+        :param progress: callback, gets number of exported messages and total number of messages
+        :param finished: callback, gets number of exported messages or None on error
+        :return: started thread
+        """
+        contact = self._contacts[num]
+        if type(contact) is Friend:
+            unsaved = contact.get_corr_for_saving()
         else:
-            corr = friend.get_corr()[_range[0]:]
-        arr = []
-        new_line = '\n' if as_text else '<br>'
-        for message in corr:
-            if type(message) is TextMessage:
-                data = message.get_data()
-                if as_text:
-                    x = '[{}] {}: {}\n'
-                else:
-                    x = '[{}] <b>{}:</b> {}<br>'
-                arr.append(x.format(convert_time(data[2]) if data[1] != MESSAGE_OWNER['NOT_SENT'] else 'Unsent',
-                                    friend.name if data[1] == MESSAGE_OWNER['FRIEND'] else self.name,
-                                    data[0]))
-        s = new_line.join(arr)
-        if not as_text:
-            s = '<html><head><meta charset="UTF-8"><title>{}</title></head><body>{}</body></html>'.format(friend.name, s)
-        return s
+            unsaved = list(map(lambda x: x.get_data(), filter(lambda x: type(x) is TextMessage, contact.get_corr())))
+        exporter = HistoryExporter(self._history, contact.tox_id, contact.name, self.name, fmt, start, end, unsaved)
+        thread = HistoryExportThread(exporter, path, progress, finished)
+        thread.start()
+        return thread
 
     # -----------------------------------------------------------------------------------------------------------------
     # Friend, message and file transfer items creation
     # -----------------------------------------------------------------------------------------------------------------
 
-    def create_friend_item(self):
+    def _get_author(self, owner, message_type):
         """
-        Method-factory
-        :return: new widget for friend instance
+        :return: name and avatar (or None) of author of message with active friend
         """
-        return self._factory.friend_item()
-
-    def create_message_item(self, text, time, owner, message_type, append=True):
         if message_type == MESSAGE_TYPE['INFO_MESSAGE']:
             name = ''
         elif owner == MESSAGE_OWNER['FRIEND']:
@@ -648,8 +745,28 @@ class Profile(basecontact.BaseContact, Singleton):
                 pixmap = self.get_curr_friend().get_pixmap()
             else:
                 pixmap = self.get_pixmap()
-        return self._factory.message_item(text, time, name, owner != MESSAGE_OWNER['NOT_SENT'],
+        return name, pixmap
+
+    def create_message_item(self, text, time, owner, message_type, append=True):
+        name, pixmap = self._get_author(owner, message_type)
+        item = self._factory.message_item(text, time, name, owner != MESSAGE_OWNER['NOT_SENT'],
                                           message_type, append, pixmap)
+        if owner == MESSAGE_OWNER['NOT_SENT']:
+            self._unsent_items[time] = item
+        return item
+
+    def create_history_page(self, page, messages):
+        """
+        Shows page of history of active friend which is not loaded, e.g. with search result
+        :param page: list widget for page, messages of active friend are not changed
+        :param messages: list of text messages, oldest first
+        """
+        factory = items_factory.ItemsFactory(page)
+        page.clear()
+        for message in messages:
+            text, owner, time, message_type = message.get_data()
+            name, pixmap = self._get_author(owner, message_type)
+            factory.message_item(text, time, name, owner != MESSAGE_OWNER['NOT_SENT'], message_type, True, pixmap)
 
     def create_gc_message_item(self, text, time, owner, name, message_type, append=True):
         pixmap = None
@@ -699,23 +816,15 @@ class Profile(basecontact.BaseContact, Singleton):
                                                   name)
         if ok:
             settings = Settings.get_instance()
-            aliases = settings['friends_aliases']
+            settings.set_contact_value(friend.tox_id, 'alias', text)
             if text:
                 friend.name = bytes(text, 'utf-8')
-                try:
-                    index = list(map(lambda x: x[0], aliases)).index(friend.tox_id)
-                    aliases[index] = (friend.tox_id, text)
-                except:
-                    aliases.append((friend.tox_id, text))
                 friend.set_alias(text)
+                self._update_index(friend, self._tox.friend_get_name(friend.number))
             else:  # use default name
                 friend.name = bytes(self._tox.friend_get_name(friend.number), 'utf-8')
                 friend.set_alias('')
-                try:
-                    index = list(map(lambda x: x[0], aliases)).index(friend.tox_id)
-                    del aliases[index]
-                except:
-                    pass
+                self._update_index(friend)
             settings.save()
         if num == self.get_active_number() and self.is_active_a_friend():
             self.update()
@@ -730,20 +839,13 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         friend = self._contacts[num]
         settings = Settings.get_instance()
-        try:
-            index = list(map(lambda x: x[0], settings['friends_aliases'])).index(friend.tox_id)
-            del settings['friends_aliases'][index]
-        except:
-            pass
-        if friend.tox_id in settings['notes']:
-            del settings['notes'][friend.tox_id]
+        settings.remove_contact_values(friend.tox_id, 'alias', 'note')
         settings.save()
         self.clear_history(num)
         if self._history.friend_exists_in_db(friend.tox_id):
             self._history.delete_friend_from_db(friend.tox_id)
         self._tox.friend_delete(friend.number)
-        del self._contacts[num]
-        self._screen.friends_list.takeItem(num)
+        self._remove_contact(num)
         if num == self._active_friend:  # active friend was deleted
             if not len(self._contacts):  # last friend was deleted
                 self.set_active(-1)
@@ -757,7 +859,6 @@ class Profile(basecontact.BaseContact, Singleton):
         Adds friend to list
         """
         num = self._tox.friend_add_norequest(tox_id)  # num - friend number
-        item = self.create_friend_item()
         try:
             if not self._history.friend_exists_in_db(tox_id):
                 self._history.add_friend_to_db(tox_id)
@@ -765,8 +866,8 @@ class Profile(basecontact.BaseContact, Singleton):
         except Exception as ex:  # something is wrong
             log('Accept friend request failed! ' + str(ex))
             message_getter = None
-        friend = Friend(message_getter, num, tox_id, '', item, tox_id)
-        self._contacts.append(friend)
+        friend = Friend(message_getter, num, tox_id, '', self._contacts_model, tox_id)
+        self._add_contact(friend)
 
     def block_user(self, tox_id):
         """
@@ -776,16 +877,13 @@ class Profile(basecontact.BaseContact, Singleton):
         if tox_id == self.tox_id[:TOX_PUBLIC_KEY_SIZE * 2]:
             return
         settings = Settings.get_instance()
-        if tox_id not in settings['blocked']:
-            settings['blocked'].append(tox_id)
-            settings.save()
-        try:
-            num = self._tox.friend_by_public_key(tox_id)
-            self.delete_friend(num)
+        settings.set_contact_value(tox_id, 'blocked', True)
+        settings.save()
+        friend = self.get_friend_by_tox_id(tox_id)
+        if friend is not None:
+            self.delete_friend(self._contacts_model.get_row(friend))
             data = self._tox.get_savedata()
             ProfileHelper.get_instance().save_profile(data)
-        except:  # not in friend list
-            pass
 
     def unblock_user(self, tox_id, add_to_friend_list):
         """
@@ -794,7 +892,7 @@ class Profile(basecontact.BaseContact, Singleton):
         :param add_to_friend_list: add this contact to friend list or not
         """
         s = Settings.get_instance()
-        s['blocked'].remove(tox_id)
+        s.set_contact_value(tox_id, 'blocked', False)
         s.save()
         if add_to_friend_list:
             self.add_friend(tox_id)
@@ -828,12 +926,11 @@ class Profile(basecontact.BaseContact, Singleton):
             else:
                 result = self._tox.friend_add(tox_id, message.encode('utf-8'))
                 tox_id = tox_id[:TOX_PUBLIC_KEY_SIZE * 2]
-                item = self.create_friend_item()
                 if not self._history.friend_exists_in_db(tox_id):
                     self._history.add_friend_to_db(tox_id)
                 message_getter = self._history.messages_getter(tox_id)
-                friend = Friend(message_getter, result, tox_id, '', item, tox_id)
-                self._contacts.append(friend)
+                friend = Friend(message_getter, result, tox_id, '', self._contacts_model, tox_id)
+                self._add_contact(friend)
             data = self._tox.get_savedata()
             ProfileHelper.get_instance().save_profile(data)
             return True
@@ -875,9 +972,11 @@ class Profile(basecontact.BaseContact, Singleton):
         del self._tox
         self._tox = restart()
         self._call = calls.AV(self._tox.AV)
+        self._outbox.set_tox(self._tox)
         self.status = None
         for friend in self._contacts:
             friend.number = self._tox.friend_by_public_key(friend.tox_id)  # numbers update
+        self._friends = {friend.number: friend for friend in self._tox_ids.values()}
         self.update_filtration()
 
     def reconnect(self):
@@ -888,16 +987,20 @@ class Profile(basecontact.BaseContact, Singleton):
             QtCore.QTimer.singleShot(50000, self.reconnect)
 
     def close(self):
+        s = Settings.get_instance()
+        unsent_files = {}
         for friend in filter(lambda x: type(x) is Friend, self._contacts):
             self.friend_exit(friend.number)
+            files = [fl.get_data()[0] for fl in friend.get_unsent_files() if fl.get_data()[1] is None]
+            if files and s['resend_files']:
+                unsent_files[friend.tox_id] = files
+        s['unsent_files'] = unsent_files
         for i in range(len(self._contacts)):
-            del self._contacts[0]
+            self._remove_contact(0)
         if hasattr(self, '_call'):
             self._call.stop()
             del self._call
-        s = Settings.get_instance()
-        s['paused_file_transfers'] = dict(self._paused_file_transfers) if s['resend_files'] else {}
-        s.save()
+        self._save_paused_transfers()
 
     # -----------------------------------------------------------------------------------------------------------------
     # File transfers support
@@ -913,13 +1016,13 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         settings = Settings.get_instance()
         friend = self.get_friend_by_number(friend_number)
-        auto = settings['allow_auto_accept'] and friend.tox_id in settings['auto_accept_from_friends']
+        auto = settings['allow_auto_accept'] and settings.get_contact_value(friend.tox_id, 'auto_accept', False)
         inline = is_inline(file_name) and settings['allow_inline']
         file_id = self._tox.file_get_file_id(friend_number, file_number)
         accepted = True
         if file_id in self._paused_file_transfers:
             data = self._paused_file_transfers[file_id]
-            pos = data[-1] if os.path.exists(data[0]) else 0
+            pos = resume_position(data[0], data[-1])
             if pos >= size:
                 self._tox.file_control(friend_number, file_number, TOX_FILE_CONTROL['CANCEL'])
                 return
@@ -984,6 +1087,9 @@ class Profile(basecontact.BaseContact, Singleton):
             tr = self._file_transfers[(friend_number, file_number)]
             if not already_cancelled:
                 tr.cancel()
+                if type(tr) is ReceiveTransfer:  # file was removed
+                    self._paused_file_transfers.pop(tr.get_id(), None)
+                    self._save_paused_transfers()
             else:
                 tr.cancelled()
             if (friend_number, file_number) in self._file_transfers:
@@ -1047,6 +1153,9 @@ class Profile(basecontact.BaseContact, Singleton):
         path = os.path.join(path, new_file_name)
         if not inline:
             rt = ReceiveTransfer(path, self._tox, friend_number, size, file_number, from_position)
+            # transfer is saved before it's paused, so it can be resumed after crash
+            self._paused_file_transfers[rt.get_id()] = [path, friend_number, True, rt.total_size()]
+            self._save_paused_transfers()
         else:
             rt = ReceiveToBuffer(self._tox, friend_number, size, file_number)
         rt.set_transfer_finished_handler(self.transfer_finished)
@@ -1135,6 +1244,14 @@ class Profile(basecontact.BaseContact, Singleton):
         """
         self._file_transfers[(friend_number, file_number)].write_chunk(position, data)
 
+    def _save_paused_transfers(self):
+        """
+        Saves paused and incoming file transfers to settings. Settings are saved with delay
+        """
+        s = Settings.get_instance()
+        s['paused_file_transfers'] = dict(self._paused_file_transfers) if s['resend_files'] else {}
+        s.save()
+
     def outgoing_chunk(self, friend_number, file_number, position, size):
         """
         Outgoing chunk
@@ -1143,6 +1260,9 @@ class Profile(basecontact.BaseContact, Singleton):
 
     def transfer_finished(self, friend_number, file_number):
         transfer = self._file_transfers[(friend_number, file_number)]
+        if transfer.state == TOX_FILE_TRANSFER_STATE['CANCELLED']:  # incomplete data
+            self.cancel_transfer(friend_number, file_number, True)
+            return
         t = type(transfer)
         if t is ReceiveAvatar:
             self.get_friend_by_number(friend_number).load_avatar()
@@ -1166,6 +1286,9 @@ class Profile(basecontact.BaseContact, Singleton):
         elif t is not SendAvatar:
             self.get_friend_by_number(friend_number).update_transfer_data(file_number,
                                                                           TOX_FILE_TRANSFER_STATE['FINISHED'])
+            if t is ReceiveTransfer:
+                self._paused_file_transfers.pop(transfer.get_id(), None)
+                self._save_paused_transfers()
         del self._file_transfers[(friend_number, file_number)]
         del transfer
 
@@ -1300,13 +1423,11 @@ class Profile(basecontact.BaseContact, Singleton):
         return type(self.get_curr_friend()) is Friend
 
     def get_group_by_number(self, number):
-        groups = filter(lambda x: type(x) is GroupChat and x.number == number, self._contacts)
-        return list(groups)[0]
+        return self._groups[number]
 
     def add_gc(self, number):
-        widget = self.create_friend_item()
-        gc = GroupChat('Group chat #' + str(number), '', widget, self._tox, number)
-        self._contacts.append(gc)
+        gc = GroupChat('Group chat #' + str(number), '', self._contacts_model, self._tox, number)
+        self._add_contact(gc)
 
     def create_group_chat(self):
         number = self._tox.add_av_groupchat()
@@ -1315,8 +1436,7 @@ class Profile(basecontact.BaseContact, Singleton):
     def leave_gc(self, num):
         gc = self._contacts[num]
         self._tox.del_groupchat(gc.number)
-        del self._contacts[num]
-        self._screen.friends_list.takeItem(num)
+        self._remove_contact(num)
         if num == self._active_friend:  # active friend was deleted
             if not len(self._contacts):  # last friend was deleted
                 self.set_active(-1)
@@ -1350,13 +1470,14 @@ class Profile(basecontact.BaseContact, Singleton):
             gc.append_message(
                 GroupChatMessage(message, MESSAGE_OWNER['FRIEND'], time.time(), message_type, name))
             if not gc.visibility:
-                self.update_filtration()
+                self.update_filtration(gc)
 
     def new_gc_title(self, group_number, title):
         gc = self.get_group_by_number(group_number)
         gc.new_title(title)
+        self._update_index(gc)
         if not self.is_active_a_friend() and self.get_active_number() == group_number:
-            self.update()
+            self.set_active(None)
 
     def update_gc(self, group_number):
         count = self._tox.group_number_peers(group_number)
@@ -1364,7 +1485,7 @@ class Profile(basecontact.BaseContact, Singleton):
         text = QtWidgets.QApplication.translate('MainWindow', '{} users in chat')
         gc.status_message = text.format(str(count)).encode('utf-8')
         if not self.is_active_a_friend() and self.get_active_number() == group_number:
-            self.update()
+            self.set_active(None)
 
     def send_gc_message(self, text):
         group_number = self.get_active_number()
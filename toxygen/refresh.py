@@ -0,0 +1,88 @@
+from PyQt5 import QtCore
+
+
+REFRESH_INTERVAL = 16  # ms, about one frame
+
+# regions of main window
+CONTACTS_LIST = 1  # filtration and sorting of friends list
+HEADER = 2  # name, status message and avatar of active contact
+MESSAGES_PAGE = 4  # messages of active contact. Page is rebuilt with header
+
+REGIONS = {
+    CONTACTS_LIST: 'contacts_list',
+    HEADER: 'header',
+    MESSAGES_PAGE: 'messages_page'
+}
+
+
+class RefreshScheduler:
+    """
+    Collects refresh requests for regions of main window and performs them once per frame. All requests made before
+    refresh are coalesced into one refresh of each dirty region
+    """
+
+    def __init__(self, refresh):
+        """
+        :param refresh: function(regions, contacts) which refreshes dirty regions. contacts - set of changed contacts
+        in contacts list, None in set means that all contacts should be updated
+        """
+        self._refresh = refresh
+        self._regions = 0
+        self._contacts = set()
+        self._requested = dict.fromkeys(REGIONS, 0)
+        self._performed = dict.fromkeys(REGIONS, 0)
+        self._timer = QtCore.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+
+    def schedule(self, regions, contact=None):
+        """
+        Marks regions as dirty
+        :param regions: bit mask of regions
+        :param contact: changed contact if only its row in contacts list should be updated
+        """
+        if regions & CONTACTS_LIST:
+            self._contacts.add(contact)
+        for region in REGIONS:
+            if regions & region:
+                self._requested[region] += 1
+        self._regions |= regions
+        if not self._timer.isActive():
+            self._timer.start(REFRESH_INTERVAL)
+
+    def cancel(self, regions):
+        """
+        Marks regions as clean, e.g. when they were refreshed directly
+        """
+        self._regions &= ~regions
+        if not self._regions & CONTACTS_LIST:
+            self._contacts.clear()
+        if not self._regions:
+            self._timer.stop()
+
+    def is_dirty(self, region):
+        return bool(self._regions & region)
+
+    def flush(self):
+        """
+        Refreshes all dirty regions now
+        """
+        self._timer.stop()
+        regions, contacts = self._regions, self._contacts
+        if not regions:
+            return
+        self._regions, self._contacts = 0, set()
+        if regions & MESSAGES_PAGE:  # header is refreshed with page
+            regions &= ~HEADER
+        for region in REGIONS:
+            if regions & region:
+                self._performed[region] += 1
+        self._refresh(regions, contacts)
+
+    def get_stats(self):
+        """
+        :return: dict region name - (number of requests, number of refreshes, number of coalesced requests)
+        """
+        return {name: (self._requested[region], self._performed[region],
+                       self._requested[region] - self._performed[region])
+                for region, name in REGIONS.items()}
@@ -1,10 +1,15 @@
 from platform import system
 import json
 import os
-from util import Singleton, curr_directory, log, copy, append_slash
+from util import Singleton, curr_directory, log, copy, append_slash, atomic_write
 import pyaudio
 from toxes import ToxES
 import smileys
+import threading
+from toxcore_enums_and_consts import TOX_PUBLIC_KEY_SIZE
+
+
+SAVE_DELAY = 2  # seconds between saving of settings and writing them to file
 
 
 class Settings(dict, Singleton):
@@ -16,17 +21,27 @@ class Settings(dict, Singleton):
         Singleton.__init__(self)
         self.path = ProfileHelper.get_path() + str(name) + '.json'
         self.name = name
+        self._lock = threading.Lock()  # guards values, dirty flag and timer
+        self._write_lock = threading.Lock()
+        self._dirty = True  # settings were changed since the last writing
+        self._saved_version = None  # version of password used for the last writing
+        self._timer = None
         if os.path.isfile(self.path):
             with open(self.path, 'rb') as fl:
                 data = fl.read()
             inst = ToxES.get_instance()
             try:
-                if inst.is_data_encrypted(data):
+                encrypted = inst is not None and inst.is_data_encrypted(data)
+                if encrypted:
                     data = inst.pass_decrypt(data)
                 info = json.loads(str(data, 'utf-8'))
             except Exception as ex:
                 info = Settings.get_default_settings()
                 log('Parsing settings error: ' + str(ex))
+            else:
+                if encrypted == Settings._has_password():  # file is up to date
+                    self._dirty = False
+                    self._saved_version = Settings._get_password_version()
             super(Settings, self).__init__(info)
             self.upgrade()
         else:
@@ -120,16 +135,15 @@ class Settings(dict, Singleton):
             'allow_auto_accept': True,
             'auto_accept_path': None,
             'sorting': 0,
-            'auto_accept_from_friends': [],
+            'contacts': {},  # public key - dict with alias, note, auto accept and blocked flags
             'paused_file_transfers': {},
+            'unsent_files': {},
             'resend_files': True,
-            'friends_aliases': [],
+            'file_transfers_progress_rate': 10,  # max number of progress updates of transfer per second, 0 - no limit
             'show_avatars': False,
             'typing_notifications': False,
             'calls_sound': True,
-            'blocked': [],
             'plugins': [],
-            'notes': {},
             'smileys': True,
             'smiley_pack': 'default',
             'mirror_mode': False,
@@ -145,7 +159,10 @@ class Settings(dict, Singleton):
             'close_to_tray': False,
             'font': 'Times New Roman',
             'update': 1,
-            'group_notifications': True
+            'group_notifications': True,
+            'history_max_age': 0,  # days, 0 - no limit
+            'history_max_messages': 0,  # per friend, 0 - no limit
+            'history_max_size': 0  # MB, 0 - no limit
         }
 
     @staticmethod
@@ -166,23 +183,128 @@ class Settings(dict, Singleton):
 
     def upgrade(self):
         default = Settings.get_default_settings()
+        self._move_contacts_data()
         for key in default:
             if key not in self:
                 print(key)
                 self[key] = default[key]
         self.save()
 
-    def save(self):
-        text = json.dumps(self)
+    def get_contact_value(self, public_key, key, default=None):
+        """
+        :param public_key: public key or tox id of contact
+        :param key: 'alias', 'note', 'auto_accept' or 'blocked'
+        :return: value for contact or default
+        """
+        data = self['contacts'].get(public_key[:TOX_PUBLIC_KEY_SIZE * 2])
+        return default if data is None else data.get(key, default)
+
+    def set_contact_value(self, public_key, key, value):
+        """
+        Sets value for contact. Empty value (None, False, '') is removed
+        """
+        public_key = public_key[:TOX_PUBLIC_KEY_SIZE * 2]
+        with self._lock:
+            data = self['contacts'].setdefault(public_key, {})
+            if value:
+                data[key] = value
+            else:
+                data.pop(key, None)
+                if not data:
+                    del self['contacts'][public_key]
+            self._dirty = True
+
+    def remove_contact_values(self, public_key, *keys):
+        """
+        Removes values for contact
+        :param keys: keys of values or nothing to remove all values
+        """
+        public_key = public_key[:TOX_PUBLIC_KEY_SIZE * 2]
+        for key in keys or tuple(self['contacts'].get(public_key, ())):
+            self.set_contact_value(public_key, key, None)
+
+    def get_contacts_with(self, key):
+        """
+        :return: list of public keys of contacts which have value for key
+        """
+        return [public_key for public_key, data in self['contacts'].items() if key in data]
+
+    def _move_contacts_data(self):
+        """
+        Moves data of contacts from lists of old versions to dict of contacts
+        """
+        self.setdefault('contacts', {})
+        for tox_id, alias in self.pop('friends_aliases', ()):
+            self.set_contact_value(tox_id, 'alias', alias)
+        for tox_id, note in self.pop('notes', {}).items():
+            self.set_contact_value(tox_id, 'note', note)
+        for tox_id in self.pop('auto_accept_from_friends', ()):
+            self.set_contact_value(tox_id, 'auto_accept', True)
+        for tox_id in self.pop('blocked', ()):
+            self.set_contact_value(tox_id, 'blocked', True)
+
+    def __setitem__(self, key, value):
+        """
+        Values must be replaced instead of changing in place, otherwise changes are not found by save()
+        """
+        with self._lock:
+            super(Settings, self).__setitem__(key, value)
+            self._dirty = True
+
+    @staticmethod
+    def _has_password():
         inst = ToxES.get_instance()
-        if inst.has_password():
-            text = bytes(inst.pass_encrypt(bytes(text, 'utf-8')))
-        else:
-            text = bytes(text, 'utf-8')
-        with open(self.path, 'wb') as fl:
-            fl.write(text)
+        return inst is not None and inst.has_password()
+
+    @staticmethod
+    def _get_password_version():
+        """
+        :return: version of password used for encryption, 0 if profile has no password
+        """
+        inst = ToxES.get_instance()
+        return inst.get_password_version() if inst is not None else 0
+
+    def save(self):
+        """
+        Schedules writing of settings to file. Saves made during SAVE_DELAY seconds are written once. Nothing is
+        encrypted and written if settings and password were not changed since the last writing
+        """
+        with self._lock:
+            if not self._dirty and self._saved_version == self._get_password_version():
+                return
+            if self._timer is None:
+                self._timer = threading.Timer(SAVE_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes scheduled changes now. File is replaced atomically
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                version = self._get_password_version()
+                if not self._dirty and self._saved_version == version:
+                    return
+                text = bytes(json.dumps(self), 'utf-8')
+                self._dirty = False
+            inst = ToxES.get_instance()
+            try:
+                if inst is not None and inst.has_password():
+                    text = bytes(inst.pass_encrypt(text))
+                atomic_write(self.path, text)
+                with self._lock:
+                    self._saved_version = version
+            except Exception as ex:
+                with self._lock:
+                    self._dirty = True  # will be written on the next save
+                log('Saving settings error: ' + str(ex))
 
     def close(self):
+        self.flush()
         profile_path = ProfileHelper.get_path()
         path = str(profile_path + str(self.name) + '.lock')
         if os.path.isfile(path):
@@ -203,6 +325,7 @@ class Settings(dict, Singleton):
             fl.write(text)
 
     def update_path(self):
+        self.flush()
         self.path = ProfileHelper.get_path() + self.name + '.json'
 
     @staticmethod
@@ -246,7 +369,7 @@ class ProfileHelper(Singleton):
 
     def save_profile(self, data):
         inst = ToxES.get_instance()
-        if inst.has_password():
+        if inst is not None and inst.has_password():
             data = inst.pass_encrypt(data)
         with open(self._path, 'wb') as fl:
             fl.write(data)
@@ -1235,12 +1235,15 @@ class Tox:
         :param friend_number: The friend number of the receiving friend for this file.
         :param file_number: The file transfer identifier returned by tox_file_send.
         :param position: The file or stream position from which to continue reading.
-        :param data: Chunk of file data
+        :param data: Chunk of file data - bytes or writable buffer, e.g. memoryview of bytearray. Buffer is passed
+        without copying
         :return: true on success.
         """
         tox_err_file_send_chunk = c_int()
+        length = len(data)
+        data = c_char_p(data) if isinstance(data, bytes) else (c_char * length).from_buffer(data)
         result = self.libtoxcore.tox_file_send_chunk(self._tox_pointer, c_uint32(friend_number), c_uint32(file_number),
-                                                     c_uint64(position), c_char_p(data), c_size_t(len(data)),
+                                                     c_uint64(position), data, c_size_t(length),
                                                      byref(tox_err_file_send_chunk))
         tox_err_file_send_chunk = tox_err_file_send_chunk.value
         if tox_err_file_send_chunk == TOX_ERR_FILE_SEND_CHUNK['OK']:
@@ -1,5 +1,5 @@
 import libtox
-from ctypes import c_size_t, create_string_buffer, byref, c_int, ArgumentError, c_char_p, c_bool
+from ctypes import c_size_t, create_string_buffer, byref, c_int, ArgumentError, c_char_p, c_bool, c_void_p
 from toxencryptsave_enums_and_consts import *
 
 
@@ -72,3 +72,100 @@ class ToxEncryptSave:
         elif tox_err_decryption == TOX_ERR_DECRYPTION['FAILED']:
             raise RuntimeError('The encrypted byte array could not be decrypted. Either the data was corrupt or the '
                                'password/key was incorrect.')
+
+    def get_salt(self, data):
+        """
+        Retrieves the salt used to encrypt the given data.
+
+        :return: salt (TOX_PASS_SALT_LENGTH bytes)
+        """
+        salt = create_string_buffer(TOX_PASS_SALT_LENGTH)
+        tox_err_get_salt = c_int()
+        self.libtoxencryptsave.tox_get_salt(c_char_p(bytes(data)), salt, byref(tox_err_get_salt))
+        tox_err_get_salt = tox_err_get_salt.value
+        if tox_err_get_salt == TOX_ERR_GET_SALT['OK']:
+            return salt[:]
+        elif tox_err_get_salt == TOX_ERR_GET_SALT['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_get_salt == TOX_ERR_GET_SALT['BAD_FORMAT']:
+            raise ArgumentError('The input data is missing the magic number (i.e. wasn\'t created by this module, or is'
+                                ' corrupted)')
+
+    def pass_key_derive_with_salt(self, password, salt):
+        """
+        Generates a secret symmetric key from the given passphrase and salt. Key derivation is slow, so the key
+        should be reused for multiple encryptions and freed with pass_key_free.
+
+        :param salt: TOX_PASS_SALT_LENGTH bytes
+        :return: pointer to key
+        """
+        func = self.libtoxencryptsave.tox_pass_key_derive_with_salt
+        func.restype = c_void_p
+        tox_err_key_derivation = c_int()
+        password = bytes(password, 'utf-8')
+        result = func(c_char_p(password),
+                      c_size_t(len(password)),
+                      c_char_p(bytes(salt)),
+                      byref(tox_err_key_derivation))
+        tox_err_key_derivation = tox_err_key_derivation.value
+        if tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['OK']:
+            return result
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_key_derivation == TOX_ERR_KEY_DERIVATION['FAILED']:
+            raise RuntimeError('The crypto lib was unable to derive a key from the given passphrase, which is usually a'
+                               ' lack of memory issue.')
+
+    def pass_key_free(self, key):
+        """
+        Frees key created by pass_key_derive_with_salt
+        """
+        self.libtoxencryptsave.tox_pass_key_free(c_void_p(key))
+
+    def pass_key_encrypt(self, data, key):
+        """
+        Encrypts the given data with the given key. Same as pass_encrypt but without key derivation.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) + TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_encryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_encrypt(c_void_p(key),
+                                                    c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    out,
+                                                    byref(tox_err_encryption))
+        tox_err_encryption = tox_err_encryption.value
+        if tox_err_encryption == TOX_ERR_ENCRYPTION['OK']:
+            return out[:]
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_encryption == TOX_ERR_ENCRYPTION['FAILED']:
+            raise RuntimeError('The encryption itself failed.')
+
+    def pass_key_decrypt(self, data, key):
+        """
+        Decrypts the given data with the given key. Same as pass_decrypt but without key derivation.
+
+        :return: output array
+        """
+        out = create_string_buffer(len(data) - TOX_PASS_ENCRYPTION_EXTRA_LENGTH)
+        tox_err_decryption = c_int()
+        self.libtoxencryptsave.tox_pass_key_decrypt(c_void_p(key),
+                                                    c_char_p(bytes(data)),
+                                                    c_size_t(len(data)),
+                                                    out,
+                                                    byref(tox_err_decryption))
+        tox_err_decryption = tox_err_decryption.value
+        if tox_err_decryption == TOX_ERR_DECRYPTION['OK']:
+            return out[:]
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['NULL']:
+            raise ArgumentError('Some input data, or maybe the output pointer, was null.')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['INVALID_LENGTH']:
+            raise ArgumentError('The input data was shorter than TOX_PASS_ENCRYPTION_EXTRA_LENGTH bytes')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['BAD_FORMAT']:
+            raise ArgumentError('The input data is missing the magic number (i.e. wasn\'t created by this module, or is'
+                                ' corrupted)')
+        elif tox_err_decryption == TOX_ERR_DECRYPTION['FAILED']:
+            raise RuntimeError('The encrypted byte array could not be decrypted. Either the data was corrupt or the '
+                               'password/key was incorrect.')
@@ -27,3 +27,25 @@ TOX_ERR_DECRYPTION = {
 }
 
 TOX_PASS_ENCRYPTION_EXTRA_LENGTH = 80
+
+TOX_ERR_KEY_DERIVATION = {
+    # The function returned successfully.
+    'OK': 0,
+    # Some input data, or maybe the output pointer, was null.
+    'NULL': 1,
+    # The crypto lib was unable to derive a key from the given passphrase, which is usually a lack of memory issue.
+    'FAILED': 2
+}
+
+TOX_ERR_GET_SALT = {
+    # The function returned successfully.
+    'OK': 0,
+    # One of the arguments to the function was NULL when it was not expected.
+    'NULL': 1,
+    # The input data is missing the magic number (i.e. wasn't created by this module, or is corrupted).
+    'BAD_FORMAT': 2
+}
+
+TOX_PASS_SALT_LENGTH = 32
+
+TOX_PASS_KEY_LENGTH = 32
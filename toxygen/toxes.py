@@ -1,16 +1,33 @@
 import util
 import toxencryptsave
+from toxencryptsave_enums_and_consts import TOX_PASS_SALT_LENGTH
+import threading
+import os
 
 
 class ToxES(util.Singleton):
+    """
+    Encryption of profile, settings and history. Key derivation from password is slow, so keys are derived once and
+    kept in memory until password is changed
+    """
 
     def __init__(self):
         super().__init__()
         self._toxencryptsave = toxencryptsave.ToxEncryptSave()
         self._passphrase = None
+        self._salt = None  # salt of key used for encryption
+        self._keys = {}  # key - salt, value - key derived from current password and this salt
+        self._lock = threading.Lock()
+        self._password_version = 0
 
     def set_password(self, passphrase):
-        self._passphrase = passphrase
+        with self._lock:
+            self._passphrase = passphrase
+            self._password_version += 1
+            for key in self._keys.values():
+                self._toxencryptsave.pass_key_free(key)
+            self._keys.clear()
+            self._salt = None
 
     def has_password(self):
         return bool(self._passphrase)
@@ -18,11 +35,48 @@ class ToxES(util.Singleton):
     def is_password(self, password):
         return self._passphrase == password
 
+    def get_password_version(self):
+        """
+        :return: number of password changes. Data encrypted with older password should be encrypted again
+        """
+        return self._password_version
+
     def is_data_encrypted(self, data):
         return len(data) > 0 and self._toxencryptsave.is_data_encrypted(data)
 
+    def _get_key(self, salt):
+        """
+        :return: cached key for salt. Key is derived if needed
+        """
+        with self._lock:
+            if salt not in self._keys:
+                self._keys[salt] = self._toxencryptsave.pass_key_derive_with_salt(self._passphrase, salt)
+            return self._keys[salt]
+
     def pass_encrypt(self, data):
-        return self._toxencryptsave.pass_encrypt(data, self._passphrase)
+        if self._salt is None:
+            self._salt = os.urandom(TOX_PASS_SALT_LENGTH)
+        return self._toxencryptsave.pass_key_encrypt(data, self._get_key(self._salt))
 
     def pass_decrypt(self, data):
-        return self._toxencryptsave.pass_decrypt(data, self._passphrase)
+        salt = self._toxencryptsave.get_salt(data)
+        if self._salt is None:  # saved data will be encrypted with the same key
+            self._salt = salt
+        return self._toxencryptsave.pass_key_decrypt(data, self._get_key(salt))
+
+    def derive_key(self, salt):
+        """
+        Derives key from current password. Derivation is slow, so key should be reused until password is changed
+        :param salt: TOX_PASS_SALT_LENGTH bytes
+        :return: key which must be freed with free_key
+        """
+        return self._toxencryptsave.pass_key_derive_with_salt(self._passphrase, salt)
+
+    def free_key(self, key):
+        self._toxencryptsave.pass_key_free(key)
+
+    def key_encrypt(self, data, key):
+        return self._toxencryptsave.pass_key_encrypt(data, key)
+
+    def key_decrypt(self, data, key):
+        return self._toxencryptsave.pass_key_decrypt(data, key)
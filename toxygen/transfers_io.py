@@ -0,0 +1,116 @@
+from collections import deque
+import threading
+import util
+
+
+QUEUE_SIZE = 256  # number of queued tasks of one transfer (about 350 KB of incoming chunks) which is reported
+
+WORKERS_COUNT = 2
+
+
+class TransfersIO(util.Singleton):
+    """
+    Executes disk operations of file transfers in small pool of worker threads. Every transfer has own queue, tasks
+    of one transfer are executed in order and by one worker at a time. Tasks are added by tox thread, so adding never
+    blocks - queue which grows over queue_size tasks (disk is slower than network) is reported to log instead
+    """
+
+    def __init__(self, workers_count=WORKERS_COUNT, queue_size=QUEUE_SIZE):
+        super().__init__()
+        self._workers_count = workers_count
+        self._queue_size = queue_size
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # notified when queue of transfer gets tasks
+        self._queues = {}  # key of transfer - deque of (function, args)
+        self._ready_keys = deque()  # transfers which have tasks and aren't processed by workers
+        self._busy_keys = set()  # transfers processed by workers
+        self._running = False
+        self._workers = []
+        self._depth, self._max_depth, self._tasks, self._overflows = 0, 0, 0, 0
+
+    def start(self):
+        with self._lock:
+            self._running = True
+        self._workers = [threading.Thread(target=self._run, name='transfers_io_{}'.format(i), daemon=True)
+                         for i in range(self._workers_count)]
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """
+        Stops workers after all queued tasks are executed
+        """
+        with self._lock:
+            self._running = False
+            self._ready.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self._workers and self._tasks:
+            util.log('File transfers I/O: ' + str(self.get_stats()))
+        self._workers = []
+
+    def execute(self, key, function, *args):
+        """
+        Adds task to queue of transfer. Never blocks
+        :param key: key of transfer, e.g. (friend number, file number)
+        :param function: function to call in worker thread
+        """
+        with self._lock:
+            queue = self._queues.setdefault(key, deque())
+            queue.append((function, args))
+            depth = len(queue)
+            self._depth += 1
+            self._max_depth = max(self._max_depth, depth)
+            if depth == self._queue_size + 1:
+                self._overflows += 1
+            if depth == 1 and key not in self._busy_keys:
+                self._ready_keys.append(key)
+                self._ready.notify()
+        if depth == self._queue_size + 1:
+            util.log('Disk is slower than file transfer {}: more than {} tasks are queued'.format(key, depth - 1))
+        if not self._workers:  # not started, e.g. in tests
+            self._execute_ready()
+
+    def _run(self):
+        while self._execute_ready(True):
+            pass
+
+    def _execute_ready(self, wait=False):
+        """
+        Executes all queued tasks of one transfer
+        :param wait: wait for tasks if there are no ready transfers
+        :return: False if there are no tasks and workers are stopped
+        """
+        with self._lock:
+            while wait and not self._ready_keys and self._running:
+                self._ready.wait()
+            if not self._ready_keys:
+                return False
+            key = self._ready_keys.popleft()
+            self._busy_keys.add(key)
+            tasks = list(self._queues[key])
+            self._queues[key].clear()
+        for function, args in tasks:
+            try:
+                function(*args)
+            except Exception as ex:
+                util.log('Exception in file transfer task: ' + str(ex))
+        with self._lock:
+            self._busy_keys.discard(key)
+            self._depth -= len(tasks)
+            self._tasks += len(tasks)
+            if self._queues[key]:
+                self._ready_keys.append(key)
+                self._ready.notify()
+            else:
+                del self._queues[key]
+        return True
+
+    def get_stats(self):
+        """
+        :return: dict with number of queued tasks (depth), max length of queue of one transfer (max_depth), number of
+        executed tasks (tasks) and number of times when queue of transfer grew over queue_size tasks (overflows)
+        """
+        with self._lock:
+            return {'depth': self._depth, 'max_depth': self._max_depth, 'tasks': self._tasks,
+                    'overflows': self._overflows}
@@ -50,6 +50,20 @@ def copy(src, dest):
             copy(full_file_name, os.path.join(dest, file_name))
 
 
+def atomic_write(path, data):
+    """
+    Writes data to temporary file and replaces file with it, so file is never left partially written
+    :param path: path to file
+    :param data: bytes
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fl:
+        fl.write(data)
+        fl.flush()
+        os.fsync(fl.fileno())
+    os.replace(tmp_path, path)
+
+
 def remove(folder):
     if os.path.isdir(folder):
         shutil.rmtree(folder)